@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: asgi.py
+"""ASGI application.
+
+Serves the same routes as main.app, but streams file responses (audio, artwork and
+cached track lists) asynchronously. The handlers themselves still run on a pool of
+threads, which is released as soon as a handler returns, rather than being held for
+the whole length of an audio stream.
+
+Launch with an ASGI server, e.g.:
+    uvicorn asgi:application --host 0.0.0.0 --port 8000
+"""
+
+# Native python imports
+import asyncio, io, logging, os, sys
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.util import FileWrapper
+
+# Local file imports
+import main
+from settings import ASGI_HANDLER_THREADS, ASGI_CHUNK_SIZE
+from util.util import RangeFileWrapper
+
+# Variables and settings
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Extension that lets a server send part of a file straight from the file descriptor.
+ZERO_COPY_EXTENSION = 'http.response.zerocopysend'
+
+
+class LindeleASGI:
+    """ASGI adapter around the pycnic WSGI application."""
+
+    def __init__(self, wsgi_app, handler_threads=ASGI_HANDLER_THREADS, chunk_size=ASGI_CHUNK_SIZE):
+        """Initialization function for the adapter.
+
+        Arguments:
+            wsgi_app (WSGI): The pycnic application whose routes should be served.
+            handler_threads (int): Number of requests that may be handled concurrently.
+            chunk_size (int): Number of bytes read at a time when streaming files without zero-copy support.
+        """
+        self.wsgi_app = wsgi_app
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=handler_threads, thread_name_prefix='asgi-handler')
+
+    async def __call__(self, scope, receive, send):
+        """Handle a single ASGI connection."""
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = await self.read_body(receive)
+        environ = self.build_environ(scope, body)
+
+        loop = asyncio.get_event_loop()
+        status, headers, response = await loop.run_in_executor(self.executor, self.call_wsgi, environ)
+
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+
+        try:
+            if isinstance(response, (FileWrapper, RangeFileWrapper)):
+                await self.send_file(scope, send, response)
+            else:
+                await self.send_iterable(send, response)
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+    async def lifespan(self, receive, send):
+        """Acknowledge server startup and shutdown events."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        """Read the full request body.
+
+        Request bodies for this API are small JSON documents, so they are buffered in memory.
+        """
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        return body
+
+    def build_environ(self, scope, body):
+        """Build a WSGI environ dictionary from an ASGI connection scope.
+
+        Arguments:
+            scope (dict): The ASGI connection scope.
+            body (bytes): The full request body.
+        """
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+            environ['REMOTE_PORT'] = str(scope['client'][1])
+
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin-1').upper().replace('-', '_')
+            value = raw_value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = f'HTTP_{name}'
+            if key in environ:
+                separator = '; ' if key == 'HTTP_COOKIE' else ','
+                value = environ[key] + separator + value
+            environ[key] = value
+        return environ
+
+    def call_wsgi(self, environ):
+        """Run the WSGI application for a request, on a handler thread.
+
+        Returns:
+            status (str): The HTTP status line.
+            headers (list): The response headers, as (name, value) tuples.
+            response (iterable): The response body. JSON responses are fully built,
+                while files are returned unread so they can be streamed.
+        """
+        captured = {}
+
+        def start_response(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+
+        # pycnic runs the handler when the application is first iterated.
+        response = iter(self.wsgi_app(environ, start_response))
+        return captured['status'], captured['headers'], response
+
+    async def send_file(self, scope, send, wrapper):
+        """Stream a file response, using zero-copy sends when the server supports them.
+
+        Arguments:
+            scope (dict): The ASGI connection scope.
+            send (callable): The ASGI send channel.
+            wrapper (FileWrapper or RangeFileWrapper): The file response returned by a handler.
+        """
+        filelike = wrapper.filelike
+        offset = filelike.tell()
+        remaining = getattr(wrapper, 'remaining', None)
+        if remaining is None:
+            remaining = os.fstat(filelike.fileno()).st_size - offset
+
+        if ZERO_COPY_EXTENSION in scope.get('extensions', {}):
+            await send({
+                'type': ZERO_COPY_EXTENSION,
+                'file': filelike,
+                'offset': offset,
+                'count': remaining,
+                'more_body': False,
+            })
+            return
+
+        loop = asyncio.get_event_loop()
+        more_body = True
+        while more_body:
+            data = b''
+            if remaining > 0:
+                # File reads may block, e.g. on a network share, so they happen off of the event loop.
+                data = await loop.run_in_executor(None, filelike.read, min(self.chunk_size, remaining))
+                remaining -= len(data)
+            # An empty read means the file was shorter than expected, so the response ends there.
+            more_body = bool(data) and remaining > 0
+            await send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+    async def send_iterable(self, send, response):
+        """Send any other response body, pulling each chunk on a handler thread.
+
+        Arguments:
+            send (callable): The ASGI send channel.
+            response (iterable): The response body.
+        """
+        loop = asyncio.get_event_loop()
+        chunk = await loop.run_in_executor(self.executor, next, response, None)
+        if chunk is None:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+        while True:
+            # Fetch one chunk ahead, so the last chunk can be marked as the end of the body.
+            next_chunk = await loop.run_in_executor(self.executor, next, response, None)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': next_chunk is not None})
+            if next_chunk is None:
+                return
+            chunk = next_chunk
+
+
+application = LindeleASGI(main.app)
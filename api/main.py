@@ -8,18 +8,23 @@ Otherwise, provides WSGI functionality.
 """
 
 # Native python imports
-import sys, argparse
+import sys, argparse, logging
 
 # Local file imports
-import music.models, music.routes, music.util
+import music.models, music.routes, music.util, music.watch
 import users.models, users.routes
 import users.util
 import util.routes
-from util.models import Base
-from util.util import BaseHandler, engine
+from util.models import Base, BINARY_GUIDS_MIGRATION, UnsupportedMigration, migrate_guid_columns, migration_completed
+from util.util import BaseHandler, engine, end_request_session
 
 # PIP library imports
 from pycnic.core import WSGI, Handler
+import sqlalchemy
+
+# Variables and settings
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
 
 class Lindele(BaseHandler):
     """Base URL handler.
@@ -48,6 +53,8 @@ class app(WSGI):
         waitress-serve --listen=*:80 main:app
     Launch on unix with:
         gunicorn -b 0.0.0.0:80 main:app
+    Or over ASGI, see asgi.py:
+        uvicorn asgi:application --host 0.0.0.0 --port 80
     """
 
     routes = [
@@ -70,6 +77,9 @@ class app(WSGI):
         ('/songs/(\d+)', music.routes.Songs()),
         ('/songs/(\d+)/audio', music.routes.Audio()),
         ('/songs/(\d+)/artwork', music.routes.Artwork()),
+        ('/songs/(\d+)/hls/master\.m3u8', music.routes.HlsMaster()),
+        ('/songs/(\d+)/hls/(\d+)/index\.m3u8', music.routes.HlsVariant()),
+        ('/songs/(\d+)/hls/(\d+)/(seg\d+\.ts)', music.routes.HlsVariant()),
 
         # All things playlists
         ('/playlists', music.routes.Playlists()),
@@ -82,15 +92,99 @@ class app(WSGI):
 
         # Server functionality
         ('/refresh', music.routes.BuildDatabase()),
+        ('/refresh/status', music.routes.RefreshStatus()),
+        ('/refresh/status/(\d+)', music.routes.RefreshStatus()),
+        ('/refresh/cancel', music.routes.CancelRefresh()),
         ('/remount', util.routes.Remount()),
         ('/restart', util.routes.Restart()),
+        ('/metrics', util.routes.Metrics()),
     ]
 
+    def teardown(self):
+        """Release the database sessions of the request, even if handling it raised an error."""
+        end_request_session()
+
+    def __iter__(self):
+        """Handle the request, keeping the response body so it can be closed once it is sent."""
+        self.body = super().__iter__()
+        return self.body
+
+    def close(self):
+        """Close the response body, which WSGI servers call once it has been sent, or the client went away.
+
+        The servers call this on the application's return value, rather than on the body, so
+        without it file responses, e.g. audio streams, would never be closed.
+        """
+        body = getattr(self, 'body', None)
+        if hasattr(body, 'close'):
+            body.close()
+
 def init_database():
     """Create database and relevant tables."""
     # This should initialize the database as necessary.
     print('Initializing database.')
     Base.metadata.create_all(engine)
+    upgrade_database()
+
+def upgrade_database():
+    """Bring the tables of an existing database up to date with the models.
+
+    create_all only creates missing tables, so anything added to an existing table
+    since it was created needs to be added here.
+    """
+    Base.metadata.create_all(engine)
+    inspector = sqlalchemy.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                print(f'Adding column {table.name}.{column.name}.')
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as conn:
+                    conn.execute(sqlalchemy.text(
+                        f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}'
+                    ))
+
+    # Track paths are unique, which tracks added twice by overlapping scans would keep from being enforced.
+    merged = music.util.merge_duplicate_tracks()
+    if merged:
+        print(f'Removed {merged} tracks stored twice under the same path.')
+
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                print(f'Creating index {index.name}.')
+                index.create(engine)
+
+    try:
+        converted = migrate_guid_columns(engine)
+    except UnsupportedMigration as e:
+        print(f'Could not convert GUIDs to binary storage: {e}')
+        return
+    if converted:
+        print(f'Converted {converted} GUIDs to binary storage.')
+
+def check_database():
+    """Warn when the database hasn't been upgraded, as users and playlists can't be found by GUID until it is.
+
+    Only the record of the completed migration is looked up, so this stays quick however many
+    users and playlists there are.
+    """
+    try:
+        if migration_completed(engine, BINARY_GUIDS_MIGRATION):
+            return
+    except sqlalchemy.exc.SQLAlchemyError:
+        # The database was created before migrations were recorded, or hasn't been created yet.
+        pass
+    try:
+        if not sqlalchemy.inspect(engine).get_table_names():
+            return
+    except sqlalchemy.exc.SQLAlchemyError:
+        return
+    logger.warn('GUIDs may still be stored as hex strings. '
+                'Run "python main.py --upgrade_database" to convert them.')
 
 def main():
     """Main function used for administrative tasks.
@@ -98,12 +192,18 @@ def main():
     Optional arguments:
         -a --make_admin [Email] (str): Email of a user to make an admin.
         -i --init_database: Flag to initialize database.
+        -u --upgrade_database: Flag to update the tables of an existing database.
         -l --list_admins: Flag to list all admins in database.
+        -k --rotate_jwt_key: Flag to replace the key used to sign session tokens.
+        -w --watch: Flag to keep the database in step with the music folder, until interrupted.
     """
     parser = argparse.ArgumentParser(description="An open-source music streaming API.")
     parser.add_argument('-a', '--make_admin', metavar='Email', type=str, help='Email address of the user to make an admin')
     parser.add_argument('-l', '--list_admins', action="store_true", help='List accounts that are admins.')
     parser.add_argument('-i', '--init_database', action='store_true', help='Initialize the database.')
+    parser.add_argument('-u', '--upgrade_database', action='store_true', help='Update the tables of an existing database.')
+    parser.add_argument('-k', '--rotate_jwt_key', action='store_true', help='Rotate the key used to sign session tokens.')
+    parser.add_argument('-w', '--watch', action='store_true', help='Watch the music folder, adding and removing tracks as files change.')
     args = parser.parse_args()
 
     if args.init_database:
@@ -111,10 +211,20 @@ def main():
         init_database()
         # And asynchronously load the music
         music.util.refresh_database()
+    elif args.upgrade_database:
+        upgrade_database()
     elif args.list_admins:
         admins = users.util.get_all_admins()
         for admin_email, admin_username in admins:
             print(f'{admin_email} - {admin_username}')
+    elif args.rotate_jwt_key:
+        kid = users.util.rotate_jwt_key()
+        print(f'Session tokens are now signed with key {kid}.')
+    elif args.watch:
+        try:
+            music.watch.watch_library()
+        except KeyboardInterrupt:
+            pass
     elif args.make_admin:
         print(f'Making user {args.make_admin} an admin.')
         success = users.util.make_user_admin(args.make_admin)
@@ -127,3 +237,5 @@ application = app
 
 if __name__ == '__main__':
     main()
+else:
+    check_database()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: music/cache.py
+"""Local disk cache of track audio, for music stored on a media server, and prefetching of upcoming tracks."""
+
+# Native python imports
+import logging, os, shutil, tempfile, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Local file imports
+from settings import TRACK_CACHE_ENABLED, TRACK_CACHE_DIR, TRACK_CACHE_MAX_BYTES, TRACK_CACHE_FILL_WORKERS
+from settings import PREFETCH_BYTES
+from util.util import open_media_file, process_exists
+
+# Variables and settings
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Temporary entries older than this, in seconds, are deleted even if the process writing them may still be running.
+TEMP_MAX_AGE = 24 * 60 * 60
+
+
+def path_size(path):
+    """Size of a file, or the total size of the files in a directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def delete_path(path):
+    """Delete a file or directory, if it still exists."""
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+class FileCache:
+    """Size-limited cache of files in a local directory.
+
+    Entries are keyed by a string identifying their contents, e.g. a track hash, and are filled
+    from a source file in the background. A file is written under a temporary name, and only
+    renamed to its key once it is complete, so partially copied files are never served.
+
+    Entries that have only been used once are evicted first, least recently used first, and
+    entries that have been used repeatedly are evicted after those.
+
+    An entry may also be a directory of files that are used together, which is added and
+    evicted as a whole.
+
+    Several processes, e.g. gunicorn workers, may share the directory. Temporary entries are
+    named after the process writing them, so a process only deletes those of processes that
+    have died. The directory is counted again before evicting, so entries added by other
+    processes count towards the size limit.
+    """
+
+    def __init__(self, directory, max_bytes, fill_workers):
+        """Initialization function for the cache.
+
+        Arguments:
+            directory (str): Directory the cached files are stored in.
+            max_bytes (int): Maximum total size of the cached files.
+            fill_workers (int): Number of files that may be copied into the cache at once.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Both map keys to file sizes, ordered from least to most recently used.
+        self._used_once = OrderedDict()
+        self._used_often = OrderedDict()
+        self._size = 0
+        self._filling = set()
+        self._executor = ThreadPoolExecutor(max_workers=fill_workers, thread_name_prefix='file-cache-fill')
+        self._load()
+
+    def _load(self):
+        """Index the files already in the cache directory, e.g. from before a restart."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._sync()
+            self._evict()
+
+    def _sync(self):
+        """Bring the index in step with the cache directory, which other processes may have changed. The lock must be held.
+
+        Entries added by other processes are indexed as used once, oldest first, and temporary
+        entries left over from fills that were interrupted are deleted.
+        """
+        now = time.time()
+        found = []
+        try:
+            scan = list(os.scandir(self.directory))
+        except OSError as e:
+            logger.warn(f'Could not list {self.directory}: {e}')
+            return
+        for entry in scan:
+            try:
+                if entry.name.startswith('.'):
+                    if self._temp_abandoned(entry.name, now - entry.stat().st_mtime):
+                        delete_path(entry.path)
+                    continue
+                if entry.name not in self._used_once and entry.name not in self._used_often:
+                    found.append((entry.stat().st_mtime, entry.name, path_size(entry.path)))
+            except OSError:
+                # Removed by another process while listing.
+                continue
+        on_disk = {entry.name for entry in scan}
+        for entries in (self._used_once, self._used_often):
+            for key in [key for key in entries if key not in on_disk]:
+                self._size -= entries.pop(key)
+        for _, key, size in sorted(found):
+            self._used_once[key] = size
+            self._size += size
+
+    def _temp_abandoned(self, name, age):
+        """Check whether a temporary entry was left behind by a fill that was interrupted.
+
+        Arguments:
+            name (str): Name of the entry, '.<pid>-<random>' for the process writing it.
+            age (float): Seconds since the entry was last modified.
+        """
+        if age > TEMP_MAX_AGE:
+            return True
+        pid = name[1:].split('-', 1)[0]
+        return pid.isdigit() and not process_exists(int(pid))
+
+    def path(self, key):
+        """Location of the cached file for a key."""
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key):
+        """Find the cached file or directory for a key, and record that it was used.
+
+        Arguments:
+            key (str): Key identifying the entry.
+
+        Returns:
+            result (str): Path of the entry, or None if it is not cached.
+        """
+        with self._lock:
+            if key in self._used_often:
+                self._used_often.move_to_end(key)
+            elif key in self._used_once:
+                self._used_often[key] = self._used_once.pop(key)
+            else:
+                return None
+        # Keep the modification time in step with use, so eviction order survives restarts.
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            # The entry was removed from under the cache.
+            self._remove(key)
+            return None
+        return self.path(key)
+
+    def open(self, key):
+        """Open the cached file for a key, if it is in the cache.
+
+        Arguments:
+            key (str): Key identifying the file.
+
+        Returns:
+            result (file): The opened file, or None if the file is not cached.
+        """
+        path = self.lookup(key)
+        if not path:
+            return None
+        try:
+            return open(path, 'rb')
+        except OSError:
+            self._remove(key)
+            return None
+
+    def fill(self, key, source_path):
+        """Copy a file into the cache in the background, unless it is already cached.
+
+        Arguments:
+            key (str): Key identifying the file.
+            source_path (str): Path of the file to copy.
+        """
+        with self._lock:
+            if key in self._filling or key in self._used_once or key in self._used_often:
+                return
+            self._filling.add(key)
+        self._executor.submit(self._fill, key, source_path)
+
+    def _fill(self, key, source_path):
+        """Copy a file into the cache."""
+        temp_path = None
+        try:
+            with open_media_file(source_path) as source:
+                if os.fstat(source.fileno()).st_size > self.max_bytes:
+                    return
+                destination, temp_path = self.create_temp_file()
+                with destination:
+                    shutil.copyfileobj(source, destination)
+            self.store(key, temp_path)
+            temp_path = None
+        except Exception as e:
+            logger.warn(f'Could not cache {source_path}: {e}')
+        finally:
+            if temp_path:
+                os.remove(temp_path)
+            with self._lock:
+                self._filling.discard(key)
+
+    def create_temp_file(self):
+        """Create a file to write a new entry to, before it is stored in the cache.
+
+        Returns:
+            temp_file (file): The temporary file, opened for writing.
+            temp_path (str): Path of the temporary file, to pass to store() once it is complete.
+        """
+        fd, temp_path = tempfile.mkstemp(prefix=f'.{os.getpid()}-', dir=self.directory)
+        return os.fdopen(fd, 'wb'), temp_path
+
+    def create_temp_dir(self):
+        """Create a directory to write a new entry to, before it is stored in the cache.
+
+        Returns:
+            temp_path (str): Path of the temporary directory, to pass to store() once it is complete.
+        """
+        return tempfile.mkdtemp(prefix=f'.{os.getpid()}-', dir=self.directory)
+
+    def store(self, key, temp_path):
+        """Move a complete temporary file or directory into the cache.
+
+        Arguments:
+            key (str): Key identifying the entry.
+            temp_path (str): Path of the temporary entry, from create_temp_file() or create_temp_dir().
+        """
+        size = path_size(temp_path)
+        if size > self.max_bytes:
+            delete_path(temp_path)
+            return
+        if os.path.isdir(self.path(key)):
+            # Directories can't be replaced in one step.
+            delete_path(self.path(key))
+        os.replace(temp_path, self.path(key))
+        with self._lock:
+            # Entries added by other processes count towards the limit too. They are indexed
+            #  first, so the new entry is still the most recently used one.
+            self._sync()
+            for entries in (self._used_once, self._used_often):
+                if key in entries:
+                    self._size -= entries.pop(key)
+            self._used_once[key] = size
+            self._size += size
+            self._evict()
+
+    def _evict(self):
+        """Remove files until the cache fits its size limit. The lock must be held."""
+        while self._size > self.max_bytes and (self._used_once or self._used_often):
+            entries = self._used_once if self._used_once else self._used_often
+            key, size = entries.popitem(last=False)
+            self._size -= size
+            delete_path(self.path(key))
+
+    def _remove(self, key):
+        """Forget about a file that is no longer in the cache directory."""
+        with self._lock:
+            for entries in (self._used_once, self._used_often):
+                if key in entries:
+                    self._size -= entries.pop(key)
+
+
+def track_cache_key(track_path, content_key):
+    """Key of a track file in the track cache.
+
+    Arguments:
+        track_path (str): Path of the track file being served, which may be a FLAC copy of the track.
+        content_key (str): Identifies the contents of the track, see music.util.track_content_key().
+    """
+    if track_path.endswith('.flac'):
+        return f'{content_key}.flac'
+    return content_key
+
+
+class Prefetcher:
+    """Warms tracks that are likely to be played soon, in the background.
+
+    With a track cache, upcoming tracks are copied into it. Otherwise, the OS is asked to read
+    them ahead into its page cache, so the first bytes of the next track don't stall on the disk
+    or the media server.
+    """
+
+    def __init__(self, cache):
+        """Initialization function for the prefetcher.
+
+        Arguments:
+            cache (FileCache): Cache to copy upcoming tracks into, or None.
+        """
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='track-prefetch')
+
+    def warm(self, tracks, flac=False):
+        """Warm a list of tracks.
+
+        Arguments:
+            tracks (list): (track_path, content_key, lossless_path) tuples of the tracks to warm.
+            flac (bool): Whether the FLAC copies of the tracks will be played, where they exist.
+        """
+        for track_path, content_key, lossless_path in tracks:
+            if flac and lossless_path:
+                track_path = lossless_path
+            with self._lock:
+                if track_path in self._pending:
+                    continue
+                self._pending.add(track_path)
+            self._executor.submit(self._warm, track_path, content_key)
+
+    def _warm(self, track_path, content_key):
+        """Warm a single track."""
+        try:
+            if self.cache and content_key:
+                self.cache.fill(track_cache_key(track_path, content_key), track_path)
+                return
+            with open_media_file(track_path) as track:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(track.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                else:
+                    track.read(PREFETCH_BYTES)
+        except Exception as e:
+            logger.info(f'Could not prefetch {track_path}: {e}')
+        finally:
+            with self._lock:
+                self._pending.discard(track_path)
+
+
+track_cache = None
+if TRACK_CACHE_ENABLED:
+    track_cache = FileCache(TRACK_CACHE_DIR, TRACK_CACHE_MAX_BYTES, TRACK_CACHE_FILL_WORKERS)
+
+track_prefetcher = Prefetcher(track_cache)
+
+
+def open_track(track_path, content_key):
+    """Open a track file, from the track cache when possible.
+
+    Tracks that aren't cached are opened from the media server, and copied into the cache
+    in the background.
+
+    Arguments:
+        track_path (str): Path of the track file on the media server.
+        content_key (str): Identifies the contents of the track, see music.util.track_content_key().
+
+    Returns:
+        result (file): The opened track file.
+
+    Raises:
+        MediaUnavailable: If the media server was not available in time.
+        OSError: If the file could not be opened for any other reason.
+    """
+    cache_key = track_cache_key(track_path, content_key)
+    use_cache = track_cache and content_key
+    if use_cache:
+        track = track_cache.open(cache_key)
+        if track:
+            return track
+    track = open_media_file(track_path)
+    if use_cache:
+        track_cache.fill(cache_key, track_path)
+    return track
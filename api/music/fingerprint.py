@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: music/fingerprint.py
+"""Audio fingerprints, which identify a track by its audio alone, so they survive retagging."""
+
+# Native python imports
+import hashlib, logging, struct
+
+# Local file imports
+from settings import FINGERPRINT_ALGORITHM, FINGERPRINT_SAMPLE_THRESHOLD, FINGERPRINT_SAMPLE_COUNT
+
+# PIP library imports
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Variables and settings
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Hash constructors by algorithm name, for the algorithms whose packages are installed.
+FINGERPRINT_HASHERS = {
+    'blake2b': lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash:
+    FINGERPRINT_HASHERS['xxh3'] = xxhash.xxh3_128
+if blake3:
+    FINGERPRINT_HASHERS['blake3'] = blake3.blake3
+
+# Algorithm new fingerprints are made with, falling back to blake2b if the configured one's
+#  package isn't installed.
+ALGORITHM = FINGERPRINT_ALGORITHM
+if ALGORITHM == 'auto':
+    ALGORITHM = 'xxh3' if xxhash else 'blake2b'
+elif ALGORITHM not in FINGERPRINT_HASHERS:
+    logger.warn(f'Fingerprint algorithm {ALGORITHM} is unavailable, using blake2b.')
+    ALGORITHM = 'blake2b'
+
+# Number of bytes hashed at each sample of a sampled fingerprint.
+SAMPLE_SIZE = 65536
+
+# Number of header packets at the start of an Ogg stream, by codec. Audio starts on the page after them.
+OGG_HEADER_PACKETS = {
+    'vorbis': 3,
+    'opus': 2,
+}
+
+
+def fingerprint_is_current(fingerprint):
+    """Check whether a stored fingerprint was made with the current algorithm.
+
+    Fingerprints are stored as '<algorithm>:<digest>', or '<algorithm>-sampled:<digest>' for
+    sampled ones, so fingerprints made with different algorithms never match each other, and
+    are replaced on the next refresh.
+
+    Arguments:
+        fingerprint (str): The stored fingerprint, or None.
+    """
+    if not fingerprint:
+        return False
+    name = fingerprint.split(':', 1)[0]
+    return name.split('-', 1)[0] == ALGORITHM
+
+
+def _skip_id3v2(track_file):
+    """Offset of the first byte after an ID3v2 tag at the start of a file, or 0 if there is none."""
+    track_file.seek(0)
+    header = track_file.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in header[6:10]:
+        size = size * 128 + (byte & 0x7F)
+    return 10 + size + (10 if header[5] & 0x10 else 0)
+
+
+def _strip_trailing_tags(track_file, start, end):
+    """End of the audio frames of a file, before any APEv2 and ID3v1 tags at its end."""
+    if end - start >= 128:
+        track_file.seek(end - 128)
+        if track_file.read(3) == b'TAG':
+            end -= 128
+    if end - start >= 32:
+        track_file.seek(end - 32)
+        footer = track_file.read(32)
+        if footer[:8] == b'APETAGEX':
+            size, flags = struct.unpack('<I4xI', footer[12:24])
+            # The size includes the footer, but not the header, if there is one.
+            end -= size + (32 if flags & 0x80000000 else 0)
+    return max(end, start)
+
+
+def audio_payload(track_file, codec):
+    """Find the part of a track file that holds its audio.
+
+    This is the data chunk of a WAV file, the mdat box of an MP4 file, the frames after the
+    metadata blocks of a FLAC file, and the frames between the leading and trailing tags of an
+    MP3 or AAC file. Ogg streams interleave their tags with the audio in pages, so only the
+    pages after their header packets are used, without the page headers.
+
+    Arguments:
+        track_file (ScanFile): The opened track file.
+        codec (str): Audio codec of the track, as recorded on Song.
+
+    Returns:
+        start (int): Offset of the first byte of audio.
+        end (int): Offset after the last byte of audio.
+        ogg_header_packets (int): Number of header packets to skip, for Ogg streams, or None.
+    """
+    size = track_file.size
+    start = _skip_id3v2(track_file)
+    track_file.seek(start)
+    magic = track_file.read(12)
+
+    if magic[:4] == b'OggS':
+        if codec in OGG_HEADER_PACKETS:
+            return start, size, OGG_HEADER_PACKETS[codec]
+        # Other Ogg streams declare their number of header packets in their own way.
+        return 0, size, None
+
+    if magic[:4] == b'RIFF' and magic[8:12] == b'WAVE':
+        position = start + 12
+        while position + 8 <= size:
+            track_file.seek(position)
+            chunk_id, chunk_size = struct.unpack('<4sI', track_file.read(8))
+            if chunk_id == b'data':
+                return position + 8, min(position + 8 + chunk_size, size), None
+            # Chunks are padded to an even length.
+            position += 8 + chunk_size + (chunk_size & 1)
+        return 0, size, None
+
+    if magic[4:8] == b'ftyp':
+        position = start
+        while position + 8 <= size:
+            track_file.seek(position)
+            box_size, box_type = struct.unpack('>I4s', track_file.read(8))
+            header_size = 8
+            if box_size == 1:
+                largesize = track_file.read(8)
+                if len(largesize) < 8:
+                    break
+                box_size = struct.unpack('>Q', largesize)[0]
+                header_size = 16
+            elif box_size == 0:
+                box_size = size - position
+            if box_type == b'mdat':
+                return position + header_size, min(position + box_size, size), None
+            if box_size < header_size:
+                break
+            position += box_size
+        return 0, size, None
+
+    if magic[:4] == b'fLaC':
+        position = start + 4
+        while position + 4 <= size:
+            track_file.seek(position)
+            header = track_file.read(4)
+            position += 4 + int.from_bytes(header[1:4], 'big')
+            if header[0] & 0x80:
+                # The last metadata block.
+                break
+        return min(position, size), _strip_trailing_tags(track_file, position, size), None
+
+    return start, _strip_trailing_tags(track_file, start, size), None
+
+
+class FingerprintBuilder:
+    """Builds the audio fingerprint of a track, from the track's bytes as they are read.
+
+    Like SeekIndexBuilder, the whole file is fed in chunks of any size, so the fingerprint can
+    be built while the file is being read for something else.
+    """
+
+    def __init__(self, start, end, ogg_header_packets=None):
+        """Initialization function for the builder.
+
+        Arguments:
+            start (int): Offset of the first byte of audio, from audio_payload().
+            end (int): Offset after the last byte of audio, from audio_payload().
+            ogg_header_packets (int): Number of header packets to skip, for Ogg streams, or None.
+        """
+        self._hasher = FINGERPRINT_HASHERS[ALGORITHM]()
+        self.start = start
+        self.end = end
+        self._ogg = ogg_header_packets is not None
+        self._headers_left = ogg_header_packets or 0
+        self._buffer = b''
+        # File offset of the next chunk.
+        self._position = 0
+
+    def feed(self, chunk):
+        """Process the next chunk of the track.
+
+        Arguments:
+            chunk (bytes): The bytes following those fed in so far.
+        """
+        position = self._position
+        self._position += len(chunk)
+        first = max(self.start - position, 0)
+        last = min(self.end - position, len(chunk))
+        if first >= last:
+            return
+        if self._ogg:
+            self._feed_ogg(chunk[first:last])
+        else:
+            self._hasher.update(chunk[first:last])
+
+    def _feed_ogg(self, data):
+        """Hash the packet data of the audio pages of an Ogg stream."""
+        buffer = self._buffer + data
+        index = 0
+        while len(buffer) - index >= 27:
+            if buffer[index:index + 4] != b'OggS':
+                # Lost track of the pages, e.g. in a damaged file, so find the next one.
+                found = buffer.find(b'OggS', index + 1)
+                if found < 0:
+                    index = len(buffer) - 3
+                    break
+                index = found
+                continue
+            header_length = 27 + buffer[index + 26]
+            if len(buffer) - index < header_length:
+                break
+            lacing = buffer[index + 27:index + header_length]
+            page_length = header_length + sum(lacing)
+            if len(buffer) - index < page_length:
+                break
+            if self._headers_left > 0:
+                # Each lacing value below 255 ends a packet.
+                self._headers_left -= sum(1 for value in lacing if value < 255)
+            else:
+                self._hasher.update(buffer[index + header_length:index + page_length])
+            index += page_length
+        self._buffer = buffer[index:]
+
+    def fingerprint(self):
+        """The finished fingerprint, as it is stored."""
+        return f'{ALGORITHM}:{self._hasher.hexdigest()}'
+
+
+def needs_sampling(start, end):
+    """Check whether the audio of a track is large enough to be fingerprinted from samples.
+
+    Arguments:
+        start (int): Offset of the first byte of audio.
+        end (int): Offset after the last byte of audio.
+    """
+    return bool(FINGERPRINT_SAMPLE_THRESHOLD) and end - start > FINGERPRINT_SAMPLE_THRESHOLD
+
+
+def sampled_fingerprint(track_file, start, end):
+    """Fingerprint a large track from evenly spaced samples of its audio, rather than all of it.
+
+    Arguments:
+        track_file (ScanFile): The opened track file.
+        start (int): Offset of the first byte of audio, from audio_payload().
+        end (int): Offset after the last byte of audio, from audio_payload().
+
+    Returns:
+        result (str): The fingerprint, as it is stored.
+    """
+    hasher = FINGERPRINT_HASHERS[ALGORITHM]()
+    length = end - start
+    hasher.update(str(length).encode())
+    count = max(FINGERPRINT_SAMPLE_COUNT, 2)
+    for sample in range(count):
+        track_file.seek(start + (length - SAMPLE_SIZE) * sample // (count - 1))
+        hasher.update(track_file.read(SAMPLE_SIZE))
+    return f'{ALGORITHM}-sampled:{hasher.hexdigest()}'
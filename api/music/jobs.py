@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: music/jobs.py
+"""Refresh jobs, which keep refreshes of the track database from overlapping and record their progress."""
+
+# Native python imports
+import datetime, logging, os, socket, threading, time
+
+# Local file imports
+from music.models import RefreshJob, RefreshState
+from settings import REFRESH_INTERVAL, REFRESH_PROGRESS_INTERVAL, REFRESH_STALE_AFTER
+from util.util import access_db
+
+# PIP library imports
+from sqlalchemy import or_, func
+from sqlalchemy.exc import IntegrityError
+
+# Variables and settings
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class RefreshCancelled(Exception):
+    """Raised within a refresh that was asked to stop, or whose lock was taken over."""
+
+
+def _lock_row_id(db_conn):
+    """Id of the RefreshState row used as the refresh lock, which is created if there is none."""
+    state_id = db_conn.query(func.min(RefreshState.id)).scalar()
+    if state_id is None:
+        db_conn.add(RefreshState(id=1, is_refreshing=False))
+        try:
+            db_conn.commit()
+        except IntegrityError:
+            # Another process created it first.
+            db_conn.rollback()
+        state_id = 1
+    return state_id
+
+
+def start_refresh_job(force=False, full=True):
+    """Take the refresh lock, and create a job for the refresh that holds it.
+
+    The lock is taken with a single conditional UPDATE, so only one process can take it, even
+    when several gunicorn workers are asked to refresh at once. A lock whose heartbeat hasn't been
+    renewed in REFRESH_STALE_AFTER seconds, e.g. because its process was killed, is taken over.
+
+    Arguments:
+        force (bool): Whether to refresh even if the last refresh started less than
+            REFRESH_INTERVAL seconds ago.
+        full (bool): Whether the job refreshes the whole music folder. Jobs that only ingest the
+            paths the library watcher saw change don't count as the last refresh.
+
+    Returns:
+        result (int): Id of the new job, or None if another refresh holds the lock, or started too recently.
+    """
+    now = datetime.datetime.now()
+    with access_db() as db_conn:
+        state_id = _lock_row_id(db_conn)
+        query = db_conn.query(RefreshState)\
+                       .filter(RefreshState.id==state_id)\
+                       .filter(or_(RefreshState.is_refreshing==False,
+                                   RefreshState.is_refreshing==None,
+                                   RefreshState.heartbeat==None,
+                                   RefreshState.heartbeat < now - datetime.timedelta(seconds=REFRESH_STALE_AFTER)))
+        if not force:
+            query = query.filter(or_(RefreshState.last_refresh==None,
+                                     RefreshState.last_refresh < now - datetime.timedelta(seconds=REFRESH_INTERVAL)))
+        changes = {RefreshState.is_refreshing: True, RefreshState.heartbeat: now}
+        if full:
+            changes[RefreshState.last_refresh] = now
+        taken = query.update(changes, synchronize_session=False)
+        if not taken:
+            db_conn.rollback()
+            return None
+
+        state = db_conn.query(RefreshState).get(state_id)
+        if state.job_id:
+            # A job that still looks like it's running lost the lock by not responding.
+            db_conn.query(RefreshJob)\
+                   .filter(RefreshJob.id==state.job_id)\
+                   .filter(RefreshJob.state=='running')\
+                   .update({RefreshJob.state: 'failed',
+                            RefreshJob.finished_at: now,
+                            RefreshJob.error: 'Stopped responding.'}, synchronize_session=False)
+        job = RefreshJob(state='running',
+                         phase='listing',
+                         owner=f'{socket.gethostname()}:{os.getpid()}',
+                         started_at=now,
+                         phase_started_at=now,
+                         updated_at=now,
+                         files_done=0)
+        db_conn.add(job)
+        db_conn.flush()
+        state.job_id = job.id
+        db_conn.commit()
+        logger.info(f'Started refresh job {job.id}.')
+        return job.id
+
+
+class ScanProgress:
+    """Progress of a scan that isn't recorded anywhere, e.g. of the files the library watcher saw change."""
+
+    def phase(self, phase, files_total=None):
+        """Record that the scan moved on to another phase.
+
+        Arguments:
+            phase (str): One of listing, reading or reconciling.
+            files_total (int): Number of files the scan will read, once known.
+        """
+
+    def advance(self, files=1):
+        """Record that more files were read.
+
+        Arguments:
+            files (int): Number of files read since the last call.
+        """
+
+
+class RefreshProgress(ScanProgress):
+    """Progress of a refresh job, which is written to its row every REFRESH_PROGRESS_INTERVAL seconds.
+
+    Each time progress is written, the job checks whether it was cancelled, raising
+    RefreshCancelled if so. The lock's heartbeat is renewed then too, and also by a background
+    thread until the job finishes, so a job doesn't lose its lock while it lists a large folder,
+    waits on slow reads, or reconciles what it read.
+    """
+
+    def __init__(self, job_id, interval=REFRESH_PROGRESS_INTERVAL, heartbeat_interval=REFRESH_STALE_AFTER / 4):
+        """Initialization function for the progress.
+
+        Arguments:
+            job_id (int): Id of the job, from start_refresh_job().
+            interval (float): Seconds between writes of the progress.
+            heartbeat_interval (float): Seconds between renewals of the lock's heartbeat by the
+                background thread.
+        """
+        self.job_id = job_id
+        self.interval = interval
+        self.heartbeat_interval = heartbeat_interval
+        self.files_done = 0
+        self._next_report = time.monotonic() + interval
+        self._finished = threading.Event()
+        self._heartbeat = threading.Thread(target=self._keep_alive, name=f'refresh-heartbeat-{job_id}', daemon=True)
+        self._heartbeat.start()
+
+    def phase(self, phase, files_total=None):
+        """Record that the job moved on to another phase, and write the progress right away."""
+        changes = {RefreshJob.phase: phase, RefreshJob.phase_started_at: datetime.datetime.now()}
+        if files_total is not None:
+            changes[RefreshJob.files_total] = files_total
+        self.report(changes)
+
+    def advance(self, files=1):
+        """Record that more files were read, writing the progress if it's due."""
+        self.files_done += files
+        if time.monotonic() >= self._next_report:
+            self.report()
+
+    def report(self, changes=None):
+        """Write the progress, renew the lock, and check whether the job was cancelled.
+
+        Arguments:
+            changes (dict): Other columns of the job to update.
+
+        Raises:
+            RefreshCancelled: If the job was cancelled, or another job took over the lock.
+        """
+        now = datetime.datetime.now()
+        changes = dict(changes or {})
+        changes.update({RefreshJob.files_done: self.files_done, RefreshJob.updated_at: now})
+        with access_db() as db_conn:
+            db_conn.query(RefreshJob)\
+                   .filter(RefreshJob.id==self.job_id)\
+                   .update(changes, synchronize_session=False)
+            held = self._renew(db_conn, now)
+            cancel_requested = db_conn.query(RefreshJob.cancel_requested)\
+                                      .filter(RefreshJob.id==self.job_id)\
+                                      .scalar()
+            db_conn.commit()
+        self._next_report = time.monotonic() + self.interval
+        if not held:
+            raise RefreshCancelled('Another refresh took over the lock.')
+        if cancel_requested:
+            raise RefreshCancelled()
+
+    def _renew(self, db_conn, now):
+        """Renew the lock's heartbeat, returning whether the job still holds the lock."""
+        return db_conn.query(RefreshState)\
+                      .filter(RefreshState.job_id==self.job_id)\
+                      .filter(RefreshState.is_refreshing==True)\
+                      .update({RefreshState.heartbeat: now}, synchronize_session=False)
+
+    def _keep_alive(self):
+        """Renew the lock's heartbeat every heartbeat_interval seconds, until the job finishes or loses the lock."""
+        while not self._finished.wait(self.heartbeat_interval):
+            try:
+                with access_db() as db_conn:
+                    held = self._renew(db_conn, datetime.datetime.now())
+                    db_conn.commit()
+            except Exception as e:
+                logger.warn(f'Could not renew the heartbeat of refresh job {self.job_id}.')
+                logger.warn(e)
+            else:
+                if not held:
+                    # The job notices on its next report.
+                    return
+
+    def finish(self, state, result=None, error=None):
+        """Record how the job ended, and release the lock.
+
+        Arguments:
+            state (str): One of finished, cancelled or failed.
+            result (dict): Numbers of tracks added, relinked and marked missing, from LibraryScan.finish().
+            error (str): Why the job failed.
+        """
+        self._finished.set()
+        self._heartbeat.join()
+        now = datetime.datetime.now()
+        changes = {RefreshJob.state: state,
+                   RefreshJob.phase: None,
+                   RefreshJob.files_done: self.files_done,
+                   RefreshJob.updated_at: now,
+                   RefreshJob.finished_at: now,
+                   RefreshJob.error: error}
+        for column in ('added', 'relinked', 'missing'):
+            if result and column in result:
+                changes[getattr(RefreshJob, column)] = result[column]
+        with access_db() as db_conn:
+            db_conn.query(RefreshJob)\
+                   .filter(RefreshJob.id==self.job_id)\
+                   .update(changes, synchronize_session=False)
+            # Only release the lock if this job still holds it.
+            db_conn.query(RefreshState)\
+                   .filter(RefreshState.job_id==self.job_id)\
+                   .update({RefreshState.is_refreshing: False, RefreshState.heartbeat: now},
+                           synchronize_session=False)
+            db_conn.commit()
+        logger.info(f'Refresh job {self.job_id} {state}.')
+
+
+def fetch_refresh_status(job_id=None):
+    """Fetch the progress of a refresh job.
+
+    Arguments:
+        job_id (int): Id of the job, or None for the latest one.
+
+    Returns:
+        result (dict): The job's state, phase and counts, how many files it reads per second,
+            and the estimated number of seconds until it has read every file, or None if there
+            is no such job.
+    """
+    with access_db(read_only=True) as db_conn:
+        query = db_conn.query(RefreshJob)
+        if job_id is None:
+            job = query.order_by(RefreshJob.id.desc()).first()
+        else:
+            job = query.get(job_id)
+        if not job:
+            return None
+
+        running = job.state == 'running'
+        now = datetime.datetime.now()
+        # While reading, the rate covers only the reading, so the time spent listing doesn't skew the estimate.
+        since = job.phase_started_at if running and job.phase == 'reading' else job.started_at
+        until = job.updated_at if running else job.finished_at
+        files_per_second = None
+        if since and until and until > since:
+            files_per_second = job.files_done / (until - since).total_seconds()
+        eta_seconds = None
+        if running and job.phase == 'reading' and files_per_second and job.files_total is not None:
+            eta_seconds = max(job.files_total - job.files_done, 0) / files_per_second
+
+        def timestamp(value):
+            return value.isoformat() if value else None
+
+        return {
+            'id': job.id,
+            'state': job.state,
+            'phase': job.phase,
+            'owner': job.owner,
+            'started_at': timestamp(job.started_at),
+            'updated_at': timestamp(job.updated_at),
+            'finished_at': timestamp(job.finished_at),
+            'files_total': job.files_total,
+            'files_done': job.files_done,
+            'files_per_second': round(files_per_second, 2) if files_per_second is not None else None,
+            'eta_seconds': round(eta_seconds) if eta_seconds is not None else None,
+            'added': job.added,
+            'relinked': job.relinked,
+            'missing': job.missing,
+            'cancel_requested': bool(job.cancel_requested),
+            # A running job that hasn't reported progress in a while may have died with its process.
+            'stalled': running and (now - job.updated_at).total_seconds() > REFRESH_STALE_AFTER,
+            'error': job.error,
+        }
+
+
+def cancel_refresh_job(job_id=None):
+    """Ask a running refresh job to stop.
+
+    The job stops the next time it writes its progress, whichever process is running it, and
+    leaves the tracks it hasn't reconciled yet as they were.
+
+    Arguments:
+        job_id (int): Id of the job, or None for whichever job is running.
+
+    Returns:
+        result (bool): Whether a running job was asked to stop.
+    """
+    with access_db() as db_conn:
+        query = db_conn.query(RefreshJob).filter(RefreshJob.state=='running')
+        if job_id is not None:
+            query = query.filter(RefreshJob.id==job_id)
+        cancelled = query.update({RefreshJob.cancel_requested: True}, synchronize_session=False)
+        db_conn.commit()
+        return bool(cancelled)
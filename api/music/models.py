@@ -9,7 +9,7 @@ from util.models import Base, GUID
 # PIP library imports
 import sqlalchemy
 from sqlalchemy import Table
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Boolean, DateTime, LargeBinary
 from sqlalchemy.orm import relationship
 
 # Variables and config
@@ -59,7 +59,16 @@ class Song(Base):
         artist_name (str): Artist of a given track
         album_name (str): Album of a given track
         track_path (str): Location of a track's file
+        track_hash (str): Legacy SHA-1 of a track's whole file, kept so tracks stored before they were fingerprinted can be relinked
+        audio_fingerprint (str): Hash of the audio in a track's file, without its tags, prefixed with the algorithm used
         track_length (str): Length of a given track
+        codec (str): Audio codec of a track's file, e.g. mp3, flac, opus, vorbis, aac, alac or pcm
+        bitrate (int): Average bitrate of a track's file, in bit/s
+        sample_rate (int): Sample rate of a track's file, in Hz
+        lossless_path (str): Location of a FLAC copy of a track, stored next to its MP3 file
+        seek_index (bytes): Packed byte offsets of each second of the track, for MP3 tracks
+        file_size (int): Size of a track's file, in bytes, when it was last read
+        file_mtime (int): Modification time of a track's file, in nanoseconds, when it was last read
         playlists (relationship): Many-to-many relationship with individual playlists.
     """
 
@@ -71,10 +80,18 @@ class Song(Base):
     artist_name = Column(String, default='')
     album_name = Column(String, default='')
 
-    track_path = Column(String)
+    track_path = Column(String, index=True, unique=True)
     track_hash = Column(String)
+    audio_fingerprint = Column(String, index=True)
 
     track_length = Column(String)
+    codec = Column(String)
+    bitrate = Column(Integer)
+    sample_rate = Column(Integer)
+    lossless_path = Column(String)
+    seek_index = Column(LargeBinary)
+    file_size = Column(BigInteger)
+    file_mtime = Column(BigInteger)
 
     file_missing = Column(Boolean, default=False)
 
@@ -90,12 +107,64 @@ class RefreshState(Base):
     Attributes:
         __tablename__ (str): Name of database table
         id (int): Primary database key for lookup
+        last_refresh (datetime): When the last refresh started.
         is_refreshing (bool): This is used for preventing multiple refreshes from occuring simultaneously,
-            sort of like a mutex lock.
+            sort of like a mutex lock. It is shared by every process using the database.
+        job_id (int): The RefreshJob holding the lock.
+        heartbeat (datetime): When the job holding the lock last renewed it. A lock whose job
+            stops renewing it, e.g. because its process died, can be taken over.
     """
 
     __tablename__ = 'refreshstate'
 
     id = Column(Integer, primary_key=True)
 
-    last_refresh = Column(DateTime)
\ No newline at end of file
+    last_refresh = Column(DateTime)
+    is_refreshing = Column(Boolean, default=False)
+    job_id = Column(Integer)
+    heartbeat = Column(DateTime)
+
+class RefreshJob(Base):
+    """RefreshJob ORM, recording the progress of a refresh of the track database.
+
+    Attributes:
+        __tablename__ (str): Name of database table
+        id (int): Primary database key for lookup
+        state (str): One of running, finished, cancelled or failed
+        phase (str): What a running job is doing: listing the music folder, reading the files in
+            it, or reconciling them with the database
+        owner (str): Host and process id of the process running the job
+        started_at (datetime): When the job started
+        phase_started_at (datetime): When the job started its current phase
+        updated_at (datetime): When the job last reported progress
+        finished_at (datetime): When the job stopped
+        files_total (int): Number of files found while listing the music folder
+        files_done (int): Number of files read so far
+        added (int): Number of tracks added
+        relinked (int): Number of missing tracks matched to files found elsewhere
+        missing (int): Number of tracks whose files weren't found
+        cancel_requested (bool): Whether the job was asked to stop
+        error (str): Why the job failed
+    """
+
+    __tablename__ = 'refreshjob'
+
+    id = Column(Integer, primary_key=True)
+
+    state = Column(String)
+    phase = Column(String)
+    owner = Column(String)
+
+    started_at = Column(DateTime)
+    phase_started_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    files_total = Column(Integer)
+    files_done = Column(Integer, default=0)
+    added = Column(Integer)
+    relinked = Column(Integer)
+    missing = Column(Integer)
+
+    cancel_requested = Column(Boolean, default=False)
+    error = Column(String)
\ No newline at end of file
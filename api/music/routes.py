@@ -4,14 +4,23 @@
 """Route handlers related to music database objects."""
 
 # Native python imports
-import logging, os, io, re, json, gzip
+import logging, os, io, re, gzip, time
 from wsgiref.util import FileWrapper
 
 # Local code imports
-import users.util, music.util
+import users.util, music.jobs, music.util
+from music.cache import open_track, track_prefetcher
+from music.throttle import active_streams
+from music.seek import SeekOutOfRange
+from music.transcode import transcoder, rendition_cache, rendition_key, hls_key, TranscodingUnavailable
+from music.transcode import RENDITION_FORMATS, RENDITION_BITRATES, DEFAULT_RENDITION_BITRATE
 from util.decorators import requires_params, requires_login, requires_admin
-from util.util import BaseHandler, mount_as_needed, RangeFileWrapper
-from settings import MISSING_ARTWORK_FILE, local_db_path
+from util.util import BaseHandler, RangeFileWrapper, database_modified_time
+from util.util import open_media_file, MediaUnavailable
+from util.util import encode_json, envelope_body, EncodedResponse, CachePolicy, PRIVATE_REVALIDATE, NO_STORE
+from settings import MISSING_ARTWORK_FILE, SONGS_CACHE_TTL, MOUNT_REPAIR_WAIT, PREFETCH_TRACKS
+from settings import AUDIO_CACHE_MAX_AGE, ARTWORK_CACHE_MAX_AGE, TRACK_LIST_CACHE_MAX_AGE
+from settings import HLS_BITRATES
 
 # PIP library imports
 from pycnic.core import Handler
@@ -21,10 +30,14 @@ from PIL import Image
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+HLS_PLAYLIST_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+
 
 class Songs(BaseHandler):
     """Route handler for fetching track information."""
 
+    cache_policy = CachePolicy(public=True, max_age=TRACK_LIST_CACHE_MAX_AGE)
+
     def get(self, songid=None):
         """GET /songs/[songid].
 
@@ -46,6 +59,9 @@ class Songs(BaseHandler):
                     return self.HTTP_200(data=data)
                 return self.HTTP_404()
 
+        # The track list may be served compressed, so shared caches need to keep both versions apart.
+        self.response.set_header("Vary", "Origin, Accept-Encoding")
+
         music_dir = os.path.dirname(os.path.abspath(__file__))
         cache_dir = os.path.join(music_dir, "cache_files")
         songs_cache = os.path.join(cache_dir, "songs.cache")
@@ -60,21 +76,16 @@ class Songs(BaseHandler):
                 and "gzip" in self.request.headers["Accept-Encoding"].lower()
                 and os.path.exists(gzip_songs_cache)
             ):
-                songs_cache_age = os.path.getmtime(gzip_songs_cache)
-                db_file_age = os.path.getmtime(local_db_path)
-                if songs_cache_age > db_file_age:
+                if self.cache_is_fresh(gzip_songs_cache):
                     self.response.status_code = 200
                     self.response.set_header("Content-Encoding", "gzip")
                     wrapper = FileWrapper(open(gzip_songs_cache, "rb"))
                     return wrapper
             # If those requirements aren't met, return uncompressed cache when possible
             elif os.path.exists(songs_cache):
-                songs_cache_age = os.path.getmtime(songs_cache)
-                db_file_age = os.path.getmtime(local_db_path)
-                if songs_cache_age > db_file_age:
-                    with open(songs_cache, "r") as f:
-                        data = json.loads(f.read())
-                        return self.HTTP_200(data=data)
+                if self.cache_is_fresh(songs_cache):
+                    with open(songs_cache, "rb") as f:
+                        return self.HTTP_200(encoded_data=f.read())
 
         else:
             # If the cache directory does not exist, make it.
@@ -83,14 +94,14 @@ class Songs(BaseHandler):
         # By this point, the cache lookup has failed, so we get all tracks from
         # the database, save the result to file, then return the result.
         tracks = music.util.get_all_tracks()
-        data = {"tracks": tracks}
+        encoded_data = encode_json({"tracks": tracks})
 
         # Write uncompressed cache
-        with open(songs_cache, "w") as f:
-            f.write(json.dumps(data))
+        with open(songs_cache, "wb") as f:
+            f.write(encoded_data)
         # Write compressed cache
         with gzip.open(gzip_songs_cache, "wb") as f:
-            f.write(json.dumps(self.HTTP_200(data=data)).encode())
+            f.write(envelope_body(200, encoded_data=encoded_data))
 
         if (
             "Accept-Encoding" in self.request.headers
@@ -101,11 +112,30 @@ class Songs(BaseHandler):
             wrapper = FileWrapper(open(gzip_songs_cache, "rb"))
             return wrapper
         else:
-            return self.HTTP_200(data=data)
+            return self.HTTP_200(encoded_data=encoded_data)
+
+    def cache_is_fresh(self, cache_file):
+        """Check whether a cached track list is newer than the database.
+
+        Arguments:
+            cache_file (str): Path of the cache file to check.
+        """
+        songs_cache_age = os.path.getmtime(cache_file)
+        db_file_age = database_modified_time()
+        if db_file_age is None:
+            # There's no local database file to compare against, so fall back to a time limit.
+            return time.time() - songs_cache_age < SONGS_CACHE_TTL
+        return songs_cache_age > db_file_age
 
 
 class Audio(BaseHandler):
-    """Route handler for fetching track audio files."""
+    """Route handler for fetching track audio files.
+
+    Audio is addressed by track id, and a track's file may change when the music folder is
+    refreshed, so cached copies are revalidated with their ETag once AUDIO_CACHE_MAX_AGE passes.
+    """
+
+    cache_policy = CachePolicy(public=True, max_age=AUDIO_CACHE_MAX_AGE)
 
     def get(self, songid):
         """GET /songs/<songid>/audio.
@@ -114,11 +144,16 @@ class Audio(BaseHandler):
             songid (str): Integer string identifying the track that should be served.
         """
         try:
-            track_file = music.util.fetch_track_path(int(songid))
-            track_hash = music.util.fetch_track_hash(int(songid))
+            track_file_info = music.util.fetch_track_file_info(int(songid))
         except:
+            track_file_info = None
+        if not track_file_info:
             logger.warn(f"Could not fetch track audio for song id: {songid}.")
             return self.HTTP_404(error="Invalid song id.")
+        track_file = track_file_info["track_path"]
+        content_key = track_file_info["content_key"]
+        codec = track_file_info["codec"]
+        content_type = music.util.audio_content_type(track_file)
 
         # Log which users listen to which songs.
         try:
@@ -129,9 +164,8 @@ class Audio(BaseHandler):
             if music.util.check_file_missing(int(songid)):
                 logger.warn(f"File for songid {songid} missing.")
                 return self.HTTP_400(error="Could not load track.")
-            user = None
-            if users.util.is_logged_in(self.request):
-                user = users.util.get_user_from_request(self.request)
+            user = users.util.get_session_user(self.request)
+            if user:
                 user = user.username
             else:
                 user = "Anonymous user"
@@ -140,51 +174,125 @@ class Audio(BaseHandler):
                     f'{user} is listening to {track_info["title"]} by {track_info["artist"]}'
                 )
 
-        download_filename = track_info["title"] + ".mp3"
-
-        # Remove .mp3 and replace with .flac, then check if file exists
-        if "flac" in self.request.args:
-            flac_track_file = f"{track_file[:-4]}.flac"
-            print(f"Flac file: {flac_track_file}")
-            if os.path.exists(flac_track_file):
-                track_file = flac_track_file
-                download_filename = download_filename[:-4] + ".flac"
+        download_filename = track_info["title"] + os.path.splitext(track_file)[1]
+
+        # Serve the lossless copy of the track instead, if one was found when it was scanned.
+        lossless = "flac" in self.request.args and track_file_info["lossless_path"]
+        if lossless:
+            track_file = track_file_info["lossless_path"]
+            codec = "flac"
+            content_type = music.util.audio_content_type(track_file)
+            download_filename = track_info["title"] + ".flac"
+
+        # Tracks can be transcoded to a different format and bitrate, e.g. for mobile data.
+        rendition = None
+        if "format" in self.request.args:
+            audio_format = self.request.args["format"]
+            if audio_format not in RENDITION_FORMATS:
+                return self.HTTP_400(error="Unsupported audio format.")
+            try:
+                bitrate = int(self.request.args.get("bitrate", DEFAULT_RENDITION_BITRATE))
+            except ValueError:
+                return self.HTTP_400(error="Invalid bitrate.")
+            if bitrate not in RENDITION_BITRATES:
+                return self.HTTP_400(error="Unsupported bitrate.")
+            # A track that is already in the requested format, at no more than the requested
+            #  bitrate, is served as it is.
+            bitrate_fits = track_file_info["bitrate"] and track_file_info["bitrate"] <= bitrate * 1000
+            if codec != audio_format or not bitrate_fits:
+                rendition = rendition_key(content_key, audio_format, bitrate)
+                download_filename = f'{track_info["title"]}.{audio_format}'
+
+        # A time to start playing from can be given instead of a byte range, which is looked up
+        #  in the seek index of the original file. Only MP3 tracks have one.
+        seek_byte = None
+        if (
+            "t" in self.request.args
+            and not rendition
+            and not lossless
+            and "Range" not in self.request.headers
+        ):
+            try:
+                seconds = int(float(self.request.args["t"]))
+            except (ValueError, OverflowError):
+                return self.HTTP_400(error="Invalid time.")
+            if seconds < 0:
+                return self.HTTP_400(error="Invalid time.")
+            try:
+                seek_byte = music.util.fetch_seek_offset(int(songid), seconds)
+            except SeekOutOfRange:
+                return self.HTTP_416(error="Requested time out of bounds.")
+
+        # The client's cached copy is still current.
+        etag = rendition or content_key
+        if etag and self.etag_matches(etag):
+            return self.HTTP_304(etag)
+
+        # Once a rendition has been transcoded, it is served like any other file.
+        track = None
+        if rendition:
+            track = rendition_cache.open(rendition)
+        transcode = rendition and not track
+
+        if not track:
+            # Tracks that have been played recently may be cached locally. Otherwise, the media
+            #  server may have gone to sleep, or be unmounted, in which case it is woken and
+            #  remounted in the background while this request waits.
+            try:
+                track = open_track(track_file, content_key)
+            except MediaUnavailable:
+                logger.warn(f"Media server unavailable while loading track {songid}.")
+                return self.HTTP_503(error="Media server unavailable.", retry_after=MOUNT_REPAIR_WAIT)
+            except OSError as e:
+                logger.warn(f"Exception while loading track {songid}.")
+                return self.HTTP_400(error="Could not load track.")
 
-        # Only mount if we actually need to load the file.
-        # This is specifically for my setup where the media server may go to sleep
-        #  and is separate from the main server, so it may need to be mounted before
-        #  tracks can be opened.
-        mount_as_needed()
+        if transcode:
+            try:
+                stream = transcoder.transcode(track, rendition, audio_format, bitrate)
+            except TranscodingUnavailable as e:
+                logger.warn(f"Could not transcode track {songid}: {e}")
+                return self.HTTP_503(error="Transcoding unavailable.", retry_after=5)
+            # The length isn't known until transcoding is done, so ranges can't be served yet.
+            self.set_audio_headers(download_filename, rendition, RENDITION_FORMATS[audio_format][2])
+            self.response.set_header("Accept-Ranges", "none")
+            self.prefetch_next(int(songid))
+            return stream
 
         # Used for parsing range requests
         range_re = re.compile(r"bytes\s*=\s*(\d+)\s*-\s*(\d*)", re.I)
 
         # Regardless of range, we need to know file size
-        file_size = os.path.getsize(track_file)
+        file_size = os.fstat(track.fileno()).st_size
 
         # These will be different depending on the range requested
         content_length = None
         wrapper = None
+        start_of_track = True
 
-        if "Range" in self.request.headers and range_re.match(
-            self.request.headers["Range"]
-        ):
+        range_match = None
+        if "Range" in self.request.headers:
+            range_match = range_re.match(self.request.headers["Range"])
+
+        if range_match or seek_byte is not None:
             # If a range is requested, we use the RangeFileWrapper to only serve the range requested
             # TODO: add if-range (hash of file, should be part of audio track model)
             # https://developer.mozilla.org/en-US/docs/Web/HTTP/Range_requests#Partial_request_responses
-            range_match = range_re.match(self.request.headers["Range"])
-            first_byte, last_byte = range_match.groups()
+            if range_match:
+                first_byte, last_byte = range_match.groups()
+            else:
+                first_byte, last_byte = str(seek_byte), ""
             if int(first_byte) > file_size:
                 # Out of bounds request, return an error
+                track.close()
                 return self.HTTP_416(error="Requested range out of bounds.")
             first_byte = int(first_byte) if first_byte else 0
+            start_of_track = first_byte == 0
             last_byte = int(last_byte) if last_byte else file_size - 1
             if last_byte >= file_size:
                 last_byte = file_size - 1
             length = last_byte - first_byte + 1
-            wrapper = RangeFileWrapper(
-                open(track_file, "rb"), offset=first_byte, length=length
-            )
+            wrapper = RangeFileWrapper(track, offset=first_byte, length=length, on_close=active_streams.closed)
             content_length = str(length)
             if "dl" in self.request.args and self.request.args["dl"] == "1":
                 self.response.set_header(
@@ -193,44 +301,185 @@ class Audio(BaseHandler):
             self.response.set_header(
                 "Content-Range", f"bytes {first_byte}-{last_byte}/{file_size}"
             )
-            self.response.set_header("If-Range", f'"{track_hash}"')
             self.response.status_code = 206
 
         else:
             # If no range is requested, we serve the whole file
             content_length = str(file_size)
-            try:
-                wrapper = FileWrapper(open(track_file, "rb"))
-            except OSError as e:
-                logger.warn(f"Exception while loading track {songid}.")
-                return self.HTTP_400(error="Could not load track.")
+            wrapper = RangeFileWrapper(track, on_close=active_streams.closed)
+
+        if rendition:
+            self.set_audio_headers(download_filename, rendition, RENDITION_FORMATS[audio_format][2])
+        else:
+            self.set_audio_headers(download_filename, content_key, content_type)
+        self.response.set_header("Content-Length", content_length)
+        self.response.set_header("Accept-Ranges", "bytes")
 
+        # Seeking within a track also makes range requests, so only warm the upcoming tracks
+        #  when playback starts.
+        if start_of_track:
+            self.prefetch_next(int(songid))
+        # Refreshes back off while audio is being streamed, until the wrapper is closed.
+        active_streams.opened()
+        return wrapper
+
+    def set_audio_headers(self, download_filename, etag, content_type):
+        """Set the headers describing the audio being served.
+
+        Arguments:
+            download_filename (str): Name the audio is saved as, when it is downloaded.
+            etag (str): Identifies the audio itself, so a cached copy is only reused while it is unchanged.
+            content_type (str): Content-type of the audio.
+        """
         if "dl" in self.request.args and self.request.args["dl"] == "1":
             self.response.set_header(
                 "Content-Disposition", f'attachment; filename="{download_filename}"'
             )
-        if download_filename.endswith("mp3"):
-            self.response.set_header("Content-Type", "audio/mpeg")
-        elif download_filename.endswith("flac"):
-            self.response.set_header("Content-Type", "audio/flac")
+        self.response.set_header("Content-Type", content_type)
+        self.response.set_header("ETag", f'"{etag}"')
 
-        self.response.set_header("Content-Length", content_length)
-        self.response.set_header("Accept-Ranges", "bytes")
+    def prefetch_next(self, songid):
+        """Warm the tracks that are likely to be played after this one.
+
+        Upcoming tracks are either listed in the `next` parameter as comma-separated ids, or
+        follow this track in the playlist given by the `playlist` parameter.
+
+        Arguments:
+            songid (int): Integer identifying the track currently playing.
+        """
+        if PREFETCH_TRACKS <= 0:
+            return
+        try:
+            if "next" in self.request.args:
+                songids = [int(i) for i in self.request.args["next"].split(",") if i]
+                tracks = music.util.fetch_track_files(songids[:PREFETCH_TRACKS])
+            elif "playlist" in self.request.args:
+                tracks = music.util.fetch_next_playlist_tracks(
+                    int(self.request.args["playlist"]), songid, PREFETCH_TRACKS
+                )
+            else:
+                return
+        except ValueError:
+            return
+        track_prefetcher.warm(tracks, flac="flac" in self.request.args)
+
+
+class HlsMaster(BaseHandler):
+    """Route handler for fetching the HLS master playlist of a track."""
+
+    # Like the track list, this only changes when the server's settings do.
+    cache_policy = CachePolicy(public=True, max_age=TRACK_LIST_CACHE_MAX_AGE)
+
+    def get(self, songid):
+        """GET /songs/<songid>/hls/master.m3u8.
+
+        Arguments:
+            songid (str): Integer string identifying the track that should be streamed.
+        """
+        if not music.util.fetch_track_info(int(songid)):
+            return self.HTTP_404(error="Invalid song id.")
+
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+        for bitrate in sorted(HLS_BITRATES):
+            # Leave some room for the overhead of the MPEG-TS container.
+            bandwidth = int(bitrate * 1000 * 1.1)
+            lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},CODECS="mp4a.40.2"')
+            lines.append(f"{bitrate}/index.m3u8")
+        body = ("\n".join(lines) + "\n").encode()
+
+        self.response.set_header("Content-Type", HLS_PLAYLIST_CONTENT_TYPE)
+        self.response.set_header("Content-Length", str(len(body)))
+        return EncodedResponse(body)
+
+
+class HlsVariant(BaseHandler):
+    """Route handler for fetching the playlist and segments of a track's HLS variant.
+
+    The track is cut into segments in the background the first time any of them is requested,
+    and the segments are cached once they have all been written. Until then, the playlist only
+    lists the segments written so far, and players fetch it again to find the others. Like audio, they are revalidated with their ETag once
+    AUDIO_CACHE_MAX_AGE passes, as the track's file may have changed.
+    """
+
+    cache_policy = CachePolicy(public=True, max_age=AUDIO_CACHE_MAX_AGE)
+
+    def get(self, songid, bitrate, filename="index.m3u8"):
+        """GET /songs/<songid>/hls/<bitrate>/(index.m3u8|<segment>.ts).
+
+        Arguments:
+            songid (str): Integer string identifying the track that should be streamed.
+            bitrate (str): Integer string identifying the bitrate of the variant, in kbit/s.
+            filename (str): Name of the playlist or segment to serve.
+        """
+        bitrate = int(bitrate)
+        if bitrate not in HLS_BITRATES:
+            return self.HTTP_404(error="Unsupported bitrate.")
+        track_file = music.util.fetch_track_path(int(songid))
+        content_key = music.util.fetch_track_content_key(int(songid))
+        if not track_file or not content_key:
+            return self.HTTP_404(error="Invalid song id.")
+        etag = hls_key(content_key, bitrate)
+        if self.etag_matches(etag):
+            return self.HTTP_304(etag)
+
+        try:
+            variant, complete = transcoder.segment(
+                lambda: open_track(track_file, content_key), etag, bitrate
+            )
+        except MediaUnavailable:
+            logger.warn(f"Media server unavailable while segmenting track {songid}.")
+            return self.HTTP_503(error="Media server unavailable.", retry_after=MOUNT_REPAIR_WAIT)
+        except TranscodingUnavailable as e:
+            logger.warn(f"Could not segment track {songid}: {e}")
+            return self.HTTP_503(error="Transcoding unavailable.", retry_after=5)
+        except OSError:
+            logger.warn(f"Exception while loading track {songid}.")
+            return self.HTTP_400(error="Could not load track.")
+
+        if not complete and not os.path.exists(os.path.join(variant, filename)):
+            # The segments may have been moved into the cache since.
+            cached = rendition_cache.lookup(etag)
+            if cached:
+                variant, complete = cached, True
+        try:
+            wrapper = FileWrapper(open(os.path.join(variant, filename), "rb"))
+        except OSError:
+            if not complete:
+                # The playlist, or the segment, hasn't been written yet.
+                return self.HTTP_503(error="Segment not ready.", retry_after=1)
+            return self.HTTP_404(error="Invalid segment.")
+
+        if filename.endswith(".m3u8"):
+            self.response.set_header("Content-Type", HLS_PLAYLIST_CONTENT_TYPE)
+        else:
+            self.response.set_header("Content-Type", "video/mp2t")
+        if complete or not filename.endswith(".m3u8"):
+            self.response.set_header("ETag", f'"{etag}"')
+        else:
+            # The playlist grows as segments are written, so players have to fetch it again.
+            self.response.set_header("Cache-Control", NO_STORE.header)
+        self.response.set_header(
+            "Content-Length", str(os.fstat(wrapper.filelike.fileno()).st_size)
+        )
         return wrapper
 
 
 class Artwork(BaseHandler):
     """Route handler for fetching track artwork files."""
 
+    cache_policy = CachePolicy(public=True, max_age=ARTWORK_CACHE_MAX_AGE)
+
     def get(self, songid):
         """GET /songs/<songid>/artwork.
 
         Arguments:
             songid (str): Integer string identifying the track that should have its artwork served.
         """
-        mount_as_needed()
         try:
             artwork_file = music.util.fetch_artwork_path(int(songid))
+        except MediaUnavailable:
+            logger.warn(f"Media server unavailable while loading artwork for track {songid}.")
+            return self.HTTP_503(error="Media server unavailable.", retry_after=MOUNT_REPAIR_WAIT)
         except:
             logger.warn(f"Could not fetch track artwork for song id: {songid}.")
             return self.HTTP_404(error="Invalid song id.")
@@ -240,11 +489,11 @@ class Artwork(BaseHandler):
         except:
             return self.HTTP_400(error="Error determining album artwork content type.")
 
-        # File size is constant.
-        file_size = os.path.getsize(artwork_file)
-
         try:
             wrapper = self.get_wrapper(artwork_file)
+        except MediaUnavailable:
+            logger.warn(f"Media server unavailable while loading artwork for track {songid}.")
+            return self.HTTP_503(error="Media server unavailable.", retry_after=MOUNT_REPAIR_WAIT)
         except Exception as e:
             logger.warn(
                 f"Could not access artwork file for track with id {songid}, or missing album artwork."
@@ -252,6 +501,7 @@ class Artwork(BaseHandler):
             logger.critical(e)
             return self.HTTP_400(error="Error loading album artwork.")
         else:
+            file_size = os.fstat(wrapper.filelike.fileno()).st_size
             self.response.set_header("Content-Length", str(file_size))
             self.response.set_header("Content-Type", content_type)
             return wrapper
@@ -271,14 +521,16 @@ class Artwork(BaseHandler):
         """Create wrapper for file, then return the wrapper, content-type, and file size."""
         wrapper = None
         try:
-            wrapper = FileWrapper(open(filename, "rb"))
+            wrapper = FileWrapper(open_media_file(filename))
+        except MediaUnavailable:
+            raise
         except OSError as e:
             logger.warn(f"Could not access artwork file: {filename}.")
             logger.info(f"Attempting to load {MISSING_ARTWORK_FILE} instead.")
             if error:
                 raise e
             else:
-                return get_wrapper(MISSING_ARTWORK_FILE, error=True)
+                return self.get_wrapper(MISSING_ARTWORK_FILE, error=True)
         else:
             return wrapper
 
@@ -290,24 +542,50 @@ class BuildDatabase(BaseHandler):
     def get(self):
         """GET /refresh."""
         # Asynchronous thread that refreshes the database, so the user doesn't have to wait.
-        music.util.refresh_database()
+        job_id = music.util.refresh_database()
         # Return success immediately
+        return self.HTTP_200(data={'job_id': job_id})
+
+
+class RefreshStatus(BaseHandler):
+    """Route handler for fetching the progress of a refresh of the track database."""
+
+    @requires_admin()
+    def get(self, job_id=None):
+        """GET /refresh/status[/job_id].
+
+        Arguments:
+            job_id (str): Integer string identifying a refresh job, or None for the latest one.
+        """
+        status = music.jobs.fetch_refresh_status(int(job_id) if job_id else None)
+        if not status:
+            return self.HTTP_404(error='No such refresh.')
+        return self.HTTP_200(data=status)
+
+
+class CancelRefresh(BaseHandler):
+    """Route handler for stopping a running refresh of the track database."""
+
+    @requires_admin()
+    def post(self):
+        """POST /refresh/cancel."""
+        if not music.jobs.cancel_refresh_job():
+            return self.HTTP_404(error='No refresh is running.')
         return self.HTTP_200()
 
 
 class Playlists(BaseHandler):
     """Route handler for fetching playlist information."""
 
+    cache_policy = PRIVATE_REVALIDATE
+
     def get(self, playlistid=None):
         """GET /playlists/[playlistid].
 
         Arguments:
             playlistid (str): Integer string identifying a unique playlist.
         """
-        if users.util.is_logged_in(self.request):
-            user = users.util.get_user_from_request(self.request)
-        else:
-            user = None
+        user = users.util.get_session_user(self.request)
 
         if not playlistid:
             return self.fetch_available_playlists(user)
@@ -321,7 +599,7 @@ class Playlists(BaseHandler):
         This includes public playlists, and playlists created by the user.
 
         Arguments:
-            user (User): The user we are fetching playlists for, or None.
+            user (SessionUser): The user we are fetching playlists for, or None.
         """
         if user:
             accessible_playlists = music.util.get_playlists_for_user(user.guid)
@@ -333,7 +611,7 @@ class Playlists(BaseHandler):
         """Fetch a playlist identified by a unique playlistid.
 
         Arguments:
-            user (User): The user we are fetching the playlist for, or None.
+            user (SessionUser): The user we are fetching the playlist for, or None.
             playlistid (str): Integer string identifying the requests playlist.
         """
         playlist_data = music.util.get_playlist_data_from_id(playlistid)
@@ -355,9 +633,8 @@ class OwnedPlaylists(BaseHandler):
     @requires_login()
     def get(self):
         """GET /playlists/owned."""
-        if users.util.is_logged_in(self.request):
-            user = users.util.get_user_from_request(self.request)
-        else:
+        user = users.util.get_session_user(self.request)
+        if not user:
             return self.HTTP_200(data={"playlists": []})
         owned_playlists = music.util.get_playlists_owned_by_user(user.guid)
         return self.HTTP_200(data=owned_playlists)
@@ -374,7 +651,7 @@ class CreatePlaylist(BaseHandler):
         Parameters:
             playlist_name (str): The name to be given to the playlist.
         """
-        user = users.util.get_user_from_request(self.request)
+        user = users.util.get_session_user(self.request)
         playlist_name = self.request.data["playlist_name"]
 
         music.util.create_new_playlist(playlist_name, user.guid, user.username)
@@ -397,7 +674,7 @@ class AddToPlaylist(BaseHandler):
         Parameters:
             songid (str): Integer string identifying the song to be added to the playlist.
         """
-        user = users.util.get_user_from_request(self.request)
+        user = users.util.get_session_user(self.request)
         if not music.util.owns_playlist(playlistid, user.guid):
             return self.HTTP_403(error="You don't own this playlist.")
 
@@ -420,7 +697,7 @@ class RemoveFromPlaylist(BaseHandler):
         Parameters:
             songid (str): Integer string identifying the song to be removed from the playlist.
         """
-        user = users.util.get_user_from_request(self.request)
+        user = users.util.get_session_user(self.request)
         if not music.util.owns_playlist(playlistid, user.guid):
             return self.HTTP_403(error="You don't own this playlist.")
 
@@ -443,7 +720,7 @@ class SetPlaylistPublicity(BaseHandler):
         Parameters:
             is_public (str): Boolean string indicating whether the playlist should be made public.
         """
-        user = users.util.get_user_from_request(self.request)
+        user = users.util.get_session_user(self.request)
         if not music.util.owns_playlist(playlistid, user.guid):
             return self.HTTP_403(error="You don't own this playlist.")
 
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: music/scan.py
+"""Reading of track files while the music folder is scanned."""
+
+# Native python imports
+import io, os
+
+# Local file imports
+from music.throttle import scan_read_budget
+
+# Number of bytes read from storage at a time.
+SCAN_BLOCK_SIZE = 65536
+
+
+class ScanFile:
+    """A track file being scanned, which reads each block of the file from storage at most once.
+
+    Tags are parsed first, through the usual file interface, and the blocks read for them are
+    kept. The whole file is then read in order with blocks(), e.g. to hash it, which reuses those
+    blocks instead of fetching them again. This matters when the music is on a network share,
+    where every read is a round trip.
+
+    Every read from storage is paced by a read budget, so scanning leaves enough of the disk or
+    network share for the audio being streamed from it.
+    """
+
+    def __init__(self, track_path, block_size=SCAN_BLOCK_SIZE, budget=scan_read_budget):
+        """Initialization function for the file.
+
+        Arguments:
+            track_path (str): Path of the track file, which is opened right away.
+            block_size (int): Number of bytes read from storage at a time.
+            budget (ReadBudget): Paces the reads from storage, or None to read as fast as possible.
+        """
+        self.name = track_path
+        self.block_size = block_size
+        self.budget = budget
+        # Unbuffered, as blocks are already read in large pieces, and only once.
+        self._file = open(track_path, 'rb', buffering=0)
+        stat = os.fstat(self._file.fileno())
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self._blocks = {}
+        self._position = 0
+
+    def __enter__(self):
+        """Use the file as a context manager, which closes it on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the file on leaving the context."""
+        self.close()
+
+    def close(self):
+        """Close the underlying file."""
+        self._file.close()
+        self._blocks.clear()
+
+    def _read_block(self, index):
+        """Read a block from storage."""
+        if self.budget:
+            self.budget.spend(self.block_size)
+        self._file.seek(index * self.block_size)
+        return self._file.read(self.block_size)
+
+    def _block(self, index):
+        """Fetch a block, reading it from storage the first time it is needed."""
+        block = self._blocks.get(index)
+        if block is None:
+            block = self._blocks[index] = self._read_block(index)
+        return block
+
+    def read(self, size=-1):
+        """Read up to size bytes from the current position, or the rest of the file."""
+        if size is None or size < 0:
+            size = self.size
+        end = min(self._position + size, self.size)
+        parts = []
+        while self._position < end:
+            index, offset = divmod(self._position, self.block_size)
+            part = self._block(index)[offset:offset + end - self._position]
+            if not part:
+                # The file is shorter than it was when it was opened.
+                break
+            parts.append(part)
+            self._position += len(part)
+        return b''.join(parts)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Move to a position in the file."""
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position.')
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        """Current position in the file."""
+        return self._position
+
+    def blocks(self):
+        """Yield the blocks of the whole file in order.
+
+        Blocks that were already read are used and then forgotten, and the rest are read from
+        storage without being kept.
+        """
+        for index in range((self.size + self.block_size - 1) // self.block_size):
+            block = self._blocks.pop(index, None)
+            if block is None:
+                block = self._read_block(index)
+            if not block:
+                return
+            yield block
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: music/seek.py
+"""Seek indexes, mapping each second of an MP3 track to the byte offset of its audio."""
+
+# Native python imports
+import struct
+from array import array
+
+# Each entry of a packed seek index is the byte offset of a second of audio.
+SEEK_INDEX_ENTRY = struct.Struct('<I')
+
+# Bitrates in kbit/s, by MPEG version and layer, indexed by the bitrate bits of a frame header.
+_MPEG1_BITRATES = {
+    1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+}
+_MPEG2_BITRATES = {
+    1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by the version bits of a frame header: MPEG 2.5, reserved, MPEG 2, MPEG 1.
+_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+
+
+class SeekOutOfRange(ValueError):
+    """Raised when a time is looked up that is past the end of a track."""
+
+    pass
+
+
+def parse_frame_header(header):
+    """Parse the header of an MPEG audio frame.
+
+    Arguments:
+        header (bytes): The first four bytes of the frame.
+
+    Returns:
+        frame_length (int): Length of the frame in bytes, including the header.
+        samples (int): Number of samples in the frame.
+        sample_rate (int): Sample rate of the frame.
+        Or None, if the bytes aren't a valid frame header.
+    """
+    if header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = 4 - ((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        # Reserved values, or free-format bitrates, which can't be followed without decoding.
+        return None
+
+    bitrates = _MPEG1_BITRATES if version == 3 else _MPEG2_BITRATES
+    bitrate = bitrates[layer][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    samples = 576 if layer == 3 and version != 3 else 1152
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+
+class SeekIndexBuilder:
+    """Builds the seek index of an MP3 track, from the track's bytes as they are read.
+
+    Each entry is the byte offset of the first frame that starts at or after that many seconds
+    into the track. The track is fed in chunks of any size, so the index can be built while
+    the file is being read for something else, e.g. hashing.
+    """
+
+    def __init__(self):
+        """Initialization function for the builder."""
+        self.offsets = array('I')
+        self._buffer = b''
+        # File offset of the start of the buffer.
+        self._position = 0
+        # Number of bytes still to be skipped, e.g. the rest of an ID3 tag.
+        self._skip = 0
+        self._started = False
+        self._elapsed = 0.0
+
+    def feed(self, chunk):
+        """Process the next chunk of the track.
+
+        Arguments:
+            chunk (bytes): The bytes following those fed in so far.
+        """
+        buffer = self._buffer + chunk
+        position = self._position
+        index = 0
+
+        if self._skip:
+            skipped = min(self._skip, len(buffer))
+            self._skip -= skipped
+            index = skipped
+
+        if not self._started:
+            if len(buffer) - index < 10:
+                self._buffer, self._position = buffer[index:], position + index
+                return
+            self._started = True
+            if buffer[index:index + 3] == b'ID3':
+                # Skip the ID3v2 tag, whose size is stored as a syncsafe integer.
+                size = 0
+                for byte in buffer[index + 6:index + 10]:
+                    size = size * 128 + (byte & 0x7F)
+                tag_size = 10 + size + (10 if buffer[index + 5] & 0x10 else 0)
+                skipped = min(tag_size, len(buffer) - index)
+                self._skip = tag_size - skipped
+                index += skipped
+
+        offsets = self.offsets
+        elapsed = self._elapsed
+        while len(buffer) - index >= 4:
+            frame = parse_frame_header(buffer[index:index + 4])
+            if not frame:
+                # Not the start of a frame, so look for the next one.
+                index += 1
+                continue
+            frame_length, samples, sample_rate = frame
+            while len(offsets) <= elapsed:
+                offsets.append(position + index)
+            elapsed += samples / sample_rate
+            if len(buffer) - index < frame_length:
+                self._skip = frame_length - (len(buffer) - index)
+                index = len(buffer)
+                break
+            index += frame_length
+
+        self._elapsed = elapsed
+        self._buffer = buffer[index:]
+        self._position = position + index
+
+    def pack(self):
+        """The finished seek index, packed for storage.
+
+        Returns:
+            result (bytes): The packed seek index, or None if no frames were found.
+        """
+        if not self.offsets:
+            return None
+        return struct.pack(f'<{len(self.offsets)}I', *self.offsets)
+
+
+def seek_offset(seek_index, seconds):
+    """Look up the byte offset of a time in a track.
+
+    Arguments:
+        seek_index (bytes): The packed seek index of the track.
+        seconds (int): Number of seconds into the track.
+
+    Returns:
+        result (int): Byte offset of the first frame at or after the given time.
+
+    Raises:
+        SeekOutOfRange: Raised if the time is before the start, or past the end, of the track.
+    """
+    if seconds < 0 or (seconds + 1) * SEEK_INDEX_ENTRY.size > len(seek_index):
+        raise SeekOutOfRange(seconds)
+    return SEEK_INDEX_ENTRY.unpack_from(seek_index, seconds * SEEK_INDEX_ENTRY.size)[0]
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: music/throttle.py
+"""Throttling of refreshes, so scanning the music folder doesn't stall the audio being streamed from it."""
+
+# Native python imports
+import logging, mmap, os, struct, subprocess, sys, threading, time
+
+# Local file imports
+from settings import SCAN_READ_BANDWIDTH, SCAN_READ_IOPS
+from settings import SCAN_BUSY_STREAMS, SCAN_BUSY_READ_BANDWIDTH, SCAN_BUSY_READ_IOPS
+from settings import ACTIVE_STREAMS_DIR, SCAN_NICE, SCAN_IONICE_CLASS
+from util.util import process_exists
+
+# Variables and settings
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Layout of the count in each process's file of active streams.
+STREAM_COUNT = struct.Struct('<q')
+
+# Arguments to the ionice command for each I/O scheduling class.
+IONICE_CLASSES = {
+    'idle': ('-c', '3'),
+    'best-effort': ('-c', '2', '-n', '7'),
+}
+
+
+class ActiveStreams:
+    """Counts the audio streams being served by every API process on this machine.
+
+    Each process keeps its own count in a file named after its pid, so a refresh running in
+    another process, e.g. another gunicorn worker or the library watcher, can add them up.
+    The file is mapped into memory when the process first serves a stream, so counting the
+    streams of range requests doesn't write to the file system. Files left behind by processes
+    that have died are removed when the counts are added up.
+    """
+
+    def __init__(self, folder, refresh_interval=1):
+        """Initialization function for the counter.
+
+        Arguments:
+            folder (str): Folder holding the count of each process.
+            refresh_interval (float): Seconds the total is reused for before the counts are read again.
+        """
+        self.folder = folder
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._total = 0
+        self._total_at = None
+        self._counter = None
+        self._counter_pid = None
+
+    def opened(self):
+        """Record that this process started serving an audio stream."""
+        self._change(1)
+
+    def closed(self):
+        """Record that this process finished serving an audio stream."""
+        self._change(-1)
+
+    def _change(self, streams):
+        """Change the count of this process in its mapped file, which other processes read it from.
+
+        Arguments:
+            streams (int): Number of streams opened, or closed if negative.
+        """
+        with self._lock:
+            try:
+                counter = self._map_counter()
+            except OSError as e:
+                logger.warn(f'Could not record the number of active streams: {e}')
+                return
+            count = STREAM_COUNT.unpack_from(counter)[0]
+            STREAM_COUNT.pack_into(counter, 0, max(count + streams, 0))
+
+    def _map_counter(self):
+        """Map the file holding the count of this process, creating it if this process has none yet.
+
+        Processes forked from this one, e.g. gunicorn workers, map a file of their own, and
+        start counting from zero.
+        """
+        pid = os.getpid()
+        if self._counter is None or self._counter_pid != pid:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, str(pid)), 'w+b') as count_file:
+                count_file.write(bytes(STREAM_COUNT.size))
+                count_file.flush()
+                # The mapping stays valid once the file is closed.
+                self._counter = mmap.mmap(count_file.fileno(), STREAM_COUNT.size)
+            self._counter_pid = pid
+        return self._counter
+
+    def total(self):
+        """Number of audio streams being served by every process, read at most once every refresh_interval seconds."""
+        now = time.monotonic()
+        if self._total_at is not None and now - self._total_at < self.refresh_interval:
+            return self._total
+        total = 0
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.isdigit():
+                continue
+            path = os.path.join(self.folder, name)
+            if not process_exists(int(name)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, 'rb') as count_file:
+                    total += STREAM_COUNT.unpack(count_file.read(STREAM_COUNT.size))[0]
+            except (OSError, struct.error):
+                continue
+        self._total = total
+        self._total_at = now
+        return total
+
+
+class ReadBudget:
+    """Paces reads to stay within a bandwidth and IOPS budget.
+
+    Each read is charged the time it takes up of either budget, whichever is more, and waits
+    until the reads before it have been paid for. While enough audio streams are being served,
+    the smaller busy budgets are used instead, so scans back off while people are listening.
+    """
+
+    def __init__(self, streams, bandwidth=SCAN_READ_BANDWIDTH, iops=SCAN_READ_IOPS,
+                 busy_streams=SCAN_BUSY_STREAMS, busy_bandwidth=SCAN_BUSY_READ_BANDWIDTH,
+                 busy_iops=SCAN_BUSY_READ_IOPS):
+        """Initialization function for the budget.
+
+        Arguments:
+            streams (ActiveStreams): Counts the audio streams being served.
+            bandwidth (int): Bytes that may be read per second, or None for no limit.
+            iops (int): Reads that may be made per second, or None for no limit.
+            busy_streams (int): Number of audio streams at which the busy budgets are used, or None to never use them.
+            busy_bandwidth (int): Bytes that may be read per second while busy, or None for no limit.
+            busy_iops (int): Reads that may be made per second while busy, or None for no limit.
+        """
+        self.streams = streams
+        self.bandwidth = bandwidth
+        self.iops = iops
+        self.busy_streams = busy_streams
+        self.busy_bandwidth = busy_bandwidth
+        self.busy_iops = busy_iops
+        self._lock = threading.Lock()
+        self._ready_at = 0
+        self._busy = False
+
+    def limits(self):
+        """The bandwidth and IOPS budgets that apply right now."""
+        busy = bool(self.busy_streams) and self.streams.total() >= self.busy_streams
+        if busy != self._busy:
+            self._busy = busy
+            logger.info('Audio is being streamed, slowing down scanning.' if busy else 'Scanning at full speed.')
+        if busy:
+            return self.busy_bandwidth, self.busy_iops
+        return self.bandwidth, self.iops
+
+    def spend(self, size):
+        """Wait until a read fits within the budget.
+
+        Arguments:
+            size (int): Number of bytes about to be read.
+        """
+        bandwidth, iops = self.limits()
+        cost = 0
+        if bandwidth:
+            cost = max(cost, size / bandwidth)
+        if iops:
+            cost = max(cost, 1 / iops)
+        if not cost:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._ready_at, now)
+            self._ready_at = start + cost
+        if start > now:
+            time.sleep(start - now)
+
+
+def lower_scan_priority():
+    """Lower the CPU and disk priority of the calling thread to SCAN_NICE and SCAN_IONICE_CLASS.
+
+    On Linux, both are set for the thread alone, so a refresh running in an API worker doesn't
+    slow down the requests served by the worker's other threads. The disk priority only affects
+    local disks. Reads from a mounted share are limited by the read budgets instead.
+    """
+    thread_id = threading.get_native_id()
+    if SCAN_NICE is not None and hasattr(os, 'setpriority'):
+        try:
+            current = os.getpriority(os.PRIO_PROCESS, thread_id)
+            if SCAN_NICE > current:
+                os.setpriority(os.PRIO_PROCESS, thread_id, SCAN_NICE)
+        except OSError as e:
+            logger.warn(f'Could not lower the CPU priority of scanning: {e}')
+    if SCAN_IONICE_CLASS and sys.platform.startswith('linux'):
+        try:
+            subprocess.run(['ionice', *IONICE_CLASSES[SCAN_IONICE_CLASS], '-p', str(thread_id)],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, KeyError, subprocess.CalledProcessError) as e:
+            logger.warn(f'Could not lower the disk priority of scanning: {e}')
+
+
+active_streams = ActiveStreams(ACTIVE_STREAMS_DIR)
+scan_read_budget = ReadBudget(active_streams)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: music/transcode.py
+"""Transcoding of tracks to other formats and bitrates, and into HLS segments, through ffmpeg."""
+
+# Native python imports
+import logging, os, subprocess, threading, weakref
+
+# Local file imports
+from music.cache import FileCache, delete_path
+from music.throttle import active_streams
+from settings import FFMPEG_PATH, TRANSCODE_WORKERS, RENDITION_CACHE_DIR, RENDITION_CACHE_MAX_BYTES
+from settings import HLS_SEGMENT_SECONDS
+from settings import ASGI_CHUNK_SIZE
+
+# Variables and settings
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Formats tracks can be transcoded to, mapped to their ffmpeg codec, ffmpeg container and content-type.
+RENDITION_FORMATS = {
+    'opus': ('libopus', 'ogg', 'audio/ogg'),
+    'aac': ('aac', 'adts', 'audio/aac'),
+    'mp3': ('libmp3lame', 'mp3', 'audio/mpeg'),
+}
+
+# Bitrates tracks can be transcoded to, in kbit/s. Only a few are allowed, so that the
+#  rendition cache isn't filled with near-identical copies of the same track.
+RENDITION_BITRATES = (32, 48, 64, 96, 128, 160, 192, 256, 320)
+DEFAULT_RENDITION_BITRATE = 128
+
+
+class TranscodingUnavailable(Exception):
+    """Raised when a track can't be transcoded right now."""
+
+    pass
+
+
+def rendition_key(content_key, audio_format, bitrate):
+    """Key of a transcoded track in the rendition cache.
+
+    Arguments:
+        content_key (str): Identifies the contents of the track, see music.util.track_content_key().
+        audio_format (str): Format the track is transcoded to.
+        bitrate (int): Bitrate the track is transcoded to, in kbit/s.
+    """
+    return f'{content_key}.{bitrate}k.{audio_format}'
+
+
+def hls_key(content_key, bitrate):
+    """Key of the HLS segments of a track in the rendition cache.
+
+    Arguments:
+        content_key (str): Identifies the contents of the track, see music.util.track_content_key().
+        bitrate (int): Bitrate the segments are encoded at, in kbit/s.
+    """
+    return f'{content_key}.{bitrate}k.hls'
+
+
+class TranscodeStream:
+    """Streams the output of an ffmpeg process, while storing it in the rendition cache.
+
+    The output is stored once ffmpeg has finished successfully. If the client goes away first,
+    ffmpeg is stopped and the partial output is thrown away. The stream counts as an active
+    audio stream until then, so refreshes back off while it is being listened to.
+
+    The stream is its own iterator, rather than a generator, so that closing it cleans up even
+    if it is closed before the first chunk is read, e.g. when the client went away before the
+    response started.
+    """
+
+    def __init__(self, process, cache, key, slots, streams=active_streams):
+        """Initialization function for the stream.
+
+        Arguments:
+            process (Popen): The ffmpeg process, writing the transcoded track to its stdout.
+            cache (FileCache): Cache to store the transcoded track in.
+            key (str): Key of the transcoded track in the cache.
+            slots (BoundedSemaphore): Transcoding slot to release once the process is done.
+            streams (ActiveStreams): Counts the audio streams being served.
+
+        Raises:
+            OSError: If the file the output is stored in couldn't be created.
+        """
+        self.process = process
+        self.cache = cache
+        self.key = key
+        self.slots = slots
+        self.streams = streams
+        self.temp_file, self.temp_path = cache.create_temp_file()
+        self.done = False
+        self.streams.opened()
+
+    def __iter__(self):
+        """Iterate over the transcoded track as it is produced."""
+        return self
+
+    def __next__(self):
+        """Read the next chunk of the transcoded track."""
+        if self.done:
+            raise StopIteration
+        try:
+            chunk = self.process.stdout.read1(ASGI_CHUNK_SIZE)
+            if chunk:
+                self.temp_file.write(chunk)
+        except BaseException:
+            self.close()
+            raise
+        if not chunk:
+            self.finish()
+            raise StopIteration
+        return chunk
+
+    def finish(self):
+        """Store the transcoded track, once ffmpeg has written all of it."""
+        if self.done:
+            return
+        self.done = True
+        self.temp_file.close()
+        if self.process.wait() == 0:
+            self.cache.store(self.key, self.temp_path)
+        else:
+            logger.warn(f'ffmpeg exited with status {self.process.returncode} while creating {self.key}.')
+            os.remove(self.temp_path)
+        self.process.stdout.close()
+        self.slots.release()
+        self.streams.closed()
+
+    def close(self):
+        """Stop transcoding if the track wasn't sent in full, e.g. because the client went away.
+
+        WSGI servers, and the ASGI adapter, call this once the response is over, however it ended.
+        """
+        if self.done:
+            return
+        self.done = True
+        self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.temp_file.close()
+        os.remove(self.temp_path)
+        self.slots.release()
+        self.streams.closed()
+
+    def __del__(self):
+        """Stop transcoding if the stream is garbage collected without having been closed."""
+        if not getattr(self, 'done', True):
+            self.close()
+
+
+class Transcoder:
+    """Transcodes tracks through ffmpeg, and keeps the results in a rendition cache."""
+
+    def __init__(self, cache, workers):
+        """Initialization function for the transcoder.
+
+        Arguments:
+            cache (FileCache): Cache of transcoded tracks.
+            workers (int): Number of tracks that may be transcoded at once.
+        """
+        self.cache = cache
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        # Locks of the tracks being segmented. Each lock is dropped once no request is using it.
+        self._segment_locks = weakref.WeakValueDictionary()
+        # Directories the tracks being segmented are written to, by key.
+        self._segmenting = {}
+
+    def transcode(self, source, key, audio_format, bitrate):
+        """Start transcoding a track.
+
+        Arguments:
+            source (file): The opened track file, whose path is passed to ffmpeg. It is closed
+                right away.
+            key (str): Key the transcoded track is stored under in the cache.
+            audio_format (str): Format to transcode to, from RENDITION_FORMATS.
+            bitrate (int): Bitrate to transcode to, in kbit/s.
+
+        Returns:
+            stream (TranscodeStream): The transcoded track, streamed as it is produced.
+
+        Raises:
+            TranscodingUnavailable: If too many tracks are already being transcoded, or ffmpeg can't be run.
+        """
+        codec, container, _ = RENDITION_FORMATS[audio_format]
+        # ffmpeg opens the track itself, as it has to seek in some files, e.g. M4A files whose
+        #  index is at the end, which it can't do through a pipe.
+        source_path = source.name
+        source.close()
+        if not self._slots.acquire(blocking=False):
+            raise TranscodingUnavailable('Too many tracks are being transcoded.')
+        command = [
+            FFMPEG_PATH, '-hide_banner', '-loglevel', 'error',
+            '-i', source_path,
+            '-vn', '-map_metadata', '-1',
+            '-c:a', codec, '-b:a', f'{bitrate}k',
+            '-f', container, 'pipe:1',
+        ]
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        except OSError as e:
+            self._slots.release()
+            logger.critical(f'Could not run ffmpeg: {e}')
+            raise TranscodingUnavailable('ffmpeg could not be run.')
+        try:
+            return TranscodeStream(process, self.cache, key, self._slots)
+        except OSError as e:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+            self._slots.release()
+            logger.warn(f'Could not create a file to store {key} in: {e}')
+            raise TranscodingUnavailable('The rendition cache is unavailable.')
+
+    def segment(self, open_source, key, bitrate):
+        """Start cutting a track into AAC encoded HLS segments, unless that has been done already.
+
+        ffmpeg runs in the background, and adds each segment to the playlist once it has been
+        written, so the first segments can be served while the rest are still being encoded.
+        Once every segment has been written, they are moved into the cache.
+
+        Arguments:
+            open_source (callable): Opens the track file, which is only done if the track needs
+                to be segmented. The file's path is passed to ffmpeg.
+            key (str): Key the segments are stored under in the cache.
+            bitrate (int): Bitrate to encode the segments at, in kbit/s.
+
+        Returns:
+            result (tuple): The directory containing the segments, and the index.m3u8 playlist
+                listing them, and whether every segment has been written. The playlist may not
+                have been written yet.
+
+        Raises:
+            TranscodingUnavailable: If too many tracks are already being transcoded, or ffmpeg can't be run.
+            MediaUnavailable: If the track file couldn't be opened because the media server is unavailable.
+            OSError: If the track file couldn't be opened for any other reason.
+        """
+        path = self.cache.lookup(key)
+        if path:
+            return path, True
+        with self._lock:
+            segment_lock = self._segment_locks.setdefault(key, threading.Lock())
+        # Players request the playlist and its first segments at once, so only one of them starts ffmpeg.
+        with segment_lock:
+            with self._lock:
+                temp_path = self._segmenting.get(key)
+            if temp_path:
+                return temp_path, False
+            path = self.cache.lookup(key)
+            if path:
+                return path, True
+            if not self._slots.acquire(blocking=False):
+                raise TranscodingUnavailable('Too many tracks are being transcoded.')
+            try:
+                with open_source() as source:
+                    source_path = source.name
+            except OSError:
+                self._slots.release()
+                raise
+            temp_path = self.cache.create_temp_dir()
+            command = [
+                FFMPEG_PATH, '-hide_banner', '-loglevel', 'error',
+                '-i', source_path,
+                '-vn', '-map_metadata', '-1',
+                '-c:a', 'aac', '-b:a', f'{bitrate}k',
+                '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'event',
+                # Segments, and the playlist, only appear under their names once they are complete.
+                '-hls_flags', 'temp_file',
+                '-hls_segment_filename', os.path.join(temp_path, 'seg%05d.ts'),
+                os.path.join(temp_path, 'index.m3u8'),
+            ]
+            try:
+                process = subprocess.Popen(command, stdin=subprocess.DEVNULL)
+            except OSError as e:
+                self._slots.release()
+                delete_path(temp_path)
+                logger.critical(f'Could not run ffmpeg: {e}')
+                raise TranscodingUnavailable('ffmpeg could not be run.')
+            with self._lock:
+                self._segmenting[key] = temp_path
+            threading.Thread(target=self._store_segments, args=(process, key, temp_path),
+                             name=f'segment-{key}', daemon=True).start()
+            return temp_path, False
+
+    def _store_segments(self, process, key, temp_path):
+        """Wait for ffmpeg to finish segmenting a track, and move the segments into the cache."""
+        try:
+            if process.wait() == 0:
+                self.cache.store(key, temp_path)
+                if not os.path.isdir(self.cache.path(key)):
+                    logger.warn(f'The segments of {key} are too large for the rendition cache.')
+            else:
+                logger.warn(f'ffmpeg exited with status {process.returncode} while segmenting {key}.')
+                delete_path(temp_path)
+        finally:
+            with self._lock:
+                self._segmenting.pop(key, None)
+            self._slots.release()
+
+
+rendition_cache = FileCache(RENDITION_CACHE_DIR, RENDITION_CACHE_MAX_BYTES, 1)
+transcoder = Transcoder(rendition_cache, TRANSCODE_WORKERS)
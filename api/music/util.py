@@ -4,25 +4,75 @@
 """Utility functions related to music models."""
 
 # Native python imports
-import logging, threading, os, random, operator, datetime, hashlib
+import logging, threading, os, random, operator, hashlib
 
 # Local file imports
-from music.models import Playlist, Song, RefreshState
+from music.models import Playlist, Song, association_table
+from music.jobs import RefreshCancelled, RefreshProgress, ScanProgress, start_refresh_job
+from music.fingerprint import FingerprintBuilder, audio_payload, fingerprint_is_current
+from music.fingerprint import needs_sampling, sampled_fingerprint
+from music.scan import ScanFile
+from music.throttle import lower_scan_priority
+from music.seek import SeekIndexBuilder, seek_offset
 from settings import MISSING_ARTWORK_FILE, MUSIC_FOLDER
 from users.models import User
-from util.util import Session, access_db
+from util.util import Session, access_db, access_media, is_mounted
 
 # PIP library imports
-import eyed3
-from mutagen.mp3 import MP3
+import mutagen
 import sqlalchemy
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from sqlalchemy import or_, func
+from sqlalchemy import or_, func, select
 
 # Variables and config
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Content-types of the audio files that are scanned, by file extension.
+AUDIO_CONTENT_TYPES = {
+    '.mp3': 'audio/mpeg',
+    '.flac': 'audio/flac',
+    '.ogg': 'audio/ogg',
+    '.opus': 'audio/ogg',
+    '.m4a': 'audio/mp4',
+    '.aac': 'audio/aac',
+    '.wav': 'audio/wav',
+}
+
+# Codecs of the file types mutagen loads, other than MP4, whose codec is read from the file.
+AUDIO_CODECS = {
+    'MP3': 'mp3',
+    'EasyMP3': 'mp3',
+    'FLAC': 'flac',
+    'OggFLAC': 'flac',
+    'OggVorbis': 'vorbis',
+    'OggOpus': 'opus',
+    'AAC': 'aac',
+    'WAVE': 'pcm',
+}
+
+# Keys each tag is read from, in order. The lowercase keys are those of mutagen's easy tags and
+#  of Vorbis comments, while the ID3 frame names are for ID3 tags without an easy interface, e.g. in WAV files.
+TAG_KEYS = {
+    'title': ('title', 'TIT2'),
+    'artist': ('artist', 'TPE1'),
+    'album': ('album', 'TALB'),
+}
+
+# Columns describing a track's file rather than its tags, which are updated whenever it is scanned.
+FILE_COLUMNS = ('codec', 'bitrate', 'sample_rate', 'lossless_path', 'track_hash', 'audio_fingerprint', 'seek_index',
+                'file_size', 'file_mtime')
+
+# Columns holding a track's tags, which are also updated whenever it is scanned, mapped to their
+#  keys in the track info from load_track_data().
+TAG_COLUMNS = {'track_name': 'title', 'artist_name': 'artist', 'album_name': 'album'}
+
+# Columns computed from the whole of a track's file, rather than from its tags. The legacy
+#  track_hash is no longer computed for new files, see LibraryScan.finish().
+CONTENT_COLUMNS = ('audio_fingerprint', 'seek_index')
+
+# Number of rows written, or ids listed, in each database statement of a scan.
+SCAN_BATCH_SIZE = 500
+
 
 def fetch_track_info(songid):
     """Fetch detailed information about a given track.
@@ -30,7 +80,7 @@ def fetch_track_info(songid):
     Arguments:
         songid (str): Integer string identifying the track to fetch information on.
     """
-    with access_db() as db_conn:
+    with access_db(read_only=True) as db_conn:
         try:
             track = db_conn.query(Song).get(songid)
         except:
@@ -68,11 +118,30 @@ def fetch_track_path(songid):
             return track.track_path
 
 
-def fetch_track_hash(songid):
-    """Fetch the file hash for a given track id.
+def track_content_key(track):
+    """Build the key identifying what a track's file contains, in caches and ETags.
+
+    The key comes from the audio fingerprint, together with the file's size and modification
+    time, so it changes whenever the file does, e.g. when it is retagged. Tracks stored before
+    those were recorded use their legacy SHA-1 until they are scanned again.
+
+    Arguments:
+        track: The track's row, with its audio_fingerprint, file_size, file_mtime and track_hash.
+
+    Returns:
+        result (str): The key, or None if nothing identifies the track's contents yet.
+    """
+    if track.audio_fingerprint and track.file_size is not None and track.file_mtime is not None:
+        key = f'{track.audio_fingerprint}:{track.file_size}:{track.file_mtime}'
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return track.track_hash
+
+
+def fetch_track_content_key(songid):
+    """Fetch the key identifying the contents of a given track id, see track_content_key().
     
     Arguments:
-        songid (str): Integer string identifying the song to fetch the file hash for.
+        songid (str): Integer string identifying the song to fetch the key for.
     """
     with access_db() as db_conn:
         try:
@@ -84,7 +153,41 @@ def fetch_track_hash(songid):
             if not track:
                 logger.warn(f"No song found with id {songid}.")
                 return None
-            return track.track_hash
+            return track_content_key(track)
+
+
+def fetch_track_file_info(songid):
+    """Fetch the file a given track id is served from, and what it contains.
+
+    Arguments:
+        songid (int): Integer identifying the track.
+
+    Returns:
+        result (dict): The track's path, content key, codec, bitrate in bit/s, and the path of its
+            lossless copy, or None if the track doesn't exist.
+    """
+    with access_db() as db_conn:
+        track = db_conn.query(Song).get(songid)
+        if not track:
+            logger.warn(f"No song found with id {songid}.")
+            return None
+        return {
+            'track_path': track.track_path,
+            'content_key': track_content_key(track),
+            'codec': track.codec,
+            'bitrate': track.bitrate,
+            'lossless_path': track.lossless_path,
+        }
+
+
+def audio_content_type(track_path):
+    """Content-type of an audio file, from its extension.
+
+    Arguments:
+        track_path (str): Path of the audio file.
+    """
+    extension = os.path.splitext(track_path)[1].lower()
+    return AUDIO_CONTENT_TYPES.get(extension, 'application/octet-stream')
 
 
 def fetch_artwork_path(songid):
@@ -97,7 +200,7 @@ def fetch_artwork_path(songid):
     track_dir = os.path.dirname(track_path)
 
     # Iterate over all files in the same directory as the track.
-    for f in os.listdir(track_dir):
+    for f in access_media(os.listdir, track_dir):
         full_path = os.path.join(track_dir, f)
         # If the file ends with either .png or .jpg, we use that file.
         if os.path.isfile(full_path):
@@ -109,16 +212,70 @@ def fetch_artwork_path(songid):
     return MISSING_ARTWORK_FILE
 
 
+def track_sort_key(track):
+    """Key for sorting tracks by artist name, then album name, then track name.
+
+    Arguments:
+        track (Song): The track to sort.
+    """
+    return (track.artist_name and track.artist_name.lower() or '',
+            track.album_name and track.album_name.lower() or '',
+            track.track_name and track.track_name.lower() or '')
+
+
+def fetch_track_files(songids):
+    """Fetch the file paths and content keys of several tracks.
+
+    Arguments:
+        songids (list): Integers identifying the tracks, in the order they should be returned in.
+
+    Returns:
+        tracks (list): (track_path, content_key, lossless_path) tuples for the tracks that exist and aren't missing.
+    """
+    if not songids:
+        return []
+    with access_db() as db_conn:
+        rows = db_conn.query(Song.id, Song.track_path, Song.lossless_path, Song.audio_fingerprint,
+                             Song.file_size, Song.file_mtime, Song.track_hash)\
+                      .filter(Song.id.in_(songids))\
+                      .filter(Song.file_missing==False)\
+                      .all()
+        found = {row.id: (row.track_path, track_content_key(row), row.lossless_path) for row in rows}
+        return [found[songid] for songid in songids if songid in found]
+
+
+def fetch_next_playlist_tracks(playlistid, songid, count):
+    """Fetch the tracks that follow a track in a playlist.
+
+    Tracks follow each other in the order the playlist is listed in, wrapping around at the end.
+
+    Arguments:
+        playlistid (int): Integer identifying the playlist.
+        songid (int): Integer identifying the track currently playing.
+        count (int): Maximum number of tracks to fetch.
+
+    Returns:
+        tracks (list): (track_path, content_key, lossless_path) tuples for the upcoming tracks.
+    """
+    with access_db() as db_conn:
+        playlist = db_conn.query(Playlist).get(playlistid)
+        if not playlist:
+            return []
+        songs = sorted([song for song in playlist.songs if not song.file_missing], key=track_sort_key)
+        positions = [index for index, song in enumerate(songs) if song.id == songid]
+        if not positions:
+            return []
+        upcoming = [songs[(positions[0] + offset) % len(songs)] for offset in range(1, min(count, len(songs) - 1) + 1)]
+        return [(song.track_path, track_content_key(song), song.lossless_path) for song in upcoming]
+
+
 def get_all_tracks():
     """Fetch track info for all songs in the database."""
-    with access_db() as db_conn:
+    with access_db(read_only=True) as db_conn:
         result = []
         all_tracks = db_conn.query(Song).filter(Song.file_missing==False).all()
 
-        # Sort by artist name, then album name, then track name.
-        all_tracks.sort(key=lambda x: (x.artist_name and x.artist_name.lower() or '', 
-                                       x.album_name and x.album_name.lower() or '', 
-                                       x.track_name and x.track_name.lower() or ''))
+        all_tracks.sort(key=track_sort_key)
         for track in all_tracks:
             track_info = {
                 'title': track.track_name,
@@ -132,6 +289,104 @@ def get_all_tracks():
     return None
 
 
+def fetch_seek_offset(songid, seconds):
+    """Fetch the byte offset of a time in a track, from the track's seek index.
+
+    Arguments:
+        songid (int): Integer identifying the track.
+        seconds (int): Number of seconds into the track.
+
+    Returns:
+        result (int): Byte offset of the first frame at or after the given time, or None if the
+            track has no seek index.
+
+    Raises:
+        SeekOutOfRange: Raised if the time is before the start, or past the end, of the track.
+    """
+    with access_db() as db_conn:
+        packed_index = db_conn.query(Song.seek_index)\
+                              .filter(Song.id==songid)\
+                              .scalar()
+        if not packed_index:
+            return None
+        return seek_offset(packed_index, seconds)
+
+
+def batches(items, size=SCAN_BATCH_SIZE):
+    """Split a list into lists of at most size items, e.g. to keep the ids in an IN clause below the database's limit."""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def fetch_known_tracks(folders=(), paths=()):
+    """Fetch what is stored about the files of the tracks in part of the music folder.
+
+    Seek indexes are large, so only whether a track has one is fetched.
+
+    Arguments:
+        folders (iterable): Folders whose tracks to fetch. Passing the music folder fetches every
+            track, including those left outside of it after it moved.
+        paths (iterable): Paths of individual tracks to fetch.
+
+    Returns:
+        result (dict): Maps the paths of the tracks to dictionaries of their id, file_missing
+            flag, TAG_COLUMNS and FILE_COLUMNS, with seek_index set to True when the track has one.
+    """
+    conditions = [Song.track_path.startswith(folder.rstrip(os.sep) + os.sep, autoescape=True)
+                  for folder in folders]
+    paths = list(paths)
+    if paths:
+        conditions.append(Song.track_path.in_(paths))
+    if not conditions:
+        return {}
+    with access_db() as db_conn:
+        query = db_conn.query(Song.id,
+                              Song.track_path,
+                              Song.file_missing,
+                              Song.track_name,
+                              Song.artist_name,
+                              Song.album_name,
+                              Song.codec,
+                              Song.bitrate,
+                              Song.sample_rate,
+                              Song.lossless_path,
+                              Song.track_hash,
+                              Song.audio_fingerprint,
+                              Song.file_size,
+                              Song.file_mtime,
+                              Song.seek_index.isnot(None).label('has_seek_index'))
+        if MUSIC_FOLDER not in folders:
+            query = query.filter(or_(*conditions))
+        result = {}
+        for row in query.all():
+            known = row._asdict()
+            known['seek_index'] = True if known.pop('has_seek_index') else None
+            result[row.track_path] = known
+        return result
+
+
+def missing_contents(known):
+    """Find which columns computed from the whole file are still missing for a known track.
+
+    Tracks added before a column existed, or fingerprinted with a different algorithm, have
+    their file read in full on the next refresh. Other tracks only have their tags read, unless
+    their file's size or modification time changed, see load_track_data().
+
+    Arguments:
+        known (dict): What is stored about the track, from fetch_known_tracks().
+
+    Returns:
+        result (tuple): The CONTENT_COLUMNS the track is missing.
+    """
+    missing = []
+    if not fingerprint_is_current(known['audio_fingerprint']):
+        missing.append('audio_fingerprint')
+    if known['codec'] in (None, 'mp3') and not known['seek_index']:
+        missing.append('seek_index')
+    return tuple(missing)
+
+
 def check_file_missing(songid):
     """Check whether a specific track's file is missing in the database.
 
@@ -151,6 +406,21 @@ def check_file_missing(songid):
             return track.file_missing
 
 
+def label_tracks_missing(songids, missing):
+    """Update the file_missing flag of many tracks at once.
+
+    Arguments:
+        songids (iterable): Integers identifying the tracks.
+        missing (bool): Whether the tracks' files are missing.
+    """
+    with access_db() as db_conn:
+        for batch in batches(songids):
+            db_conn.query(Song)\
+                   .filter(Song.id.in_(batch))\
+                   .update({Song.file_missing: missing}, synchronize_session=False)
+        db_conn.commit()
+
+
 def label_track_missing(track_path, missing):
     """Update the track_missing flag in the database.
 
@@ -158,53 +428,45 @@ def label_track_missing(track_path, missing):
         track_path (str): The path to the track that is missing.
     """
     with access_db() as db_conn:
-        track = db_conn.query(Song)\
-                       .filter(Song.track_path==track_path)\
-                       .first()
-        if track:
-            track.file_missing = missing
-            db_conn.commit()
+        db_conn.query(Song)\
+               .filter(Song.track_path==track_path)\
+               .update({Song.file_missing: missing}, synchronize_session=False)
+        db_conn.commit()
 
 
-def add_track_to_database(track_info):
-    """Add a track to the database.
+def merge_duplicate_tracks():
+    """Merge tracks stored more than once under the same path into the oldest of them.
 
-    Arguments:
-        track_info (dict): Specific track information to be entered into the database.
+    Overlapping scans could add the same file twice before track paths had to be unique. The
+    playlists holding any of the copies hold the oldest one instead.
+
+    Returns:
+        result (int): Number of tracks that were removed.
     """
-    track_path = track_info['track_path']
-    track_hash = track_info['track_hash']
+    removed = 0
     with access_db() as db_conn:
-        # Make sure the track doesn't already exist
-        # First by checking the track path
-        exists = db_conn.query(Song)\
-                        .filter(Song.track_path==track_path)\
-                        .first()
-        if exists:
-            return False
-        else:
-            # Then by checking the track hash
-            exists = db_conn.query(Song)\
-                            .filter(Song.track_hash==track_hash)\
-                            .first()
-            if exists and exists.file_missing:
-                # If the track hash exists, and the file is missing, update its path
-                exists.track_path = track_path
-                exists.file_missing = False
-                db_conn.commit()
-                return False
-
-        # Create and add ORM object to the database
-        song = Song(track_name=track_info['title'],
-                    artist_name=track_info['artist'],
-                    album_name=track_info['album'],
-                    track_path=track_info['track_path'],
-                    track_length=track_info['track_length'],
-                    track_hash=track_info['track_hash'])
-        db_conn.add(song)
+        duplicates = db_conn.query(Song.track_path, func.min(Song.id))\
+                            .group_by(Song.track_path)\
+                            .having(func.count(Song.id) > 1)\
+                            .all()
+        for track_path, kept_id in duplicates:
+            copies = [row.id for row in db_conn.query(Song.id)
+                                             .filter(Song.track_path==track_path)
+                                             .filter(Song.id!=kept_id)]
+            songids = copies + [kept_id]
+            playlistids = {row.playlist_id for row in db_conn.execute(
+                select([association_table.c.playlist_id]).where(association_table.c.song_id.in_(songids)))}
+            db_conn.execute(association_table.delete()
+                                             .where(association_table.c.song_id.in_(songids)))
+            for playlistid in playlistids:
+                db_conn.execute(association_table.insert()
+                                                 .values(playlist_id=playlistid, song_id=kept_id))
+            db_conn.query(Song)\
+                   .filter(Song.id.in_(copies))\
+                   .delete(synchronize_session=False)
+            removed += len(copies)
         db_conn.commit()
-        return True
-    return False
+    return removed
 
 
 def remove_track_from_database(track_id):
@@ -218,170 +480,507 @@ def remove_track_from_database(track_id):
     return False
 
 
-def async_refresh():
-    """Asynchronously call the database refresh function."""
+def async_refresh(job_id):
+    """Asynchronously call the database refresh function.
+
+    Arguments:
+        job_id (int): Id of the refresh job, from start_refresh_job().
+
+    Returns:
+        result (Thread): The thread running the refresh.
+    """
     logger.info('Refreshing database.')
-    t = threading.Thread(target=refresh_database_thread)
+    t = threading.Thread(target=refresh_database_thread, args=(job_id,), name=f'refresh-{job_id}')
     t.start()
+    return t
 
 
 def clean_database():
-    """Remove all missing tracks from the database."""
+    """Remove all missing tracks from the database, along with their places in playlists."""
     with access_db() as db_conn:
-        missing_tracks = db_conn.query(Song)\
-                                .filter(Song.file_missing == True)
-        for track in missing_tracks:
-            db_conn.delete(track)
+        missing_ids = select([Song.id]).where(Song.file_missing==True)
+        db_conn.execute(association_table.delete()\
+                                         .where(association_table.c.song_id.in_(missing_ids)))
+        db_conn.query(Song)\
+               .filter(Song.file_missing==True)\
+               .delete(synchronize_session=False)
         db_conn.commit()
 
 
 def refresh_database():
     """Update the song database.
 
-    Uses a single database entry to decide whether or not it's allowed to update the database.
-    This is only allowed once every 5 minutes, at max.
+    Uses a lock in the database to decide whether or not it's allowed to update the database,
+    so only one refresh runs at a time across every process. A refresh is only allowed once
+    every REFRESH_INTERVAL seconds, at max.
+
+    Returns:
+        result (int): Id of the refresh job that was started, or None if none was.
     """
-    with access_db() as db_conn:
-        try:
-            entry = db_conn.query(RefreshState).one()
-        except MultipleResultsFound as e:
-            logger.info('Multiple rows found. Deleting and refreshing.')
-            for db_entry in db_conn.query(RefreshState).all():
-                db_conn.delete(db_entry)
-            db_conn.commit()
-        except NoResultFound as e:
-            logger.info('No rows found. Creating.')
-            state = RefreshState(last_refresh=datetime.datetime.now())
-            db_conn.add(state)
-            db_conn.commit()
-            async_refresh()
-        else:
-            if entry.last_refresh:
-                # If the database has been refreshed at least once, check that it's been 5 minutes.
-                delta = datetime.datetime.now() - entry.last_refresh
-                if delta > datetime.timedelta(minutes=5):
-                    # If 5 minutes have passed, allow an update.
-                    async_refresh()
-                    entry.last_refresh = datetime.datetime.now()
-                    db_conn.commit()
-                else:
-                    logger.info(f'Not enough time has passed since last refresh. Time delta: {delta}')
-                    logger.info(f'Last refresh: {entry.last_refresh}')
-            else: 
-                # If the database has never been refreshed, then go for it
-                async_refresh()
-                entry.last_refresh = datetime.datetime.now()
-                db_conn.commit()
+    job_id = start_refresh_job()
+    if job_id is None:
+        logger.info('Not refreshing, as a refresh is running or started recently.')
+        return None
+    async_refresh(job_id)
+    return job_id
 
 
-def refresh_database_thread():
-    """Walk through all files in the music folder, adding them to the database as necessary."""
-    logger.info('Started refreshing.')
+def refresh_database_thread(job_id):
+    """Walk through all files in the music folder, adding them to the database as necessary.
 
+    Arguments:
+        job_id (int): Id of the refresh job, from start_refresh_job(), which records the progress.
+    """
+    logger.info('Started refreshing.')
+    lower_scan_priority()
+    progress = RefreshProgress(job_id)
     try:
-        # This handles directory walking, it's kind of nasty to use this iterator
-        for dirpath, dirname, filename in os.walk(MUSIC_FOLDER):
-            for f in filename:
-                # Do nothing with non-mp3 tracks
-                if not f.endswith('.mp3'):
-                    continue
-                full_file_path = os.path.join(dirpath, f)
-                track_info = load_track_data(full_file_path)
-                if track_info:
-                    add_track_to_database(track_info)
+        result = scan_folder(MUSIC_FOLDER, progress)
+    except RefreshCancelled as e:
+        logger.info('Refreshing cancelled.')
+        progress.finish('cancelled', error=str(e) or None)
     except Exception as e:
         logger.warn('Exception encountered while refreshing database.')
         logger.warn(e)
-        raise e
-    finally:
         # Return to a non-refreshing state once finished.
-        with access_db() as db_conn:
-            try:
-                state = db_conn.query(RefreshState).one()
-                state.is_refreshing=False
-                db_conn.commit()
-            except MultipleResultsFound as e:
-                state = db_conn.query(RefreshState).first().delete()
-                db_conn.commit()
-                logger.info('Refreshing finished!')
-                return
+        progress.finish('failed', error=str(e))
+        raise e
+    else:
+        if result is None:
+            progress.finish('failed', error='The music folder is unavailable.')
+        else:
+            progress.finish('finished', result)
         logger.info('Refreshing finished!')
 
 
-def load_track_data(track_path):
+class LibraryScan:
+    """A scan of part of the music folder, which is written to the database in batches.
+
+    Files are read as they are found, and changes to known tracks are written in batches. Once
+    every file has been read, finish() reconciles the files that were seen with the tracks in
+    the database:
+    - known tracks whose files weren't seen are marked missing,
+    - new files whose audio fingerprint, or else legacy hash, matches a missing track are relinked to
+      that track, so it keeps its place in playlists,
+    - and the remaining new files are added as new tracks.
+    """
+
+    def __init__(self, folders=(), paths=(), reread=False, progress=None):
+        """Initialization function for the scan.
+
+        Arguments:
+            folders (iterable): Folders being scanned. Known tracks in them whose files aren't seen are marked missing.
+            paths (iterable): Individual files being scanned, which are marked missing if they aren't seen.
+            reread (bool): Whether to read known files in full, e.g. because they are known to have changed.
+            progress (ScanProgress): Where the progress of the scan is reported, e.g. a RefreshProgress.
+        """
+        self.progress = progress or ScanProgress()
+        self.folders = list(folders)
+        self.known = fetch_known_tracks(self.folders, paths)
+        self.reread = reread
+        self.seen = set()
+        self.updates = []
+        self.new_tracks = []
+
+    def scan_folder(self, folder):
+        """Read every file in a folder.
+
+        Arguments:
+            folder (str): The music folder, or a folder within it.
+        """
+        # The folder is listed before any file is read, so the progress of reading them can be reported.
+        self.progress.phase('listing')
+        files = []
+        # This handles directory walking, it's kind of nasty to use this iterator
+        for dirpath, dirname, filename in os.walk(folder):
+            filenames = set(filename)
+            for f in filename:
+                if os.path.splitext(f)[1].lower() in AUDIO_CONTENT_TYPES:
+                    files.append((os.path.join(dirpath, f), filenames))
+
+        self.progress.phase('reading', files_total=len(files))
+        for track_path, filenames in files:
+            self.scan_file(track_path, filenames)
+            self.progress.advance()
+
+    def scan_file(self, track_path, sibling_names):
+        """Read a file, if it is an audio track.
+
+        Arguments:
+            track_path (str): Path of the file.
+            sibling_names (set): Names of the files in the same folder, which are used to pair MP3
+                files with their lossless copies.
+        """
+        dirpath, f = os.path.split(track_path)
+        stem, extension = os.path.splitext(f)
+        extension = extension.lower()
+        # Do nothing with files that aren't audio tracks
+        if extension not in AUDIO_CONTENT_TYPES:
+            return
+        # A FLAC file next to an MP3 file of the same name is the lossless copy of that
+        #  track, rather than a track of its own.
+        if extension == '.flac' and f'{stem}.mp3' in sibling_names:
+            return
+        # A file may be reached twice, e.g. when both it and its folder changed.
+        if track_path in self.seen:
+            return
+        # Files that exist count as seen, even if they can't be read right now.
+        self.seen.add(track_path)
+
+        known = self.known.get(track_path)
+        contents = CONTENT_COLUMNS
+        known_stat = None
+        if known:
+            known_stat = (known['file_size'], known['file_mtime'])
+            if not self.reread:
+                contents = missing_contents(known)
+        track_info = load_track_data(track_path, contents, known_stat)
+        if not track_info:
+            return
+        track_info['lossless_path'] = None
+        if extension == '.mp3' and f'{stem}.flac' in sibling_names:
+            track_info['lossless_path'] = os.path.join(dirpath, f'{stem}.flac')
+
+        if not known:
+            self.new_tracks.append(track_info)
+            return
+        changes = {column: track_info[column] for column in FILE_COLUMNS
+                   if column in track_info and known[column] != track_info[column]}
+        # Tags are read on every scan, so retagged tracks are updated too.
+        changes.update({column: track_info[key] for column, key in TAG_COLUMNS.items()
+                        if known[column] != track_info[key]})
+        if known['file_missing']:
+            # The file is back where it was.
+            changes['file_missing'] = False
+        if changes:
+            changes['id'] = known['id']
+            self.updates.append(changes)
+            if len(self.updates) >= SCAN_BATCH_SIZE:
+                self.write_updates()
+
+    def write_updates(self):
+        """Write the changes to known tracks found so far."""
+        if not self.updates:
+            return
+        with access_db() as db_conn:
+            db_conn.bulk_update_mappings(Song, self.updates)
+            db_conn.commit()
+        self.updates = []
+
+    def finish(self):
+        """Reconcile the files that were seen with the tracks in the database.
+
+        Returns:
+            result (dict): Number of tracks that were added, relinked and marked missing.
+        """
+        self.write_updates()
+        self.progress.phase('reconciling')
+
+        gone = [known['id'] for track_path, known in self.known.items()
+                if track_path not in self.seen and not known['file_missing']]
+        if gone:
+            label_tracks_missing(gone, True)
+
+        relinked = []
+        added = []
+        with access_db() as db_conn:
+            missing = db_conn.query(Song.id, Song.audio_fingerprint, Song.track_hash)\
+                             .filter(Song.file_missing==True)\
+                             .all()
+            # Match by fingerprint, and then by the legacy hash, for tracks that haven't been
+            #  fingerprinted with the current algorithm. New files are only hashed if there are such tracks.
+            unmatched = self.new_tracks
+            for column in ('audio_fingerprint', 'track_hash'):
+                if column == 'track_hash':
+                    missing = [row for row in missing
+                               if row.track_hash and not fingerprint_is_current(row.audio_fingerprint)]
+                    keys = {id(track_info): file_hash(track_info['track_path'])
+                            for track_info in unmatched} if missing else {}
+                else:
+                    keys = {id(track_info): track_info.get(column) for track_info in unmatched}
+                missing_ids = {getattr(row, column): row.id for row in missing if getattr(row, column)}
+                new_tracks = {keys[id(track_info)]: track_info for track_info in unmatched if keys.get(id(track_info))}
+                for key in new_tracks.keys() & missing_ids.keys():
+                    relinked.append((missing_ids[key], new_tracks[key]))
+                linked_tracks = {id(track_info) for _, track_info in relinked}
+                linked_ids = {songid for songid, _ in relinked}
+                unmatched = [track_info for track_info in unmatched if id(track_info) not in linked_tracks]
+                missing = [row for row in missing if row.id not in linked_ids]
+            added = unmatched
+
+            for batch in batches(relinked):
+                db_conn.bulk_update_mappings(Song, [
+                    dict({column: track_info[column] for column in FILE_COLUMNS if column in track_info},
+                         **{column: track_info[key] for column, key in TAG_COLUMNS.items()},
+                         id=songid, track_path=track_info['track_path'], file_missing=False)
+                    for songid, track_info in batch
+                ])
+            for batch in batches(added):
+                db_conn.bulk_insert_mappings(Song, [
+                    dict({column: track_info.get(column) for column in FILE_COLUMNS},
+                         **{column: track_info[key] for column, key in TAG_COLUMNS.items()},
+                         track_path=track_info['track_path'],
+                         track_length=track_info['track_length'],
+                         file_missing=False)
+                    for track_info in batch
+                ])
+            db_conn.commit()
+
+        result = {'added': len(added), 'relinked': len(relinked), 'missing': len(gone)}
+        logger.info(f'Scan finished: {result}')
+        return result
+
+
+def scan_folder(folder, progress=None):
+    """Walk through all files in a folder, adding them to the database as necessary.
+
+    If the scan is cancelled, the changes to known tracks read so far are kept, but nothing is
+    marked missing, relinked or added.
+
+    Arguments:
+        folder (str): The music folder, or a folder within it.
+        progress (ScanProgress): Where the progress of the scan is reported, e.g. a RefreshProgress.
+
+    Returns:
+        result (dict): Number of tracks that were added, relinked and marked missing, or None
+            if the folder is unavailable.
+    """
+    # An unmounted share looks empty, which must not be mistaken for every track being removed.
+    if not os.path.isdir(folder) or not is_mounted():
+        logger.warn(f'{folder} is unavailable, not scanning it.')
+        return None
+    scan = LibraryScan(folders=[folder], progress=progress)
+    try:
+        scan.scan_folder(folder)
+    except RefreshCancelled:
+        scan.write_updates()
+        raise
+    return scan.finish()
+
+
+def ingest_changed_paths(paths, progress=None):
+    """Update the database for files and folders in the music folder that were added, changed or removed.
+
+    This lets the library watcher read only what changed, rather than the whole music folder.
+    Changed files are read in full, since their contents may be different. The caller must hold
+    the refresh lock, see start_refresh_job(), or a refresh running at the same time could add
+    the same new files.
+
+    Arguments:
+        paths (iterable): Paths of the changed files and folders.
+        progress (ScanProgress): Where the progress of the scan is reported, e.g. a RefreshProgress.
+
+    Returns:
+        result (dict): Number of tracks that were added, relinked and marked missing, or None
+            if the music folder is unavailable.
+    """
+    if not is_mounted():
+        logger.warn('The music folder is unavailable, not ingesting changes.')
+        return None
+    targets = set()
+    for path in paths:
+        stem, extension = os.path.splitext(path)
+        if extension.lower() == '.flac':
+            # The MP3 file next to a lossless copy has to be updated when the copy is added or removed.
+            targets.add(f'{stem}.mp3')
+        targets.add(path)
+
+    # A removed path may have been a file or a folder.
+    folders = [path for path in targets if not os.path.isfile(path)]
+    scan = LibraryScan(folders=folders, paths=targets, reread=True, progress=progress)
+    sibling_names = {}
+    try:
+        for path in sorted(targets):
+            if os.path.isdir(path):
+                scan.scan_folder(path)
+            elif os.path.isfile(path):
+                dirpath = os.path.dirname(path)
+                if dirpath not in sibling_names:
+                    sibling_names[dirpath] = set(os.listdir(dirpath))
+                scan.scan_file(path, sibling_names[dirpath])
+    except RefreshCancelled:
+        scan.write_updates()
+        raise
+    return scan.finish()
+
+
+def read_tag(tags, name):
+    """Read a tag from a file's tags, whatever format they are in.
+
+    Arguments:
+        tags (mutagen.Tags): The tags loaded by mutagen, or None if the file has none.
+        name (str): Name of the tag, from TAG_KEYS.
+
+    Returns:
+        result (str): The first value of the tag, or None if it isn't set.
+    """
+    if not tags:
+        return None
+    for key in TAG_KEYS[name]:
+        try:
+            value = tags[key]
+        except (KeyError, ValueError):
+            continue
+        # ID3 frames hold their values in a list of their own.
+        value = getattr(value, 'text', value)
+        if value:
+            return str(value[0])
+    return None
+
+
+def audio_codec(audiofile):
+    """Name of the audio codec of a file loaded by mutagen.
+
+    Arguments:
+        audiofile (mutagen.FileType): The loaded file.
+    """
+    kind = type(audiofile).__name__
+    if kind in AUDIO_CODECS:
+        return AUDIO_CODECS[kind]
+    codec = getattr(audiofile.info, 'codec', None)
+    if codec and codec.startswith('mp4a'):
+        return 'aac'
+    return codec
+
+
+def file_hash(track_path):
+    """Compute the legacy SHA-1 of a track's whole file, which old tracks are relinked by.
+
+    Arguments:
+        track_path (str): Path of the track file.
+
+    Returns:
+        result (str): The hex digest, or None if the file can't be read.
+    """
+    hasher = hashlib.sha1()
+    try:
+        with ScanFile(track_path) as track_file:
+            for block in track_file.blocks():
+                hasher.update(block)
+    except OSError as e:
+        logger.warn(f'Exception encountered while hashing track: {track_path}')
+        logger.warn(e)
+        return None
+    return hasher.hexdigest()
+
+
+def load_track_data(track_path, contents=CONTENT_COLUMNS, known_stat=None):
     """Open a track file in order to extract track info.
 
+    MP3, FLAC, Ogg Vorbis, Opus, M4A, AAC and WAV files are read through mutagen, which detects
+    the format from the file itself. Tags, stream information, the audio fingerprint and the
+    seek index all come from a single pass over the file, with each part of it read from
+    storage only once.
+
     Arguments:
         track_path (str): File path for the track to fetch information about.
+        contents (tuple): Which of the CONTENT_COLUMNS to compute. If none, only the parts of
+            the file holding its tags and stream information are read.
+        known_stat (tuple): The file_size and file_mtime stored for the track. If the file's
+            size or modification time differs, it was replaced or edited since it was last
+            read, every one of the CONTENT_COLUMNS is computed, and its legacy track_hash is
+            cleared. Tracks stored before these were recorded just have them recorded.
     """
-    # This silences some noisy notifications about malformed/missing info.
-    eyed3.log.setLevel('ERROR')
     result = {}
 
-    # Attempt to load the audiofile
-    audiofile = None
     try:
-        audiofile = eyed3.load(track_path)
-    except Exception as e:
+        track_file = ScanFile(track_path)
+    except OSError as e:
         logger.warn(f'Exception encountered while loading track: {track_path}')
         logger.warn(e)
         return None
 
-    # Loading was successful, but returned None instead of a useable object.
-    if not audiofile:
-        logger.warn(f'eyed3 returned NoneType while loading track: {track_path}')
-        return None
+    with track_file:
+        result['file_size'] = track_file.size
+        result['file_mtime'] = track_file.mtime_ns
+        if known_stat and None not in known_stat and known_stat != (track_file.size, track_file.mtime_ns):
+            contents = CONTENT_COLUMNS
+            result['track_hash'] = None
 
-    # Load track title. If it doesn't exist, we don't want to display the track.
-    try:
-        result['title'] = audiofile.tag.title
-    except:
-        logger.warn(f'Track had no title: {track_path}')
-        return None
-    else:
-        if not result['title']:
-            logger.warn(f'Track had no title: {track_path}')
+        # Attempt to load the audiofile
+        audiofile = None
+        try:
+            audiofile = mutagen.File(track_file, easy=True)
+        except Exception as e:
+            logger.warn(f'Exception encountered while loading track: {track_path}')
+            logger.warn(e)
             return None
 
-    # Load track artist. It might not exist, and that's fine.
-    try:
-        result['artist'] = audiofile.tag.artist
-    except:
-        logger.info(f'Track has no artist: {track_path}')
-        result['artist'] = ''
-
-    # Load track album. It might not exist, and that's fine.
-    try:
-        result['album'] = audiofile.tag.album
-    except:
-        logger.info(f'Track has no album: {track_path}')
-        result['album'] = ''
+        # Loading was successful, but the format wasn't recognized.
+        if not audiofile:
+            logger.warn(f'Unrecognized audio format while loading track: {track_path}')
+            return None
 
-    # Fetch track length. If it doesn't exist, we don't want to display the track.
-    try:
-        time_secs = MP3(track_path).info.length
-    except:
-        logger.warn(f'Track had no track length data: {track_path}')
-        return None
+        # Load track title. If it doesn't exist, we don't want to display the track.
+        result['title'] = read_tag(audiofile.tags, 'title')
+        if not result['title']:
+            logger.warn(f'Track had no title: {track_path}')
+            return None
 
-    # Convert the audio length from seconds to a more readable number.
-    minutes, seconds = divmod(int(time_secs), 60)
-    hours, minutes = divmod(minutes, 60)
-    if (hours > 0):
-        track_length = "%02d:%02d:%02d" % (hours, minutes, seconds)
-    else:
-        track_length = "%02d:%02d" % (minutes, seconds)
-    result['track_length'] = track_length
-    result['track_path'] = track_path
+        # Load track artist. It might not exist, and that's fine.
+        result['artist'] = read_tag(audiofile.tags, 'artist')
+        if result['artist'] is None:
+            logger.info(f'Track has no artist: {track_path}')
+            result['artist'] = ''
+
+        # Load track album. It might not exist, and that's fine.
+        result['album'] = read_tag(audiofile.tags, 'album')
+        if result['album'] is None:
+            logger.info(f'Track has no album: {track_path}')
+            result['album'] = ''
+
+        # Fetch track length. If it doesn't exist, we don't want to display the track.
+        time_secs = getattr(audiofile.info, 'length', None)
+        if not time_secs:
+            logger.warn(f'Track had no track length data: {track_path}')
+            return None
 
-    # Create file hash string with SHA1
-    hasher = hashlib.sha1()
-    with open(track_path, 'rb') as f:
-        buf = f.read(65536)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = f.read(65536)
-    result['track_hash'] = hasher.hexdigest()
+        # Convert the audio length from seconds to a more readable number.
+        minutes, seconds = divmod(int(time_secs), 60)
+        hours, minutes = divmod(minutes, 60)
+        if (hours > 0):
+            track_length = "%02d:%02d:%02d" % (hours, minutes, seconds)
+        else:
+            track_length = "%02d:%02d" % (minutes, seconds)
+        result['track_length'] = track_length
+        result['track_path'] = track_path
+
+        # Record what the file contains, so serving it doesn't need to look at the file again.
+        result['codec'] = audio_codec(audiofile)
+        result['bitrate'] = getattr(audiofile.info, 'bitrate', None) or None
+        result['sample_rate'] = getattr(audiofile.info, 'sample_rate', None) or None
+
+        # Only MP3 tracks have a seek index.
+        seek_index = None
+        if result['codec'] != 'mp3':
+            result['seek_index'] = None
+        elif 'seek_index' in contents:
+            seek_index = SeekIndexBuilder()
+
+        # Build the fingerprint and the seek index from the same reads. The blocks already read
+        #  for the tags aren't read again.
+        try:
+            fingerprint = None
+            if 'audio_fingerprint' in contents:
+                start, end, ogg_header_packets = audio_payload(track_file, result['codec'])
+                if needs_sampling(start, end):
+                    result['audio_fingerprint'] = sampled_fingerprint(track_file, start, end)
+                else:
+                    fingerprint = FingerprintBuilder(start, end, ogg_header_packets)
+            if fingerprint or seek_index:
+                for block in track_file.blocks():
+                    if fingerprint:
+                        fingerprint.feed(block)
+                    if seek_index:
+                        seek_index.feed(block)
+        except OSError as e:
+            logger.warn(f'Exception encountered while reading track: {track_path}')
+            logger.warn(e)
+            return None
+        if fingerprint:
+            result['audio_fingerprint'] = fingerprint.fingerprint()
+        if seek_index:
+            result['seek_index'] = seek_index.pack()
 
     return result
 
@@ -459,7 +1058,7 @@ def get_playlist_data_from_id(playlistid):
     if not playlistid:
         logger.warn(f"Trying to access playlist without id.")
         return None
-    with access_db() as db_conn:
+    with access_db(read_only=True) as db_conn:
         try:
             playlist = db_conn.query(Playlist)\
                               .get(playlistid)
@@ -479,10 +1078,7 @@ def get_playlist_data_from_id(playlistid):
                 'public': playlist.public,
             }
             if playlist.songs:
-                # Sorts by artist name, then album name, then track name.
-                sorted_songs = sorted(playlist.songs, key=lambda x: ((x.artist_name and x.artist_name.lower() or ''), 
-                                                                     (x.album_name and x.album_name.lower() or ''), 
-                                                                     (x.track_name and x.track_name.lower() or '')))
+                sorted_songs = sorted(playlist.songs, key=track_sort_key)
                 for track in sorted_songs:
                     track_info = {
                         'title': track.track_name,
@@ -554,7 +1150,7 @@ def remove_song_from_playlist(playlistid, songid):
 def get_public_playlists():
     """Fetch publicly available playlists."""
     result = {'playlists': []}
-    with access_db() as db_conn:
+    with access_db(read_only=True) as db_conn:
         # Filter all playlists by publicity.
         public = db_conn.query(Playlist)\
                        .filter(Playlist.public==True)
@@ -599,7 +1195,7 @@ def get_playlists_for_user(user_guid):
         user_guid (uuid): UUID identifying the specific user to fetch playlists for.
     """
     result = {'playlists': []}
-    with access_db() as db_conn:
+    with access_db(read_only=True) as db_conn:
         accessible = db_conn.query(Playlist)\
                        .filter(
                             or_(Playlist.owner_guid==user_guid,
@@ -626,7 +1222,7 @@ def get_playlists_owned_by_user(user_guid):
         user_guid (uuid): UUID identifying the specific user to fetch playlists for.
     """
     result = {'playlists': []}
-    with access_db() as db_conn:
+    with access_db(read_only=True) as db_conn:
         accessible = db_conn.query(Playlist)\
                        .filter(Playlist.owner_guid==user_guid)
         for playlist in accessible:
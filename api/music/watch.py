@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: music/watch.py
+"""Watching the music folder, so added, changed and removed tracks reach the database within seconds."""
+
+# Native python imports
+import abc, logging, os, time
+
+# Local file imports
+from music.jobs import RefreshCancelled, RefreshProgress, start_refresh_job
+from music.throttle import lower_scan_priority
+from music.util import ingest_changed_paths, refresh_database_thread
+from settings import MUSIC_FOLDER, NEED_TO_MOUNT, WATCH_MODE, WATCH_DEBOUNCE, WATCH_POLL_INTERVAL
+from util.util import is_mounted
+
+# PIP library imports
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Variables and settings
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class LibraryWatcher(abc.ABC):
+    """Collects changed paths in the music folder, and ingests them once they've settled.
+
+    A path is only ingested once it has gone WATCH_DEBOUNCE seconds without changing, so a file
+    that is still being copied is read once, when it is complete, and an album copied in one go
+    is ingested together.
+    """
+
+    def __init__(self, folder, ingest=ingest_changed_paths, debounce=WATCH_DEBOUNCE):
+        """Initialization function for the watcher.
+
+        Arguments:
+            folder (str): The folder to watch.
+            ingest (callable): Called with a list of settled paths, and the RefreshProgress of the
+                job ingesting them.
+            debounce (float): Seconds a path must go unchanged before it is ingested.
+        """
+        self.folder = folder
+        self.ingest = ingest
+        self.debounce = debounce
+        # Maps changed paths to when they last changed.
+        self._pending = {}
+
+    def changed(self, path):
+        """Record that a path changed."""
+        self._pending[path] = time.monotonic()
+
+    def flush(self):
+        """Ingest the paths that have settled.
+
+        Paths are ingested under the refresh lock, so they aren't read at the same time as a
+        refresh, or another watcher, reads them. While another process holds the lock, they
+        are kept until a later flush.
+        """
+        now = time.monotonic()
+        settled = [path for path, changed_at in self._pending.items() if now - changed_at >= self.debounce]
+        if not settled:
+            return
+        job_id = start_refresh_job(force=True, full=False)
+        if job_id is None:
+            logger.info(f'Another refresh is running, keeping {len(settled)} changed paths until it finishes.')
+            return
+        for path in settled:
+            del self._pending[path]
+        logger.info(f'Ingesting {len(settled)} changed paths.')
+        progress = RefreshProgress(job_id)
+        try:
+            result = self.ingest(settled, progress)
+        except RefreshCancelled as e:
+            logger.info('Ingesting changed paths cancelled.')
+            progress.finish('cancelled', error=str(e) or None)
+        except Exception as e:
+            logger.warn('Exception encountered while ingesting changed paths.')
+            logger.warn(e)
+            progress.finish('failed', error=str(e))
+        else:
+            if result is None:
+                progress.finish('failed', error='The music folder is unavailable.')
+            else:
+                progress.finish('finished', result)
+
+    @abc.abstractmethod
+    def run(self):
+        """Watch the folder until interrupted."""
+
+
+class InotifyWatcher(LibraryWatcher):
+    """Watches a local folder with inotify, which reports changes as they happen."""
+
+    def __init__(self, folder, **kwargs):
+        """Initialization function for the watcher.
+
+        Arguments:
+            folder (str): The folder to watch.
+        """
+        super().__init__(folder, **kwargs)
+        flags = inotify_simple.flags
+        self._mask = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.DELETE
+                      | flags.MOVED_FROM | flags.MOVED_TO)
+        self._inotify = inotify_simple.INotify()
+        # Maps watch descriptors to the folders they watch.
+        self._watches = {}
+        self._add_tree(folder)
+
+    def _add_tree(self, folder):
+        """Watch a folder and every folder within it."""
+        for dirpath, dirnames, filenames in os.walk(folder):
+            try:
+                self._watches[self._inotify.add_watch(dirpath, self._mask)] = dirpath
+            except OSError as e:
+                logger.warn(f'Could not watch {dirpath}: {e}')
+
+    def run(self):
+        """Watch the folder until interrupted."""
+        flags = inotify_simple.flags
+        while True:
+            # Only wake up for the debounce while something is waiting to settle.
+            timeout = self.debounce * 1000 if self._pending else None
+            for event in self._inotify.read(timeout=timeout):
+                if event.mask & flags.Q_OVERFLOW:
+                    # Events were dropped, so the whole folder has to be checked.
+                    logger.warn('Too many changes to follow, rescanning the music folder.')
+                    self.changed(self.folder)
+                    continue
+                if event.mask & flags.IGNORED:
+                    # The watched folder was removed.
+                    self._watches.pop(event.wd, None)
+                    continue
+                directory = self._watches.get(event.wd)
+                if directory is None:
+                    continue
+                path = os.path.join(directory, event.name)
+                if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self._add_tree(path)
+                self.changed(path)
+            self.flush()
+
+
+class PollingWatcher(LibraryWatcher):
+    """Watches a folder by polling it, e.g. on a mounted share, where inotify sees no changes.
+
+    Only folders whose modification time changed since the last poll are listed again, since
+    adding, removing or renaming a file updates its folder. Files that changed are only passed
+    on once they look the same in two polls in a row, as writing to a file doesn't update its
+    folder. Files edited in place, e.g. retagged, aren't noticed, but their tags are read again,
+    and written to the database, by the next full refresh.
+    """
+
+    def __init__(self, folder, poll_interval=WATCH_POLL_INTERVAL, **kwargs):
+        """Initialization function for the watcher.
+
+        Arguments:
+            folder (str): The folder to watch.
+            poll_interval (float): Seconds between polls.
+        """
+        super().__init__(folder, **kwargs)
+        self.poll_interval = poll_interval
+        # Maps each folder to its modification time, and to the (is_dir, size, mtime) of each of its entries.
+        self._folders = {}
+        # Maps files that changed, but may still be being written, to their (is_dir, size, mtime).
+        self._settling = {}
+        self._add_tree(folder)
+
+    def _list(self, folder):
+        """Stat a folder and its entries."""
+        entries = {}
+        with os.scandir(folder) as scan:
+            for entry in scan:
+                if entry.is_dir():
+                    # Changes within a folder are found by polling that folder itself.
+                    entries[entry.name] = (True, None, None)
+                else:
+                    stat = entry.stat()
+                    entries[entry.name] = (False, stat.st_size, stat.st_mtime)
+        return os.stat(folder).st_mtime, entries
+
+    def _add_tree(self, folder):
+        """Record how a folder and every folder within it look now."""
+        for dirpath, dirnames, filenames in os.walk(folder):
+            try:
+                self._folders[dirpath] = self._list(dirpath)
+            except OSError as e:
+                logger.warn(f'Could not list {dirpath}: {e}')
+
+    def _remove_tree(self, folder):
+        """Forget about a folder and every folder within it."""
+        prefix = folder + os.sep
+        for dirpath in [dirpath for dirpath in self._folders if dirpath == folder or dirpath.startswith(prefix)]:
+            del self._folders[dirpath]
+
+    def poll(self):
+        """Look for changes since the last poll."""
+        # An unmounted share looks empty, which must not be mistaken for every track being removed.
+        if not os.path.isdir(self.folder) or (NEED_TO_MOUNT and not is_mounted()):
+            logger.info('Music folder unavailable, skipping poll.')
+            return
+
+        for path, previous in list(self._settling.items()):
+            try:
+                stat = os.stat(path)
+                current = (False, stat.st_size, stat.st_mtime)
+            except OSError:
+                current = None
+            if current == previous:
+                del self._settling[path]
+                self.changed(path)
+            elif current is None:
+                del self._settling[path]
+            else:
+                self._settling[path] = current
+
+        for folder, (mtime, entries) in list(self._folders.items()):
+            if folder not in self._folders:
+                # Removed along with its parent earlier in this poll.
+                continue
+            try:
+                current_mtime = os.stat(folder).st_mtime
+                if current_mtime == mtime:
+                    continue
+                current_mtime, current_entries = self._list(folder)
+            except OSError:
+                # Removed, which is reported by its parent folder.
+                continue
+            self._folders[folder] = (current_mtime, current_entries)
+            for name in entries.keys() | current_entries.keys():
+                before, after = entries.get(name), current_entries.get(name)
+                if before == after:
+                    continue
+                path = os.path.join(folder, name)
+                if before and before[0]:
+                    self._remove_tree(path)
+                if after and after[0]:
+                    self._add_tree(path)
+                    self.changed(path)
+                elif after:
+                    # Passed on once it stops changing.
+                    self._settling[path] = after
+                else:
+                    self.changed(path)
+
+    def run(self):
+        """Watch the folder until interrupted."""
+        next_poll = 0
+        while True:
+            if time.monotonic() >= next_poll:
+                self.poll()
+                next_poll = time.monotonic() + self.poll_interval
+            self.flush()
+            # Wake up in between polls while something is waiting to settle.
+            if self._pending:
+                time.sleep(min(self.debounce, self.poll_interval))
+            else:
+                time.sleep(max(next_poll - time.monotonic(), 0))
+
+
+def create_watcher(folder=MUSIC_FOLDER):
+    """Create the watcher configured by WATCH_MODE.
+
+    Arguments:
+        folder (str): The folder to watch.
+    """
+    mode = WATCH_MODE
+    if mode == 'auto':
+        mode = 'inotify' if inotify_simple and not NEED_TO_MOUNT else 'poll'
+    if mode == 'inotify':
+        if not inotify_simple:
+            raise RuntimeError('WATCH_MODE is inotify, but the inotify_simple package is not installed.')
+        logger.info(f'Watching {folder} with inotify.')
+        return InotifyWatcher(folder)
+    logger.info(f'Watching {folder} by polling every {WATCH_POLL_INTERVAL} seconds.')
+    return PollingWatcher(folder)
+
+
+def watch_library():
+    """Keep the database in step with the music folder until interrupted.
+
+    The folder is scanned in full once the watcher has started, to catch up on changes made
+    while nothing was watching it, unless another process is already refreshing it.
+    """
+    # Everything the watcher does is scanning.
+    lower_scan_priority()
+    watcher = create_watcher()
+    job_id = start_refresh_job(force=True)
+    if job_id is None:
+        logger.info('Another refresh is running, so it will catch up on the changes instead.')
+    else:
+        refresh_database_thread(job_id)
+    watcher.run()
@@ -0,0 +1,641 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: tests/test_music.py
+"""Test suite for music utilities."""
+
+# Native python imports
+import datetime, os, shutil, struct, subprocess, sys, tempfile, threading, time, uuid
+from unittest import TestCase, mock, skipIf
+
+# Pip library imports
+from mutagen.easyid3 import EasyID3
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# Local imports
+from music.seek import SeekIndexBuilder, SeekOutOfRange, parse_frame_header, seek_offset
+# Most music utilities read their configuration from local_settings.py, see wizard.py.
+try:
+	import local_settings
+except ImportError:
+	local_settings = None
+else:
+	from music.cache import FileCache
+	from music.fingerprint import FingerprintBuilder, OGG_HEADER_PACKETS, audio_payload
+	from music.scan import ScanFile
+	from music.throttle import ActiveStreams
+	from music.transcode import TranscodeStream
+	from music.models import Song, RefreshState
+	from music.jobs import RefreshCancelled, RefreshProgress, start_refresh_job, cancel_refresh_job
+	from music.jobs import fetch_refresh_status
+	from music.util import LibraryScan, create_new_playlist, add_song_to_playlist, get_playlist_data_from_id
+	from music.util import fetch_track_content_key, file_hash, merge_duplicate_tracks
+	from music.util import fetch_known_tracks, get_playlists_owned_by_user, owns_playlist
+	from music.watch import PollingWatcher
+	from util.models import Base
+	import util.util
+
+needs_settings = skipIf(local_settings is None, 'Needs a local_settings.py file, created with wizard.py.')
+
+
+def use_test_database(testcase):
+	"""Point every database session at an empty in-memory database until the test is over."""
+	test_engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+	Base.metadata.create_all(test_engine)
+	util.util.Session.configure(bind=test_engine)
+	testcase.addCleanup(util.util.Session.configure, bind=util.util.engine)
+	patcher = mock.patch.object(util.util, 'ReadSessions', [])
+	patcher.start()
+	testcase.addCleanup(patcher.stop)
+
+
+@needs_settings
+class TestFileCache(TestCase):
+	"""Test suite for the size-limited file cache."""
+
+	def setUp(self):
+		"""Create an empty cache directory."""
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.directory = directory.name
+
+	def add(self, cache, key, size):
+		"""Store an entry of a given size in the cache."""
+		temp_file, temp_path = cache.create_temp_file()
+		with temp_file:
+			temp_file.write(b'\0' * size)
+		cache.store(key, temp_path)
+
+	def test_lookup(self):
+		"""Stored entries can be found, and are opened from the cache directory."""
+		cache = FileCache(self.directory, 1000, 1)
+		self.add(cache, 'a', 100)
+		self.assertEqual(cache.lookup('a'), os.path.join(self.directory, 'a'))
+		self.assertIsNone(cache.lookup('b'))
+		with cache.open('a') as cached:
+			self.assertEqual(len(cached.read()), 100)
+
+	def test_evicts_used_once_first(self):
+		"""Entries used only once are evicted before those used repeatedly, oldest first."""
+		cache = FileCache(self.directory, 1000, 1)
+		for key in ('a', 'b', 'c'):
+			self.add(cache, key, 300)
+		cache.lookup('a')
+		self.add(cache, 'd', 300)
+		self.assertEqual(sorted(os.listdir(self.directory)), ['a', 'c', 'd'])
+		self.add(cache, 'e', 300)
+		self.assertEqual(sorted(os.listdir(self.directory)), ['a', 'd', 'e'])
+
+	def test_too_large(self):
+		"""Entries larger than the whole cache aren't stored."""
+		cache = FileCache(self.directory, 1000, 1)
+		self.add(cache, 'a', 1001)
+		self.assertEqual(os.listdir(self.directory), [])
+
+	def test_shared_directory(self):
+		"""Entries stored by another cache sharing the directory count towards the limit."""
+		first = FileCache(self.directory, 1000, 1)
+		second = FileCache(self.directory, 1000, 1)
+		for key in ('a', 'b', 'c'):
+			self.add(first, key, 300)
+		self.add(second, 'd', 300)
+		self.assertEqual(sorted(os.listdir(self.directory)), ['b', 'c', 'd'])
+		self.add(first, 'e', 300)
+		self.assertEqual(sorted(os.listdir(self.directory)), ['c', 'd', 'e'])
+
+	def test_reload(self):
+		"""A new cache picks up the entries already in its directory, and evicts down to its limit."""
+		cache = FileCache(self.directory, 1000, 1)
+		for key in ('a', 'b', 'c'):
+			self.add(cache, key, 300)
+		reloaded = FileCache(self.directory, 700, 1)
+		self.assertEqual(sorted(os.listdir(self.directory)), ['b', 'c'])
+		self.assertEqual(reloaded.lookup('c'), os.path.join(self.directory, 'c'))
+
+	def test_abandoned_temporary_entries(self):
+		"""Temporary entries of processes that have died are deleted, while those still being written are kept."""
+		cache = FileCache(self.directory, 1000, 1)
+		writing, writing_path = cache.create_temp_file()
+		self.addCleanup(writing.close)
+		# Process ids are never larger than 2**22 on Linux.
+		abandoned_path = os.path.join(self.directory, f'.{2**22 + 1}-abandoned')
+		open(abandoned_path, 'wb').close()
+		FileCache(self.directory, 1000, 1)
+		self.assertTrue(os.path.exists(writing_path))
+		self.assertFalse(os.path.exists(abandoned_path))
+
+
+@needs_settings
+class TestActiveStreams(TestCase):
+	"""Test suite for counting the audio streams served by every process."""
+
+	def setUp(self):
+		"""Create an empty folder for the counts."""
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.folder = directory.name
+
+	def test_total(self):
+		"""Streams opened by a process are counted by others, without rewriting its file."""
+		streams = ActiveStreams(self.folder)
+		reader = ActiveStreams(self.folder, refresh_interval=0)
+		streams.opened()
+		path = os.path.join(self.folder, str(os.getpid()))
+		inode = os.stat(path).st_ino
+		streams.opened()
+		self.assertEqual(reader.total(), 2)
+		streams.closed()
+		self.assertEqual(reader.total(), 1)
+		self.assertEqual(os.stat(path).st_ino, inode)
+
+	def test_dead_process(self):
+		"""Counts left behind by processes that died are removed."""
+		path = os.path.join(self.folder, '999999999')
+		with open(path, 'wb') as count_file:
+			count_file.write(bytes(8))
+		self.assertEqual(ActiveStreams(self.folder).total(), 0)
+		self.assertFalse(os.path.exists(path))
+
+
+@needs_settings
+class TestTranscodeStream(TestCase):
+	"""Test suite for streaming the output of ffmpeg into the rendition cache."""
+
+	def setUp(self):
+		"""Create an empty cache, and take a transcoding slot."""
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.cache = FileCache(directory.name, 100000, 1)
+		self.slots = threading.BoundedSemaphore(1)
+		self.slots.acquire()
+		self.streams = mock.Mock()
+
+	def stream(self):
+		"""Start a process standing in for ffmpeg, which writes 10000 bytes."""
+		process = subprocess.Popen([sys.executable, '-c', 'import sys; sys.stdout.buffer.write(bytes(10000))'],
+		                           stdout=subprocess.PIPE)
+		return TranscodeStream(process, self.cache, 'key', self.slots, streams=self.streams)
+
+	def assertReleased(self):
+		"""Check that the slot and the active stream were given back."""
+		self.assertTrue(self.slots.acquire(blocking=False))
+		self.streams.opened.assert_called_once_with()
+		self.streams.closed.assert_called_once_with()
+
+	def test_sent_in_full(self):
+		"""Output sent in full is stored in the cache."""
+		stream = self.stream()
+		self.assertEqual(len(b''.join(stream)), 10000)
+		stream.close()
+		self.assertEqual(os.path.getsize(self.cache.lookup('key')), 10000)
+		self.assertReleased()
+
+	def test_closed_before_reading(self):
+		"""A stream closed before its first chunk was read stops the process, and stores nothing."""
+		stream = self.stream()
+		stream.close()
+		self.assertIsNotNone(stream.process.returncode)
+		self.assertIsNone(self.cache.lookup('key'))
+		self.assertEqual(os.listdir(self.cache.directory), [])
+		self.assertReleased()
+
+
+# MPEG 1 Layer III frames at 128 kbit/s and 44.1 kHz, each holding 1152 samples.
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0x00])
+FRAME_LENGTH = 417
+FRAME_SECONDS = 1152 / 44100
+
+
+def make_mp3(seconds, tag_size=100):
+	"""Build the bytes of an MP3 file of silent frames, after an ID3v2 tag, and followed by an ID3v1 tag."""
+	tag = b'ID3\x03\x00\x00' + bytes([0, 0, 0, tag_size]) + b'\0' * tag_size
+	frames = int(seconds / FRAME_SECONDS) + 1
+	return tag + (FRAME_HEADER + b'\0' * (FRAME_LENGTH - 4)) * frames + b'TAG' + b'\0' * 125
+
+
+class TestSeekIndex(TestCase):
+	"""Test suite for the seek indexes of MP3 tracks."""
+
+	def test_parse_frame_header(self):
+		"""Frame lengths include their padding byte, and invalid headers aren't frames."""
+		self.assertEqual(parse_frame_header(FRAME_HEADER), (FRAME_LENGTH, 1152, 44100))
+		self.assertEqual(parse_frame_header(bytes([0xFF, 0xFB, 0x92, 0x00])), (FRAME_LENGTH + 1, 1152, 44100))
+		# MPEG 2 Layer III frames hold half as many samples, and have their own bitrates.
+		self.assertEqual(parse_frame_header(bytes([0xFF, 0xF3, 0x90, 0x00])), (261, 576, 22050))
+		# No frame sync, a reserved version, a free-format bitrate and a reserved sample rate.
+		for header in (b'TAG\0', bytes([0xFF, 0xEB, 0x90, 0x00]), bytes([0xFF, 0xFB, 0x00, 0x00]),
+		               bytes([0xFF, 0xFB, 0x9C, 0x00])):
+			self.assertIsNone(parse_frame_header(header))
+
+	def test_offsets(self):
+		"""Each second maps to the first frame starting at or after it, past the ID3v2 tag."""
+		builder = SeekIndexBuilder()
+		builder.feed(make_mp3(5))
+		# The last frame starts just before 5 seconds into the track.
+		self.assertEqual(len(builder.offsets), 5)
+		self.assertEqual(builder.offsets[0], 110)
+		for second in range(1, 5):
+			frame = -(-second // FRAME_SECONDS)
+			self.assertEqual(builder.offsets[second], 110 + int(frame) * FRAME_LENGTH)
+
+	def test_chunks(self):
+		"""The index is the same whatever size of chunks the track is fed in."""
+		track = make_mp3(5, tag_size=120)
+		whole = SeekIndexBuilder()
+		whole.feed(track)
+		for chunk_size in (1, 7, 416, 4096):
+			builder = SeekIndexBuilder()
+			for start in range(0, len(track), chunk_size):
+				builder.feed(track[start:start + chunk_size])
+			self.assertEqual(builder.pack(), whole.pack())
+
+	def test_seek_offset(self):
+		"""Offsets are looked up in the packed index, and times outside the track are refused."""
+		builder = SeekIndexBuilder()
+		builder.feed(make_mp3(5))
+		packed = builder.pack()
+		self.assertEqual(seek_offset(packed, 0), 110)
+		self.assertEqual(seek_offset(packed, 3), builder.offsets[3])
+		for seconds in (-1, 5, 600):
+			with self.assertRaises(SeekOutOfRange):
+				seek_offset(packed, seconds)
+
+	def test_no_frames(self):
+		"""Files without any frames have no index."""
+		builder = SeekIndexBuilder()
+		builder.feed(b'ID3\x03\x00\x00\x00\x00\x00\x10' + b'\0' * 16 + b'not audio' * 50)
+		self.assertIsNone(builder.pack())
+
+
+@needs_settings
+class TestAudioPayload(TestCase):
+	"""Test suite for finding the audio of a track file, which is what its fingerprint is made from."""
+
+	def setUp(self):
+		"""Create a directory for the track files."""
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.directory = directory.name
+
+	def payload(self, data, codec):
+		"""Write a track file, and find its audio."""
+		path = os.path.join(self.directory, 'track')
+		with open(path, 'wb') as track:
+			track.write(data)
+		with ScanFile(path, budget=None) as track_file:
+			return audio_payload(track_file, codec)
+
+	def fingerprint(self, data, codec):
+		"""Write a track file, and fingerprint its audio."""
+		builder = FingerprintBuilder(*self.payload(data, codec))
+		builder.feed(data)
+		return builder.fingerprint()
+
+	def test_mp3(self):
+		"""MP3 audio lies between the ID3v2 tag and the ID3v1 tag."""
+		data = make_mp3(1)
+		self.assertEqual(self.payload(data, 'mp3'), (110, len(data) - 128, None))
+
+	def test_ape_tag(self):
+		"""APEv2 tags at the end of a file, with their header, are left out."""
+		audio = FRAME_HEADER + b'\0' * (FRAME_LENGTH - 4)
+		items = b'\0' * 40
+		footer = b'APETAGEX' + struct.pack('<III', 2000, len(items) + 32, 1) + struct.pack('<I', 0x80000000) + b'\0' * 8
+		data = audio + footer + items + footer
+		self.assertEqual(self.payload(data, 'mp3'), (0, len(audio), None))
+
+	def test_wav(self):
+		"""WAV audio is the data chunk, whatever chunks come before it."""
+		samples = b'\1\2' * 100
+		chunks = b'fmt ' + struct.pack('<I', 16) + b'\0' * 16 + b'LIST' + struct.pack('<I', 5) + b'\0' * 6
+		chunks += b'data' + struct.pack('<I', len(samples)) + samples
+		data = b'RIFF' + struct.pack('<I', len(chunks) + 4) + b'WAVE' + chunks
+		start, end, _ = self.payload(data, 'pcm')
+		self.assertEqual(data[start:end], samples)
+
+	def test_mp4(self):
+		"""MP4 audio is the mdat box, whatever boxes come before it."""
+		frames = b'\3' * 300
+		data = struct.pack('>I', 16) + b'ftypM4A \0\0\0\0'
+		data += struct.pack('>I', 24) + b'moov' + b'\0' * 16
+		data += struct.pack('>I', len(frames) + 8) + b'mdat' + frames
+		start, end, _ = self.payload(data, 'aac')
+		self.assertEqual(data[start:end], frames)
+
+	def test_flac(self):
+		"""FLAC audio follows the last metadata block."""
+		frames = b'\4' * 300
+		streaminfo = bytes([0x00, 0, 0, 34]) + b'\0' * 34
+		comment = bytes([0x84, 0, 0, 10]) + b'\0' * 10
+		data = b'fLaC' + streaminfo + comment + frames
+		start, end, _ = self.payload(data, 'flac')
+		self.assertEqual(data[start:end], frames)
+
+	def test_ogg(self):
+		"""Ogg streams are passed on whole, with the number of header packets to skip for known codecs."""
+		data = b'OggS' + b'\0' * 200
+		self.assertEqual(self.payload(data, 'vorbis'), (0, len(data), OGG_HEADER_PACKETS['vorbis']))
+		self.assertEqual(self.payload(data, 'speex'), (0, len(data), None))
+
+	def test_retagged(self):
+		"""Retagging a track doesn't change its fingerprint, while changing its audio does."""
+		data = make_mp3(1)
+		retagged = make_mp3(1, tag_size=120)[:-125] + b'Retagged' + b'\0' * 117
+		self.assertEqual(self.fingerprint(data, 'mp3'), self.fingerprint(retagged, 'mp3'))
+		changed = data[:500] + b'\1' + data[501:]
+		self.assertNotEqual(self.fingerprint(data, 'mp3'), self.fingerprint(changed, 'mp3'))
+
+
+@needs_settings
+class TestLibraryScan(TestCase):
+	"""Test suite for reconciling the files seen by a scan with the tracks in the database."""
+
+	def setUp(self):
+		"""Create an empty database, and an empty music folder."""
+		use_test_database(self)
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.folder = directory.name
+
+	def write_track(self, name, title, seconds=1):
+		"""Write an MP3 file with a title to the music folder."""
+		path = os.path.join(self.folder, name)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, 'wb') as track:
+			track.write(make_mp3(seconds))
+		tags = EasyID3(path)
+		tags['title'] = title
+		tags.save()
+		return path
+
+	def scan(self):
+		"""Scan the whole music folder."""
+		scan = LibraryScan(folders=[self.folder])
+		scan.scan_folder(self.folder)
+		return scan.finish()
+
+	def tracks(self):
+		"""List the id, path, title and missing flag of every track."""
+		with util.util.access_db() as db_conn:
+			return sorted((song.id, song.track_path, song.track_name, song.file_missing) for song in db_conn.query(Song))
+
+	def test_added(self):
+		"""New files are added as new tracks, and scanning them again changes nothing."""
+		first = self.write_track('one/a.mp3', 'A')
+		second = self.write_track('one/b.mp3', 'B', seconds=2)
+		self.assertEqual(self.scan(), {'added': 2, 'relinked': 0, 'missing': 0})
+		self.assertEqual(self.tracks(), [(1, first, 'A', False), (2, second, 'B', False)])
+		self.assertEqual(self.scan(), {'added': 0, 'relinked': 0, 'missing': 0})
+
+	def test_retagged(self):
+		"""Retagged tracks keep their id, and take their new tags."""
+		path = self.write_track('one/a.mp3', 'A')
+		self.scan()
+		tags = EasyID3(path)
+		tags['title'] = 'Renamed'
+		tags.save()
+		self.assertEqual(self.scan(), {'added': 0, 'relinked': 0, 'missing': 0})
+		self.assertEqual(self.tracks(), [(1, path, 'Renamed', False)])
+
+	def test_moved_and_retagged(self):
+		"""A track that was moved and retagged at once is relinked by its audio, and keeps its place in playlists."""
+		path = self.write_track('one/a.mp3', 'A')
+		self.scan()
+		create_new_playlist('Playlist', uuid.uuid4(), 'owner')
+		add_song_to_playlist(1, 1)
+
+		moved = os.path.join(self.folder, 'two', 'b.mp3')
+		os.makedirs(os.path.dirname(moved))
+		shutil.move(path, moved)
+		tags = EasyID3(moved)
+		tags['title'] = 'Moved'
+		tags.save()
+		self.assertEqual(self.scan(), {'added': 0, 'relinked': 1, 'missing': 1})
+		self.assertEqual(self.tracks(), [(1, moved, 'Moved', False)])
+		self.assertEqual([track['id'] for track in get_playlist_data_from_id(1)['tracks']], [1])
+
+	def test_replaced(self):
+		"""A file replaced in place has everything computed from its contents computed again, and its legacy hash cleared."""
+		path = self.write_track('one/a.mp3', 'A')
+		self.scan()
+		with util.util.access_db() as db_conn:
+			db_conn.query(Song).update({Song.track_hash: file_hash(path)})
+			db_conn.commit()
+			before = db_conn.query(Song.audio_fingerprint, Song.seek_index).one()
+		self.write_track('one/a.mp3', 'A', seconds=3)
+		self.assertEqual(self.scan(), {'added': 0, 'relinked': 0, 'missing': 0})
+		with util.util.access_db() as db_conn:
+			song = db_conn.query(Song).one()
+			self.assertEqual((song.file_size, song.file_mtime), (os.path.getsize(path), os.stat(path).st_mtime_ns))
+			self.assertIsNone(song.track_hash)
+			for column, value in before._asdict().items():
+				self.assertNotEqual(getattr(song, column), value)
+
+	def test_content_key(self):
+		"""New tracks aren't hashed, and their content key changes when they are retagged."""
+		path = self.write_track('one/a.mp3', 'A')
+		self.scan()
+		with util.util.access_db() as db_conn:
+			self.assertIsNone(db_conn.query(Song.track_hash).scalar())
+		before = fetch_track_content_key(1)
+		self.assertTrue(before)
+		tags = EasyID3(path)
+		tags['title'] = 'Renamed'
+		tags.save()
+		self.scan()
+		self.assertNotIn(fetch_track_content_key(1), (None, before))
+
+	def test_relinked_by_hash(self):
+		"""Tracks stored before they were fingerprinted are relinked by their legacy hash."""
+		path = self.write_track('one/a.mp3', 'A')
+		self.scan()
+		with util.util.access_db() as db_conn:
+			db_conn.query(Song).update({Song.audio_fingerprint: None, Song.track_hash: file_hash(path)})
+			db_conn.commit()
+		moved = os.path.join(self.folder, 'b.mp3')
+		shutil.move(path, moved)
+		self.assertEqual(self.scan(), {'added': 0, 'relinked': 1, 'missing': 1})
+		self.assertEqual(self.tracks(), [(1, moved, 'A', False)])
+
+	def test_missing(self):
+		"""Tracks whose files are gone are marked missing, and are found again when they come back."""
+		path = self.write_track('one/a.mp3', 'A')
+		self.scan()
+		with open(path, 'rb') as track:
+			data = track.read()
+		os.remove(path)
+		self.assertEqual(self.scan(), {'added': 0, 'relinked': 0, 'missing': 1})
+		self.assertEqual(self.tracks(), [(1, path, 'A', True)])
+		with open(path, 'wb') as track:
+			track.write(data)
+		self.assertEqual(self.scan(), {'added': 0, 'relinked': 0, 'missing': 0})
+		self.assertEqual(self.tracks(), [(1, path, 'A', False)])
+
+	def test_different_audio(self):
+		"""A new file whose audio differs from a missing track's is added as a new track."""
+		path = self.write_track('one/a.mp3', 'A')
+		self.scan()
+		os.remove(path)
+		other = self.write_track('two/a.mp3', 'A', seconds=2)
+		self.assertEqual(self.scan(), {'added': 1, 'relinked': 0, 'missing': 1})
+		self.assertEqual(self.tracks(), [(1, path, 'A', True), (2, other, 'A', False)])
+
+	def test_merge_duplicates(self):
+		"""Tracks stored twice under the same path are merged into the oldest, which takes their place in playlists."""
+		path = self.write_track('one/a.mp3', 'A')
+		self.scan()
+		create_new_playlist('Playlist', uuid.uuid4(), 'owner')
+		with util.util.access_db() as db_conn:
+			# Tracks were stored twice before track paths had to be unique.
+			db_conn.execute('DROP INDEX ix_song_track_path')
+			db_conn.add(Song(track_name='A', track_path=path))
+			db_conn.commit()
+		add_song_to_playlist(1, 2)
+		self.assertEqual(merge_duplicate_tracks(), 1)
+		self.assertEqual(self.tracks(), [(1, path, 'A', False)])
+		self.assertEqual([track['id'] for track in get_playlist_data_from_id(1)['tracks']], [1])
+
+
+@needs_settings
+class TestLibraryWatcher(TestCase):
+	"""Test suite for ingesting the changes the library watcher sees."""
+
+	def setUp(self):
+		"""Create an empty database, and a watcher that records what it ingests."""
+		use_test_database(self)
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.ingested = []
+		# Changes are passed to the watcher by the tests, rather than found by polling.
+		self.watcher = PollingWatcher(directory.name, ingest=self.ingest, debounce=0)
+
+	def ingest(self, paths, progress):
+		"""Record the paths that were ingested."""
+		self.ingested.append(sorted(paths))
+		return {'added': len(paths), 'relinked': 0, 'missing': 0}
+
+	def test_ingest(self):
+		"""Settled paths are ingested by a job of their own, which doesn't delay the next refresh."""
+		self.watcher.changed('/music/a.mp3')
+		self.watcher.flush()
+		self.assertEqual(self.ingested, [['/music/a.mp3']])
+		status = fetch_refresh_status()
+		self.assertEqual((status['state'], status['added']), ('finished', 1))
+		with mock.patch('music.jobs.REFRESH_INTERVAL', 3600):
+			self.assertIsNotNone(start_refresh_job())
+
+	def test_refresh_running(self):
+		"""Paths are kept while a refresh holds the lock, and ingested once it releases it."""
+		job_id = start_refresh_job(force=True)
+		self.watcher.changed('/music/a.mp3')
+		self.watcher.flush()
+		self.assertEqual(self.ingested, [])
+		RefreshProgress(job_id).finish('finished')
+		self.watcher.flush()
+		self.assertEqual(self.ingested, [['/music/a.mp3']])
+
+
+@needs_settings
+class TestRefreshJobs(TestCase):
+	"""Test suite for the lock that keeps refreshes from overlapping, and the jobs holding it."""
+
+	def setUp(self):
+		"""Create an empty database."""
+		use_test_database(self)
+
+	def test_lock(self):
+		"""Only one refresh holds the lock at a time, and it is released when the refresh finishes."""
+		job_id = start_refresh_job(force=True)
+		self.assertIsNotNone(job_id)
+		self.assertIsNone(start_refresh_job(force=True))
+		RefreshProgress(job_id).finish('finished', {'added': 1, 'relinked': 0, 'missing': 2})
+		status = fetch_refresh_status(job_id)
+		self.assertEqual((status['state'], status['added'], status['missing']), ('finished', 1, 2))
+		self.assertNotIn(start_refresh_job(force=True), (None, job_id))
+
+	def test_interval(self):
+		"""Refreshes that aren't forced don't start again within REFRESH_INTERVAL seconds."""
+		job_id = start_refresh_job()
+		RefreshProgress(job_id).finish('finished')
+		with mock.patch('music.jobs.REFRESH_INTERVAL', 3600):
+			self.assertIsNone(start_refresh_job())
+		with mock.patch('music.jobs.REFRESH_INTERVAL', 0):
+			self.assertIsNotNone(start_refresh_job())
+
+	def test_stale_lock(self):
+		"""A lock whose job stopped reporting progress is taken over, and its job is told so."""
+		job_id = start_refresh_job(force=True)
+		progress = RefreshProgress(job_id)
+		progress.report()
+		with util.util.access_db() as db_conn:
+			db_conn.query(RefreshState).update({RefreshState.heartbeat: datetime.datetime(2000, 1, 1)})
+			db_conn.commit()
+		new_job_id = start_refresh_job(force=True)
+		self.assertIsNotNone(new_job_id)
+		status = fetch_refresh_status(job_id)
+		self.assertEqual((status['state'], status['error']), ('failed', 'Stopped responding.'))
+		with self.assertRaises(RefreshCancelled):
+			progress.report()
+		# The old job finishing doesn't release the lock of the new one.
+		progress.finish('cancelled')
+		self.assertIsNone(start_refresh_job(force=True))
+
+	def test_heartbeat(self):
+		"""The lock's heartbeat is renewed while a job runs without reporting progress, and no longer once it finishes."""
+		job_id = start_refresh_job(force=True)
+		stale = datetime.datetime(2000, 1, 1)
+		with util.util.access_db() as db_conn:
+			db_conn.query(RefreshState).update({RefreshState.heartbeat: stale})
+			db_conn.commit()
+		progress = RefreshProgress(job_id, heartbeat_interval=0.01)
+		for _ in range(100):
+			with util.util.access_db() as db_conn:
+				if db_conn.query(RefreshState.heartbeat).scalar() > stale:
+					break
+			time.sleep(0.01)
+		self.assertIsNone(start_refresh_job(force=True))
+		progress.finish('finished')
+		self.assertFalse(progress._heartbeat.is_alive())
+
+	def test_cancel(self):
+		"""A cancelled job stops the next time it reports its progress."""
+		job_id = start_refresh_job(force=True)
+		progress = RefreshProgress(job_id, interval=0)
+		progress.phase('reading', files_total=10)
+		self.assertTrue(cancel_refresh_job())
+		with self.assertRaises(RefreshCancelled):
+			progress.advance()
+		progress.finish('cancelled')
+		self.assertFalse(cancel_refresh_job())
+		self.assertEqual(fetch_refresh_status()['state'], 'cancelled')
+
+
+@needs_settings
+class TestReadReplicas(TestCase):
+	"""Test suite for which queries may be answered by a read replica."""
+
+	def setUp(self):
+		"""Create an empty database, and a replica that hasn't caught up with any of its writes."""
+		use_test_database(self)
+		replica = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+		Base.metadata.create_all(replica)
+		patcher = mock.patch.object(util.util, 'ReadSessions', [sessionmaker(bind=replica)])
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_listing(self):
+		"""Listing endpoints read from the replica."""
+		owner = uuid.uuid4()
+		create_new_playlist('Playlist', owner, 'owner')
+		self.assertEqual(get_playlists_owned_by_user(owner), {'playlists': []})
+
+	def test_reads_before_writes(self):
+		"""Permission checks and scans read from the main database."""
+		owner = uuid.uuid4()
+		create_new_playlist('Playlist', owner, 'owner')
+		self.assertTrue(owns_playlist(1, owner))
+		with util.util.access_db() as db_conn:
+			db_conn.add(Song(track_name='A', track_path='/music/a.mp3'))
+			db_conn.commit()
+		self.assertEqual(list(fetch_known_tracks(paths=['/music/a.mp3'])), ['/music/a.mp3'])
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: tests/test_users.py
+"""Test suite for user utilities."""
+
+# Native python imports
+import datetime, os, tempfile, time, uuid
+from unittest import TestCase, mock, skipIf
+
+# Pip library imports
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+# Local imports
+# The user utilities read their configuration from local_settings.py, see wizard.py.
+try:
+	import local_settings
+except ImportError:
+	local_settings = None
+else:
+	from users.util import PASSWORD_HASHERS, PBKDF2Hasher, ScryptHasher
+	from users.util import register_password_hasher, get_password_hasher, default_password_hasher
+	from users.util import check_password, password_needs_rehash, create_storable_password
+	from users.util import create_storable_hash, generate_salt
+	from users.util import SlidingWindowLimiter, LoginAttemptLog
+	from users.util import JWTKeyring, SessionUser, create_session_token, decode_session_token, session_user_from_token
+	from util.models import Base
+	import users.util, util.util
+
+needs_settings = skipIf(local_settings is None, 'Needs a local_settings.py file, created with wizard.py.')
+
+
+def use_test_database(testcase):
+	"""Point every database session at an empty in-memory database until the test is over."""
+	test_engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+	Base.metadata.create_all(test_engine)
+	util.util.Session.configure(bind=test_engine)
+	testcase.addCleanup(util.util.Session.configure, bind=util.util.engine)
+	patcher = mock.patch.object(util.util, 'ReadSessions', [])
+	patcher.start()
+	testcase.addCleanup(patcher.stop)
+
+
+def storable_hash(hasher, password, salt=None):
+	"""Hash a password with a specific hasher, in the format it is stored in."""
+	salt = salt or generate_salt()
+	return create_storable_hash(hasher.name, hasher.params, salt, hasher.hash(password.encode('utf-8'), salt))
+
+
+class ReversedHasher:
+	"""Hasher that isn't registered by default, used to test the registry."""
+
+	name = 'reversed'
+	params = ''
+
+	@classmethod
+	def from_params(cls, name, params):
+		"""Create a hasher from the information stored alongside a hash."""
+		return cls()
+
+	def hash(self, password, salt):
+		"""Hash a password, if only nominally."""
+		return bytes(reversed(salt + password))
+
+
+@needs_settings
+class TestPasswordHashers(TestCase):
+	"""Test suite for the password hasher registry, and rehashing."""
+
+	def test_registered_hashers(self):
+		"""Stored algorithm names map to the hasher able to repeat them."""
+		self.assertIs(PASSWORD_HASHERS['scrypt'], ScryptHasher)
+		for digest in ('sha1', 'sha256', 'sha512'):
+			self.assertIs(PASSWORD_HASHERS[digest], PBKDF2Hasher)
+
+	def test_get_password_hasher(self):
+		"""Hashers are configured with the stored cost parameters."""
+		hasher = get_password_hasher('sha256', '1000')
+		self.assertIsInstance(hasher, PBKDF2Hasher)
+		self.assertEqual((hasher.name, hasher.iterations), ('sha256', 1000))
+		hasher = get_password_hasher('scrypt', '1024:8:1')
+		self.assertEqual((hasher.n, hasher.r, hasher.p), (1024, 8, 1))
+		self.assertEqual(hasher.params, '1024:8:1')
+
+	def test_unknown_algorithm(self):
+		"""An unknown algorithm can't be looked up, and never matches a password."""
+		with self.assertRaises(ValueError):
+			get_password_hasher('argon9', '')
+		stored = storable_hash(ReversedHasher(), 'password')
+		self.assertFalse(check_password('password', stored))
+
+	def test_register_password_hasher(self):
+		"""Registered hashers are used to check the hashes stored with their name."""
+		register_password_hasher(ReversedHasher.name, ReversedHasher)
+		self.addCleanup(PASSWORD_HASHERS.pop, ReversedHasher.name, None)
+		stored = storable_hash(ReversedHasher(), 'password')
+		self.assertTrue(check_password('password', stored))
+		self.assertFalse(check_password('wrong', stored))
+
+	def test_check_password(self):
+		"""Hashes made with other settings than the current ones can still be checked."""
+		for hasher in (PBKDF2Hasher('sha1', 1000), PBKDF2Hasher('sha512', 1000), ScryptHasher(1024, 8, 1)):
+			stored = storable_hash(hasher, 'password')
+			self.assertTrue(check_password('password', stored))
+			self.assertFalse(check_password('wrong', stored))
+
+	def test_unreadable_hash(self):
+		"""A corrupt stored hash never matches a password."""
+		self.assertFalse(check_password('password', 'not a hash'))
+
+	def test_password_needs_rehash(self):
+		"""Only hashes made with other settings than the current ones need rehashing."""
+		self.assertFalse(password_needs_rehash(create_storable_password('password')))
+		current = default_password_hasher()
+		for hasher in (PBKDF2Hasher('sha1', 1000), PBKDF2Hasher('sha256', 1000), ScryptHasher(1024, 8, 1)):
+			if (hasher.name, hasher.params) != (current.name, current.params):
+				self.assertTrue(password_needs_rehash(storable_hash(hasher, 'password')))
+
+
+@needs_settings
+class TestSlidingWindowLimiter(TestCase):
+	"""Test suite for the in-memory login limiter."""
+
+	def test_limit(self):
+		"""A key is only limited once it has more events than the limit."""
+		limiter = SlidingWindowLimiter(3, 60)
+		for _ in range(3):
+			limiter.record('a@b.co')
+		self.assertFalse(limiter.exceeded('a@b.co'))
+		limiter.record('a@b.co')
+		self.assertTrue(limiter.exceeded('a@b.co'))
+
+	def test_keys_are_separate(self):
+		"""Events for one key don't count towards another."""
+		limiter = SlidingWindowLimiter(1, 60)
+		limiter.record('a@b.co')
+		limiter.record('a@b.co')
+		self.assertTrue(limiter.exceeded('a@b.co'))
+		self.assertFalse(limiter.exceeded('c@d.co'))
+
+	def test_window(self):
+		"""Events that have left the window don't count."""
+		limiter = SlidingWindowLimiter(1, 60)
+		limiter.record('a@b.co', time.time() - 120)
+		limiter.record('a@b.co', time.time() - 90)
+		limiter.record('a@b.co')
+		self.assertFalse(limiter.exceeded('a@b.co'))
+		limiter.record('a@b.co')
+		self.assertTrue(limiter.exceeded('a@b.co'))
+
+	def test_purge(self):
+		"""Keys whose events have all left the window are forgotten."""
+		limiter = SlidingWindowLimiter(1, 60)
+		limiter.record('a@b.co', time.time() - 120)
+		limiter._next_purge = 0
+		limiter.record('c@d.co')
+		self.assertEqual(set(limiter._events), {'c@d.co'})
+
+
+@needs_settings
+class TestLoginAttemptLog(TestCase):
+	"""Test suite for sharing failed logins between API processes through the database."""
+
+	def setUp(self):
+		"""Create an empty database, and empty login limiters."""
+		use_test_database(self)
+		for name in ('email_login_limiter', 'ip_login_limiter'):
+			patcher = mock.patch.object(users.util, name, SlidingWindowLimiter(1, 60))
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def fail(self, log, email):
+		"""Queue a failed login attempt."""
+		log.add(email, False, '10.0.0.1', datetime.datetime.now())
+
+	def test_batched(self):
+		"""Attempts are only written when the batch is flushed."""
+		log = LoginAttemptLog('here:1')
+		self.fail(log, 'a@b.co')
+		self.assertEqual(log._pending[0]['origin'], 'here:1')
+		log.flush()
+		self.assertEqual(log._pending, [])
+		with util.util.access_db() as db_conn:
+			self.assertEqual(db_conn.query(users.util.LoginAttempt).count(), 1)
+
+	def test_sync(self):
+		"""Failed attempts written by other processes are recorded once, and a process's own are skipped."""
+		here, there = LoginAttemptLog('here:1'), LoginAttemptLog('there:2')
+		here._last_synced_id = 0
+		self.fail(here, 'a@b.co')
+		self.fail(there, 'c@d.co')
+		self.fail(there, 'c@d.co')
+		here.flush()
+		there._write(there._pending)
+		here.sync()
+		here.sync()
+		self.assertEqual(set(users.util.email_login_limiter._events), {'c@d.co'})
+		self.assertTrue(users.util.email_login_limiter.exceeded('c@d.co'))
+		self.assertEqual(len(users.util.ip_login_limiter._events['10.0.0.1']), 2)
+
+
+@needs_settings
+class TestJWTKeyring(TestCase):
+	"""Test suite for the keys session tokens are signed with, and their rotation."""
+
+	def setUp(self):
+		"""Create an empty key directory, shared by two keyrings standing in for two processes."""
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		key_file, retired_key_dir = os.path.join(directory.name, '.key'), os.path.join(directory.name, '.retired_keys')
+		self.rotating = JWTKeyring(key_file, retired_key_dir)
+		self.other = JWTKeyring(key_file, retired_key_dir)
+		# Only keys with unknown ids make the other keyring check for changes.
+		patcher = mock.patch('users.util.JWT_KEY_RELOAD_INTERVAL', 3600)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_shared_key(self):
+		"""Every process signs with the same key, which is generated by the first one."""
+		kid, key = self.rotating.current()
+		self.assertEqual(len(key), JWTKeyring.key_size)
+		self.assertEqual(self.other.current(), (kid, key))
+
+	def test_rotation(self):
+		"""Keys rotated in by another process are accepted right away, and the retired key still is."""
+		old_kid, old_key = self.rotating.current()
+		self.other.current()
+		new_kid = self.rotating.rotate()
+		self.assertNotEqual(new_kid, old_kid)
+		self.assertEqual(self.other.get(new_kid), self.rotating.current()[1])
+		self.assertEqual(self.other.get(old_kid), old_key)
+		self.assertEqual(self.other.current()[0], new_kid)
+
+	def test_unknown_key_checks_are_limited(self):
+		"""Unknown key ids only make the keyring check for changes once every miss_check_interval seconds."""
+		self.other.current()
+		self.assertIsNone(self.other.get('made-up'))
+		new_kid = self.rotating.rotate()
+		self.assertIsNone(self.other.get(new_kid))
+		self.other._next_miss_check = 0
+		self.assertIsNotNone(self.other.get(new_kid))
+
+	def test_retired_keys_pruned(self):
+		"""Only the most recently retired keys are accepted."""
+		kids = [self.rotating.current()[0]]
+		with mock.patch('users.util.JWT_RETIRED_KEYS_ACCEPTED', 1):
+			for _ in range(2):
+				kids.append(self.rotating.rotate())
+		self.assertIsNone(self.rotating.get(kids[0]))
+		self.assertIsNotNone(self.rotating.get(kids[1]))
+
+
+@needs_settings
+class TestSessionTokens(TestCase):
+	"""Test suite for creating session tokens, and checking them without the database."""
+
+	def setUp(self):
+		"""Sign tokens with a fresh keyring, and make up the invalidation epochs of users."""
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.keyring = JWTKeyring(os.path.join(directory.name, '.key'), os.path.join(directory.name, '.retired_keys'))
+		self.epochs = {}
+		for name, value in (('jwt_keyring', self.keyring), ('revocation_table', self.epochs)):
+			patcher = mock.patch.object(users.util, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+		self.user = mock.Mock(guid=uuid.uuid4(), username='alice', admin=True, last_invalidated=None)
+		self.epochs[self.user.guid] = 0
+
+	def test_round_trip(self):
+		"""Tokens carry the user, and are checked without looking the user up."""
+		details = decode_session_token(create_session_token(self.user))
+		self.assertEqual(session_user_from_token(details), SessionUser(self.user.guid, 'alice', True))
+
+	def test_tampered(self):
+		"""Tokens whose signature doesn't match aren't accepted."""
+		token = create_session_token(self.user)
+		header, payload, signature = token.split('.')
+		self.assertIsNone(decode_session_token('.'.join((header, payload, signature[::-1]))))
+
+	def test_rotated_key(self):
+		"""Tokens signed with a retired key are still accepted."""
+		token = create_session_token(self.user)
+		self.keyring.rotate()
+		self.assertIsNotNone(decode_session_token(token))
+
+	def test_invalidated(self):
+		"""Tokens issued before the user's sessions were invalidated, or for removed users, aren't accepted."""
+		details = decode_session_token(create_session_token(self.user))
+		self.epochs[self.user.guid] = int(time.time() * 1000)
+		self.assertIsNone(session_user_from_token(details))
+		del self.epochs[self.user.guid]
+		self.assertIsNone(session_user_from_token(details))
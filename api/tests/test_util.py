@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Filename: tests/test_util.py
+"""Test suite for general utilities."""
+
+# Native python imports
+import uuid
+from unittest import TestCase, skipIf
+
+# Pip library imports
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+# Local imports
+# The utilities read their configuration from local_settings.py, see wizard.py.
+try:
+	import local_settings
+except ImportError:
+	local_settings = None
+else:
+	from music.models import Playlist
+	from users.models import User
+	from util.models import Base, BINARY_GUIDS_MIGRATION, migrate_guid_columns, migration_completed
+	from util.util import CachePolicy, NO_STORE, PRIVATE_REVALIDATE
+
+needs_settings = skipIf(local_settings is None, 'Needs a local_settings.py file, created with wizard.py.')
+
+
+@needs_settings
+class TestCachePolicy(TestCase):
+	"""Test suite for the Cache-Control policies of routes."""
+
+	def test_header(self):
+		"""Directives are listed in a fixed order."""
+		policy = CachePolicy(max_age=3600, public=True, immutable=True)
+		self.assertEqual(policy.header, 'public, max-age=3600, immutable')
+		policy = CachePolicy(no_store=True, no_cache=True, private=True, max_age=0)
+		self.assertEqual(policy.header, 'no-store, private, no-cache, max-age=0')
+
+	def test_empty(self):
+		"""A policy without directives sends an empty header."""
+		self.assertEqual(CachePolicy().header, '')
+
+	def test_shared_policies(self):
+		"""The default policies never let a shared cache store a response."""
+		self.assertEqual(NO_STORE.header, 'no-store')
+		self.assertEqual(PRIVATE_REVALIDATE.header, 'private, no-cache')
+
+
+@needs_settings
+class TestGuidMigration(TestCase):
+	"""Test suite for converting GUIDs stored as hex strings into binary values."""
+
+	def setUp(self):
+		"""Create a database holding a user and a playlist from before GUIDs were stored as bytes."""
+		self.engine = create_engine('sqlite://')
+		Base.metadata.create_all(self.engine)
+		self.guid = uuid.uuid4()
+		self.add_rows(self.guid)
+
+	def add_rows(self, guid):
+		"""Store a user and their playlist with the GUID as a hex string."""
+		with self.engine.begin() as conn:
+			conn.execute(text("INSERT INTO user (username, guid, volume) VALUES ('alice', :guid, 100)"), guid=guid.hex)
+			conn.execute(text("INSERT INTO playlist (name, owner_guid) VALUES ('Playlist', :guid)"), guid=guid.hex)
+
+	def test_migrate(self):
+		"""Hex strings are converted into the GUID's 16 bytes, which lookups by GUID then match."""
+		self.assertEqual(migrate_guid_columns(self.engine), 2)
+		with self.engine.connect() as conn:
+			self.assertEqual(conn.execute(text('SELECT guid FROM user')).scalar(), self.guid.bytes)
+			self.assertEqual(conn.execute(text('SELECT owner_guid FROM playlist')).scalar(), self.guid.bytes)
+		session = sessionmaker(bind=self.engine)()
+		self.addCleanup(session.close)
+		self.assertEqual(session.query(User).filter(User.guid==self.guid).one().username, 'alice')
+		self.assertEqual(session.query(Playlist).filter(Playlist.owner_guid==self.guid).one().name, 'Playlist')
+
+	def test_recorded(self):
+		"""The completed migration is recorded, so the columns aren't scanned again."""
+		self.assertFalse(migration_completed(self.engine, BINARY_GUIDS_MIGRATION))
+		migrate_guid_columns(self.engine)
+		self.assertTrue(migration_completed(self.engine, BINARY_GUIDS_MIGRATION))
+		self.add_rows(uuid.uuid4())
+		self.assertEqual(migrate_guid_columns(self.engine), 0)
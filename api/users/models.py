@@ -11,7 +11,7 @@ from util.models import Base, GUID, HexByteString
 # PIP library imports
 import sqlalchemy
 from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import IPAddressType
@@ -26,15 +26,22 @@ class LoginAttempt(Base):
         attempt_time (datetime): Time of login attempt.
         source_ip (str): IP of the user attempting to login
         success (bool): Whether the login attempt was successful or not.
+        origin (str): Host and process id of the API process the attempt was made to.
     """
 
     __tablename__ = 'login_attempts'
+    __table_args__ = (
+        Index('ix_login_attempts_email_attempt_time', 'email', 'attempt_time'),
+        Index('ix_login_attempts_attempt_time', 'attempt_time'),
+        Index('ix_login_attempts_source_ip_attempt_time', 'source_ip', 'attempt_time'),
+    )
 
     id = Column(Integer, primary_key=True)
     email = Column(String)
     attempt_time = Column(DateTime)
     source_ip = Column(IPAddressType)
     success = Column(Boolean)
+    origin = Column(String)
 
 class User(Base):
     """User account model stored in database and used for authentication.
@@ -55,8 +55,8 @@ class Login(BaseHandler):
 
         user = fetch_user_by_email(email)
 
-        if login_attempts_exceeded(email):
-           logger.warn(f'User with email {email} tried to login too many times. Rate limiting applied.')
+        if login_attempts_exceeded(email, ip):
+           logger.warn(f'User with email {email} tried to login too many times from {ip}. Rate limiting applied.')
            return self.HTTP_429(data={'msg': 'Too many failed login attempts. Please try again later.'})
 
         # We check all of these things before returning to prevent account enumeration via timing attacks.
@@ -71,7 +71,13 @@ class Login(BaseHandler):
             logger.warn(f'Tried to log in with email {email}, but this account has not completed registration.')
             forbidden = True
 
-        if user and user.password_hash and (not check_password(input_password, user.password_hash)):
+        try:
+            password_matches = user and user.password_hash and check_password(input_password, user.password_hash)
+        except HashPoolSaturated:
+            logger.warn(f'Too many passwords are being hashed to check the login for {email}.')
+            return self.HTTP_503(error='Server is busy. Please try again shortly.', retry_after=1)
+
+        if user and user.password_hash and (not password_matches):
             log_login_attempt(email, False, ip)
             logger.warn(f'Tried to log in with email {email}, but input password did not match stored password.')
             forbidden = True
@@ -82,6 +88,15 @@ class Login(BaseHandler):
         logger.info(f'User {user.username} logged in.')
         log_login_attempt(email, True, ip)
 
+        # Now that we know the password, upgrade its hash if the hashing settings have changed.
+        if password_needs_rehash(user.password_hash):
+            try:
+                update_password_hash(user.guid, create_storable_password(input_password))
+            except HashPoolSaturated:
+                logger.info(f'Skipped upgrading the password hash for user {user.username}, hashing pool is busy.')
+            else:
+                logger.info(f'Upgraded the password hash for user {user.username}.')
+
         # Generate a session token for the user, and set their session cookie.
         session_token = create_session_token(user)
         self.response.set_cookie(
@@ -102,7 +117,7 @@ class Logout(BaseHandler):
 
         Deauthenticate the user making the request.
         """
-        user = get_user_from_request(self.request)
+        user = get_session_user(self.request)
         if user:
             logger.info(f'User {user.username} logged out.')
             self.response.delete_cookie('session')
@@ -151,7 +166,11 @@ class Register(BaseHandler):
             return self.HTTP_400(error='Username already taken.')
 
         # Create the user.
-        create_full_user(email, username, password)
+        try:
+            create_full_user(email, username, password)
+        except HashPoolSaturated:
+            logger.warn(f'Too many passwords are being hashed to register the user with email {email}.')
+            return self.HTTP_503(error='Server is busy. Please try again shortly.', retry_after=1)
         return self.HTTP_200()
 
 class CurrentUser(BaseHandler):
@@ -162,12 +181,12 @@ class CurrentUser(BaseHandler):
 
         Fetch details and settings for the current user, as well as login status.
         """
-        user = get_user_from_request(self.request)
+        user = get_session_user(self.request)
         if not user:
             return self.HTTP_200(data={'logged_in': False, 'user': {}})
         user_data = {
             'username': user.username,
-            'volume': user.volume,
+            'volume': fetch_user_volume(user.guid),
         }
         if user.admin:
             user_data['admin'] = True
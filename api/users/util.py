@@ -4,21 +4,27 @@
 """Utility functions related to user objects."""
 
 # Native python imports
-import uuid, secrets, binascii, hashlib, hmac
-import os, logging, re, datetime, time, json
+import uuid, secrets, binascii, hashlib, hmac, collections, atexit
+import os, logging, re, datetime, time, json, threading, socket
+from concurrent.futures import ThreadPoolExecutor
 import smtplib, ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from base64 import b64encode, b64decode
 
 # Local file imports
-from settings import hash_iterations, hash_algo
-from settings import BASE_PATH
+from settings import hash_scheme, hash_iterations, hash_algo, scrypt_n, scrypt_r, scrypt_p
+from settings import BASE_PATH, JWT_RETIRED_KEYS_ACCEPTED, JWT_KEY_RELOAD_INTERVAL
+from settings import SESSION_REVOCATION_REFRESH_INTERVAL
+from settings import PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_DEPTH
+from settings import LOGIN_ATTEMPT_WINDOW, LOGIN_ATTEMPT_EMAIL_LIMIT, LOGIN_ATTEMPT_IP_LIMIT
+from settings import LOGIN_ATTEMPT_PERSIST, LOGIN_ATTEMPT_FLUSH_INTERVAL, LOGIN_ATTEMPT_BATCH_SIZE
+from settings import LOGIN_ATTEMPT_RETENTION_DAYS
 from users.models import User, LoginAttempt
 from util.util import access_db
 
 # PIP library imports
-from sqlalchemy import and_
+from sqlalchemy import and_, func
 import jwt
 
 # Variables and settings
@@ -27,9 +33,15 @@ template_dir = os.path.join(curr_dir, 'res', 'templates')
 
 smtp_port = 465
 
+# Length in bytes of the salt generated for each password hash.
+SALT_LENGTH = 32
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Lightweight stand-in for a User, built entirely from the contents of a session token.
+SessionUser = collections.namedtuple('SessionUser', ['guid', 'username', 'admin'])
+
 def create_full_user(email, username, password):
     """Creates a user in the database given an email, username, and password.
 
@@ -85,12 +97,27 @@ def fetch_user_by_username(username):
     Returns:
         result (User or None): The User object associated with the provided username if it exists, else None.
     """
-    with access_db() as db_conn:
+    with access_db(read_only=True) as db_conn:
         result = db_conn.query(User).\
                          filter(User.username==username).\
                          first()
         return result
 
+def fetch_user_volume(input_uuid):
+    """Fetch the preferred volume of the user associated with the provided UUID.
+
+    Arguments:
+        input_uuid (UUID): The UUID to look up.
+
+    Returns:
+        volume (int or None): The user's preferred volume if the user exists, else None.
+    """
+    with access_db() as db_conn:
+        result = db_conn.query(User.volume).\
+                         filter(User.guid==input_uuid).\
+                         scalar()
+        return result
+
 def username_taken(username):
     """Check if a given username already exists in the database.
 
@@ -117,34 +144,171 @@ def is_logged_in(request):
     Returns:
         logged_in (bool): True if the request is authenticated, else False.
     """
-    logged_in = False
+    return get_session_user(request) is not None
+
+def get_session_user(request):
+    """Fetch the user that made a request from their session token, without querying the database.
+
+    The token is checked against the in-memory revocation table to make sure it hasn't been
+    invalidated. The result is stored on the request, so repeated calls are free.
+
+    Arguments:
+        request (Request): The request from which the user is being extracted.
+
+    Returns:
+        session_user (SessionUser): The user who made the request, or None if it is not authenticated.
+    """
+    try:
+        return request._session_user
+    except AttributeError:
+        pass
+
+    session_user = None
     try:
         session = request.cookies['session']
     except KeyError:
-        return logged_in
-    token_details = decode_session_token(session)
-    if token_details:
-        # Check to make sure it hasn't been invalidated.
-        issued_at = datetime.datetime.fromtimestamp(token_details['iat'])
-        user = fetch_user_by_uuid(uuid.UUID(token_details['uuid']))
-        if not user:
-            return logged_in
+        session = None
 
-        if not user.last_invalidated:
-            # If no token has ever been invalidated, return true.
-            logged_in = True
-            return logged_in
-        else:
-            # If a token has been invalidated, check if this one is fresh enough.
-            if user.last_invalidated < issued_at:
-                logged_in = True
-                return logged_in
-            else:
-                logger.info("Session token is not fresh enough.")
-                return logged_in
-    else:
+    token_details = decode_session_token(session) if session else None
+    if session and not token_details:
         logger.warn("Session token could not be interpreted.")
-    return logged_in
+    elif token_details:
+        session_user = session_user_from_token(token_details)
+
+    request._session_user = session_user
+    return session_user
+
+def session_user_from_token(token_details):
+    """Validate the contents of a session token, and build a SessionUser from them.
+
+    Arguments:
+        token_details (dict): Decoded payload of a session token.
+
+    Returns:
+        session_user (SessionUser): The user the token belongs to, or None if the token has been invalidated.
+    """
+    user_guid = uuid.UUID(token_details['uuid'])
+    current_epoch = revocation_table.get(user_guid)
+    if current_epoch is None:
+        # The user no longer exists.
+        return None
+
+    if 'epoch' in token_details:
+        fresh = token_details['epoch'] >= current_epoch
+    else:
+        # Tokens issued before the epoch was added can only be checked by their issue time.
+        fresh = token_details['iat'] * 1000 > current_epoch
+    if not fresh:
+        logger.info("Session token is not fresh enough.")
+        return None
+
+    if 'username' in token_details:
+        return SessionUser(user_guid, token_details['username'], token_details.get('admin', False))
+
+    user = fetch_user_by_uuid(user_guid)
+    if not user:
+        return None
+    return SessionUser(user.guid, user.username, bool(user.admin))
+
+def invalidation_epoch(last_invalidated):
+    """Convert the last time a user's sessions were invalidated to an integer epoch.
+
+    Arguments:
+        last_invalidated (datetime): Last time that session tokens were invalidated, or None.
+
+    Returns:
+        epoch (int): Milliseconds since the unix epoch, or 0 if tokens were never invalidated.
+    """
+    if not last_invalidated:
+        return 0
+    return int(last_invalidated.timestamp() * 1000)
+
+class RevocationTable:
+    """In-memory table of the invalidation epoch of every user.
+
+    This allows session tokens to be checked without querying the database on every request.
+    The whole table is reloaded with a single query every SESSION_REVOCATION_REFRESH_INTERVAL
+    seconds, and users that are not in the table yet (e.g. newly registered) are looked up
+    individually.
+    """
+
+    def __init__(self):
+        """Initialization function for the revocation table."""
+        self._lock = threading.Lock()
+        self._epochs = {}
+        self._next_refresh = 0
+
+    def get(self, user_guid):
+        """Fetch the invalidation epoch for a user.
+
+        Arguments:
+            user_guid (UUID): The user to look up.
+
+        Returns:
+            epoch (int): The user's invalidation epoch, or None if the user does not exist.
+        """
+        if time.monotonic() >= self._next_refresh:
+            self.refresh()
+
+        try:
+            return self._epochs[user_guid]
+        except KeyError:
+            pass
+
+        with access_db() as db_conn:
+            result = db_conn.query(User.last_invalidated)\
+                            .filter(User.guid==user_guid)\
+                            .first()
+        if not result:
+            return None
+        epoch = invalidation_epoch(result.last_invalidated)
+        self._epochs[user_guid] = epoch
+        return epoch
+
+    def set(self, user_guid, epoch):
+        """Record a new invalidation epoch for a user in this process.
+
+        Arguments:
+            user_guid (UUID): The user whose sessions were invalidated.
+            epoch (int): The new invalidation epoch.
+        """
+        self._epochs[user_guid] = epoch
+
+    def refresh(self):
+        """Reload the invalidation epochs of all users from the database."""
+        with self._lock:
+            if time.monotonic() < self._next_refresh:
+                return
+            with access_db() as db_conn:
+                rows = db_conn.query(User.guid, User.last_invalidated).all()
+            self._epochs = {guid: invalidation_epoch(last_invalidated) for guid, last_invalidated in rows}
+            self._next_refresh = time.monotonic() + SESSION_REVOCATION_REFRESH_INTERVAL
+
+
+revocation_table = RevocationTable()
+
+def invalidate_sessions(input_uuid):
+    """Invalidate every session token that has been issued to a user so far.
+
+    Other processes pick up the change the next time their revocation table is refreshed.
+
+    Arguments:
+        input_uuid (UUID): UUID of the user whose sessions should be invalidated.
+
+    Returns:
+        success (bool): True if the user exists and their sessions were invalidated, False otherwise.
+    """
+    with access_db() as db_conn:
+        user = db_conn.query(User)\
+                      .filter(User.guid==input_uuid)\
+                      .first()
+        if not user:
+            return False
+        user.last_invalidated = datetime.datetime.now()
+        epoch = invalidation_epoch(user.last_invalidated)
+        db_conn.commit()
+    revocation_table.set(input_uuid, epoch)
+    return True
 
 def make_user_admin(email):
     """Make a user with a given email address an admin.
@@ -171,7 +335,7 @@ def make_user_admin(email):
 def get_all_admins():
     """Fetch all admin emails from database."""
     result = []
-    with access_db() as db_conn:
+    with access_db(read_only=True) as db_conn:
         all_admins = db_conn.query(User).filter(User.admin==True).all()
         for admin in all_admins:
             result.append((admin.email, admin.username))
@@ -199,7 +363,7 @@ def is_admin(request):
         result = True
     return result
 
-def generate_salt(n=32):
+def generate_salt(n=SALT_LENGTH):
     """Generate an n-byte salt, defaulting to 32 bytes.
 
     The python documentation for the secrets library posits that 32 bytes is sufficient randomness
@@ -215,6 +379,231 @@ def generate_salt(n=32):
     result = secrets.token_bytes(n)
     return result
 
+class HashPoolSaturated(Exception):
+    """Raised when too many password hashes are already running or queued."""
+
+
+class PasswordHashPool:
+    """Size-limited pool of threads used for hashing passwords.
+
+    Password hashing is deliberately slow, so the number of hashes running at once is limited.
+    At most PASSWORD_HASH_WORKERS hashes run at once, and at most PASSWORD_HASH_QUEUE_DEPTH more
+    may wait for a free thread. The request thread that submitted a hash blocks until it is
+    done, so a burst of logins can tie up at most that many request threads. Anything beyond
+    that is rejected immediately with HashPoolSaturated, which the routes turn into a 503.
+    """
+
+    def __init__(self, workers, queue_depth):
+        """Initialization function for the pool.
+
+        Arguments:
+            workers (int): Number of hashes that may run concurrently.
+            queue_depth (int): Number of hashes that may wait for a free worker.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._metrics_lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._total_hash_time = 0.0
+        self._max_hash_time = 0.0
+
+    def run(self, func, *args):
+        """Run a hashing function on the pool, blocking the calling thread until it has a result.
+
+        Arguments:
+            func (callable): The hashing function to run.
+            args: Arguments to pass to the hashing function.
+
+        Returns:
+            result: The return value of the hashing function.
+
+        Raises:
+            HashPoolSaturated: Raised if the pool and its queue are already full.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._metrics_lock:
+                self._rejected += 1
+            raise HashPoolSaturated()
+
+        try:
+            with self._metrics_lock:
+                self._in_flight += 1
+            future = self._executor.submit(self._timed, time.monotonic(), func, *args)
+            return future.result()
+        finally:
+            with self._metrics_lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def _timed(self, submitted, func, *args):
+        """Run a hashing function, recording how long it waited and ran for."""
+        started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            finished = time.monotonic()
+            with self._metrics_lock:
+                self._completed += 1
+                self._total_wait += started - submitted
+                self._total_hash_time += finished - started
+                self._max_hash_time = max(self._max_hash_time, finished - started)
+
+    def metrics(self):
+        """Fetch statistics about the hashes run by the pool.
+
+        Returns:
+            result (dict): Counts of completed, rejected and in-flight hashes, and latencies in milliseconds.
+        """
+        with self._metrics_lock:
+            completed = self._completed
+            return {
+                'in_flight': self._in_flight,
+                'completed': completed,
+                'rejected': self._rejected,
+                'average_wait_ms': round(1000 * self._total_wait / completed, 2) if completed else 0,
+                'average_hash_ms': round(1000 * self._total_hash_time / completed, 2) if completed else 0,
+                'max_hash_ms': round(1000 * self._max_hash_time, 2),
+            }
+
+
+password_hash_pool = PasswordHashPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_DEPTH)
+
+class PBKDF2Hasher:
+    """Password hasher using hashlib.pbkdf2_hmac.
+
+    For compatibility with existing hashes, these are stored under the name of their digest, e.g. 'sha256'.
+    """
+
+    def __init__(self, digest, iterations):
+        """Initialization function for the hasher.
+
+        Arguments:
+            digest (str): Name of the digest used by pbkdf2_hmac, e.g. 'sha256'.
+            iterations (int): Number of iterations used when hashing.
+        """
+        self.name = digest
+        self.iterations = int(iterations)
+
+    @classmethod
+    def from_params(cls, name, params):
+        """Create a hasher from the information stored alongside a hash.
+
+        Arguments:
+            name (str): Stored name of the hashing algorithm.
+            params (str): Stored cost parameters of the hashing algorithm.
+        """
+        return cls(name, params)
+
+    @property
+    def params(self):
+        """Cost parameters of the hasher, as stored alongside a hash."""
+        return str(self.iterations)
+
+    def hash(self, password, salt):
+        """Hash a password.
+
+        Arguments:
+            password (bytes): The password to hash.
+            salt (bytes): Unique salt for the hash.
+
+        Returns:
+            result (bytes): The hashed password.
+        """
+        return hashlib.pbkdf2_hmac(self.name, password, salt, self.iterations)
+
+
+class ScryptHasher:
+    """Memory-hard password hasher using hashlib.scrypt."""
+
+    name = 'scrypt'
+
+    def __init__(self, n, r, p):
+        """Initialization function for the hasher.
+
+        Arguments:
+            n (int): CPU/memory cost parameter, a power of 2.
+            r (int): Block size parameter.
+            p (int): Parallelization parameter.
+        """
+        self.n = int(n)
+        self.r = int(r)
+        self.p = int(p)
+
+    @classmethod
+    def from_params(cls, name, params):
+        """Create a hasher from the information stored alongside a hash.
+
+        Arguments:
+            name (str): Stored name of the hashing algorithm.
+            params (str): Stored cost parameters of the hashing algorithm, formatted as n:r:p.
+        """
+        return cls(*params.split(':'))
+
+    @property
+    def params(self):
+        """Cost parameters of the hasher, as stored alongside a hash."""
+        return f'{self.n}:{self.r}:{self.p}'
+
+    def hash(self, password, salt):
+        """Hash a password.
+
+        Arguments:
+            password (bytes): The password to hash.
+            salt (bytes): Unique salt for the hash.
+
+        Returns:
+            result (bytes): The hashed password.
+        """
+        # hashlib refuses to use more than 32MiB unless told otherwise, so allow for the configured cost.
+        maxmem = 2 * 128 * self.n * self.r * self.p
+        return hashlib.scrypt(password, salt=salt, n=self.n, r=self.r, p=self.p, maxmem=maxmem, dklen=64)
+
+
+# Registry of hashers, keyed by the algorithm name stored alongside each hash.
+PASSWORD_HASHERS = {
+    'scrypt': ScryptHasher,
+}
+for _digest in ('sha1', 'sha256', 'sha512'):
+    PASSWORD_HASHERS[_digest] = PBKDF2Hasher
+
+def register_password_hasher(name, hasher_cls):
+    """Add a hasher to the registry, so that hashes stored with the given name can be checked.
+
+    Arguments:
+        name (str): Algorithm name stored alongside hashes made by the hasher.
+        hasher_cls (class): Class with a from_params classmethod, and params and hash members.
+    """
+    PASSWORD_HASHERS[name] = hasher_cls
+
+def get_password_hasher(name, params):
+    """Fetch a hasher able to repeat a stored hash.
+
+    Arguments:
+        name (str): Stored name of the hashing algorithm.
+        params (str): Stored cost parameters of the hashing algorithm.
+
+    Returns:
+        hasher: A hasher configured with the given parameters.
+    """
+    try:
+        hasher_cls = PASSWORD_HASHERS[name]
+    except KeyError:
+        raise ValueError(f'Unsupported password hashing algorithm: {name}')
+    return hasher_cls.from_params(name, params)
+
+def default_password_hasher():
+    """Fetch the hasher configured for new passwords in the settings file.
+
+    Returns:
+        hasher: The hasher new passwords should be stored with.
+    """
+    if hash_scheme == 'scrypt':
+        return ScryptHasher(scrypt_n, scrypt_r, scrypt_p)
+    return PBKDF2Hasher(hash_algo, hash_iterations)
+
 def check_password(input_password, stored_password):
     """Check the input password against a given stored password hash.
 
@@ -226,18 +615,40 @@ def check_password(input_password, stored_password):
         stored_password (str): The hash to compare the input against.
 
     Returns:
-        result (bool): True if the input password matches the hash, False otherwise.
-    """
-    # Extract the relevant hashing information from the stored hash.
-    algo, iters, salt, hashed_pass = extract_hash_info(stored_password)
+        result (bool): True if the input password matches the hash, False otherwise, including
+            when the hash was made with an unknown algorithm or can't be read.
 
-    # Hash the given input password in the same manner as the stored hash.
-    input_hashed_pass = hashlib.pbkdf2_hmac(algo, input_password.encode('utf-8'), salt, iters)
+    Raises:
+        HashPoolSaturated: Raised if too many passwords are already being hashed.
+    """
+    try:
+        # Extract the relevant hashing information from the stored hash.
+        algo, params, salt, hashed_pass = extract_hash_info(stored_password)
+
+        # Hash the given input password in the same manner as the stored hash.
+        hasher = get_password_hasher(algo, params)
+        input_hashed_pass = password_hash_pool.run(hasher.hash, input_password.encode('utf-8'), salt)
+    except (ValueError, TypeError) as e:
+        logger.error(f'Could not check a stored password hash: {e}')
+        return False
 
     # Securely compare the hashes.
     result = secrets.compare_digest(hashed_pass, input_hashed_pass)
     return result
 
+def password_needs_rehash(stored_password):
+    """Check whether a stored hash was made with different settings than the ones currently configured.
+
+    Arguments:
+        stored_password (str): The stored hash to check.
+
+    Returns:
+        result (bool): True if the password should be hashed again with the current settings.
+    """
+    algo, params, _, _ = extract_hash_info(stored_password)
+    hasher = default_password_hasher()
+    return (algo, params) != (hasher.name, hasher.params)
+
 def create_storable_password(password):
     """Generate a unique salt, and create a hashed password from that.
 
@@ -246,6 +657,9 @@ def create_storable_password(password):
 
     Returns:
         result (str): The hash generated from the input password.
+
+    Raises:
+        HashPoolSaturated: Raised if too many passwords are already being hashed.
     """
     # Every password gets a unique hash, in order to prevent rainbow table attacks.
     salt = generate_salt()
@@ -254,16 +668,17 @@ def create_storable_password(password):
     #  so we have to encode the input password.
     password_as_bytes = password.encode('utf-8')
 
-    # Use the hashing algorithm and iterations in the config file, as well as the generated
+    # Use the hasher configured in the settings file, as well as the generated
     #  salt to perform the hashing.
-    hashed_pass = hashlib.pbkdf2_hmac(hash_algo, password_as_bytes, salt, hash_iterations)
+    hasher = default_password_hasher()
+    hashed_pass = password_hash_pool.run(hasher.hash, password_as_bytes, salt)
 
     # The hashed password is a byte-like object, and we need to store the hashing information
     #  along with it to check it later, so we use this to generate a storable version of the hash.
-    result = create_storable_hash(hash_algo, hash_iterations, salt, hashed_pass)
+    result = create_storable_hash(hasher.name, hasher.params, salt, hashed_pass)
     return result
 
-def create_storable_hash(algo, iters, salt, hashed_pass):
+def create_storable_hash(algo, params, salt, hashed_pass):
     """Generate a storable version of a password hash from its components.
 
     Each password needs to have a unique salt, and it's possible that the hashing method
@@ -272,8 +687,8 @@ def create_storable_hash(algo, iters, salt, hashed_pass):
     process when we check passwords later.
 
     Arguments:
-        algo (str): The hashing algorithm used by pbkdf2_hmac for generating the hash.
-        iters (int): The number of iterations used for generating the hash.
+        algo (str): Name of the hashing algorithm used for generating the hash.
+        params (str or int): The cost parameters used for generating the hash, e.g. the number of iterations.
         salt (bytes): Unique salt used in the generation of the hash.
         hashed_pass (bytes): The actual hash that we are storing.
 
@@ -281,8 +696,8 @@ def create_storable_hash(algo, iters, salt, hashed_pass):
         result (str): A storable string containing information about the hash, and the hash itself.
     """
     algo = algo.encode('utf-8')
-    iters = str(iters).encode('utf-8')
-    joined_hash = b'$'.join([algo, iters, salt, hashed_pass])
+    params = str(params).encode('utf-8')
+    joined_hash = b'$'.join([algo, params, salt, hashed_pass])
     storable_hash = binascii.hexlify(joined_hash)
     return storable_hash
 
@@ -294,20 +709,40 @@ def extract_hash_info(hash):
     single string. In order to repeat the hashing process the same way when passwords
     are checked, we need to extract this information from the stored string.
 
+    The salt and hash are raw bytes that may themselves contain the separator, so the
+    salt is split off by its length rather than by the separator.
+
     Arguments:
         hash (str): The stored string containing the hash, and the information about the hashing process.
 
     Returns:
         algo (str): The hashing algorithm used.
-        iters (int): The number of iterations used when creating the hash.
+        params (str): The cost parameters used when creating the hash, e.g. the number of iterations.
         salt (bytes): The unique salt used to generate the hash.
         hashed_pass (bytes): The hashed version of the password.
     """
     raw_hash = binascii.unhexlify(hash)
-    algo, iters, salt, hashed_pass = raw_hash.split(b'$')
+    algo, params, salt_and_hash = raw_hash.split(b'$', 2)
+    salt = salt_and_hash[:SALT_LENGTH]
+    hashed_pass = salt_and_hash[SALT_LENGTH + 1:]
     algo = algo.decode('utf-8')
-    iters = int(iters.decode('utf-8'))
-    return algo, iters, salt, hashed_pass
+    params = params.decode('utf-8')
+    return algo, params, salt, hashed_pass
+
+def update_password_hash(input_uuid, storable_password_hash):
+    """Replace the stored password hash of a given user, without changing their password.
+
+    Arguments:
+        input_uuid (uuid): UUID associated with the account whose hash should be replaced.
+        storable_password_hash (str): The new hash, as generated by create_storable_password.
+    """
+    with access_db() as db_conn:
+        user = db_conn.query(User).\
+                       filter(User.guid==input_uuid).\
+                       first()
+        if user:
+            user.password_hash = storable_password_hash
+            db_conn.commit()
 
 def update_username(input_uuid, username):
     """Update the username of a given user.
@@ -360,7 +795,7 @@ def update_password(input_uuid, old_password, new_password):
         return success
 
     # Generate a new hash, and store it for the user.
-    storable_password_hash = create_storable_password(password)
+    storable_password_hash = create_storable_password(new_password)
 
     with access_db() as db_conn:
         user = db_conn.query(User).\
@@ -373,8 +808,9 @@ def update_password(input_uuid, old_password, new_password):
         user.password_hash = storable_password_hash
         db_conn.commit()
         success = True
-        return success
 
+    # Sessions created with the old password should no longer be accepted.
+    invalidate_sessions(input_uuid)
     return success
 
 def validate_email(email):
@@ -397,42 +833,278 @@ def validate_email(email):
         return True
     return False
 
+class SlidingWindowLimiter:
+    """In-memory sliding window counter of failed events, e.g. failed logins, per key.
+
+    Only the timestamps within the window are kept, so memory use is bounded by the
+    number of events that happened within the window.
+    """
+
+    def __init__(self, limit, window):
+        """Initialization function for the limiter.
+
+        Arguments:
+            limit (int): Number of events allowed within the window before the key is limited.
+            window (int): Length of the window in seconds.
+        """
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._events = {}
+        self._next_purge = 0
+
+    def record(self, key, timestamp=None):
+        """Record an event for a key.
+
+        Arguments:
+            key (hashable): The key that the event happened for.
+            timestamp (float): Unix time of the event, defaulting to now.
+        """
+        now = time.time()
+        if timestamp is None:
+            timestamp = now
+        with self._lock:
+            self._events.setdefault(key, collections.deque()).append(timestamp)
+            if now >= self._next_purge:
+                self._purge(now)
+
+    def exceeded(self, key):
+        """Check whether more events than allowed have happened for a key within the window.
+
+        Arguments:
+            key (hashable): The key to check.
+
+        Returns:
+            result (bool): True if the key is over its limit, False otherwise.
+        """
+        cutoff = time.time() - self.window
+        with self._lock:
+            events = self._events.get(key)
+            if not events:
+                return False
+            while events and events[0] <= cutoff:
+                events.popleft()
+            return len(events) > self.limit
+
+    def _purge(self, now):
+        """Drop events that have left the window, and keys that no longer have any events."""
+        cutoff = now - self.window
+        for key in list(self._events):
+            events = self._events[key]
+            while events and events[0] <= cutoff:
+                events.popleft()
+            if not events:
+                del self._events[key]
+        self._next_purge = now + self.window
+
+
+class LoginAttemptLog:
+    """Batches login attempts in memory, and writes them to the database periodically.
+
+    A background thread flushes the batch every LOGIN_ATTEMPT_FLUSH_INTERVAL seconds, or as soon
+    as LOGIN_ATTEMPT_BATCH_SIZE attempts are waiting. After each flush, it records the failed
+    attempts other processes have written since the last one in the login limiters, so the
+    limits hold across every API process, without counting attempts on each login. Roughly once
+    a day, attempts older than LOGIN_ATTEMPT_RETENTION_DAYS are removed so the table doesn't
+    grow forever.
+    """
+
+    def __init__(self, origin):
+        """Initialization function for the log.
+
+        Arguments:
+            origin (str): Identifies the attempts written by this process, e.g. its host and process id.
+        """
+        self.origin = origin
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wake = threading.Event()
+        self._thread = None
+        self._next_compaction = 0
+        self._last_synced_id = None
+
+    def start(self, last_synced_id):
+        """Start writing attempts, and reading those of other processes, in the background.
+
+        Arguments:
+            last_synced_id (int): Id of the last attempt already recorded in the login limiters.
+        """
+        with self._lock:
+            self._last_synced_id = last_synced_id or 0
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='login-attempt-log', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def add(self, email, success, ip, attempt_time):
+        """Queue a login attempt to be written to the database.
+
+        Arguments:
+            email (str): The email the login is attempted for.
+            success (bool): Whether the login was successful or not.
+            ip (ipaddress): The ip address that the login attempt occurred from.
+            attempt_time (datetime): Time of the login attempt.
+        """
+        attempt = {
+            'email': email,
+            'success': success,
+            'source_ip': ip,
+            'attempt_time': attempt_time,
+            'origin': self.origin,
+        }
+        with self._lock:
+            self._pending.append(attempt)
+            batch_full = len(self._pending) >= LOGIN_ATTEMPT_BATCH_SIZE
+        if batch_full:
+            self._wake.set()
+
+    def flush(self):
+        """Write all queued login attempts to the database, read those of other processes, and compact old rows if it's time."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        if pending:
+            self._write(pending)
+
+        self.sync()
+
+        if time.monotonic() >= self._next_compaction:
+            self._next_compaction = time.monotonic() + 24 * 60 * 60
+            self.compact()
+
+    def _write(self, attempts):
+        """Store login attempts in the database."""
+        try:
+            with access_db() as db_conn:
+                db_conn.bulk_insert_mappings(LoginAttempt, attempts)
+                db_conn.commit()
+        except Exception as e:
+            logger.warn(f'Exception encountered while storing {len(attempts)} login attempts.')
+            logger.warn(e)
+
+    def sync(self):
+        """Record the failed attempts written by other processes since the last sync in the login limiters."""
+        if self._last_synced_id is None:
+            return
+        try:
+            with access_db() as db_conn:
+                failures = db_conn.query(LoginAttempt.id, LoginAttempt.email, LoginAttempt.source_ip, LoginAttempt.attempt_time)\
+                    .filter(LoginAttempt.id>self._last_synced_id)\
+                    .filter(LoginAttempt.success==False)\
+                    .filter(LoginAttempt.origin!=self.origin)\
+                    .order_by(LoginAttempt.id)\
+                    .all()
+        except Exception as e:
+            logger.warn('Exception encountered while reading the login attempts of other processes.')
+            logger.warn(e)
+            return
+        for attempt_id, email, source_ip, attempt_time in failures:
+            record_login_failure(email, source_ip, attempt_time.timestamp())
+            self._last_synced_id = attempt_id
+
+    def compact(self):
+        """Delete login attempts older than the retention period in a single statement."""
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=LOGIN_ATTEMPT_RETENTION_DAYS)
+        try:
+            with access_db() as db_conn:
+                removed = db_conn.query(LoginAttempt)\
+                                 .filter(LoginAttempt.attempt_time<cutoff)\
+                                 .delete(synchronize_session=False)
+                db_conn.commit()
+        except Exception as e:
+            logger.warn('Exception encountered while removing old login attempts.')
+            logger.warn(e)
+        else:
+            if removed:
+                logger.info(f'Removed {removed} login attempts older than {LOGIN_ATTEMPT_RETENTION_DAYS} days.')
+
+    def _run(self):
+        """Background loop that flushes the queue periodically."""
+        while True:
+            self._wake.wait(LOGIN_ATTEMPT_FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+
+email_login_limiter = SlidingWindowLimiter(LOGIN_ATTEMPT_EMAIL_LIMIT, LOGIN_ATTEMPT_WINDOW)
+ip_login_limiter = SlidingWindowLimiter(LOGIN_ATTEMPT_IP_LIMIT, LOGIN_ATTEMPT_WINDOW)
+login_attempt_log = LoginAttemptLog(f'{socket.gethostname()}:{os.getpid()}')
+_login_limiters_loaded = threading.Event()
+_login_limiters_lock = threading.Lock()
+
+def record_login_failure(email, ip, timestamp):
+    """Record a failed login attempt in the login limiters.
+
+    Arguments:
+        email (str): The email the login was attempted for.
+        ip (ipaddress): The ip address that the login attempt occurred from, if known.
+        timestamp (float): Unix time of the attempt.
+    """
+    email_login_limiter.record(email, timestamp)
+    if ip is not None:
+        ip_login_limiter.record(str(ip), timestamp)
+
+def load_login_limiters():
+    """Seed the login rate limiters with the failed attempts stored in the database.
+
+    This runs once per process, so that restarting the API doesn't reset rate limiting. From
+    then on, the attempts other processes store are read in the background, see LoginAttemptLog.
+    """
+    if _login_limiters_loaded.is_set():
+        return
+    with _login_limiters_lock:
+        if _login_limiters_loaded.is_set():
+            return
+        if LOGIN_ATTEMPT_PERSIST:
+            cutoff = datetime.datetime.now() - datetime.timedelta(seconds=LOGIN_ATTEMPT_WINDOW)
+            with access_db() as db_conn:
+                last_id = db_conn.query(func.max(LoginAttempt.id)).scalar()
+                recent_failures = db_conn.query(LoginAttempt.email, LoginAttempt.source_ip, LoginAttempt.attempt_time)\
+                    .filter(\
+                        and_(
+                            LoginAttempt.id<=(last_id or 0),
+                            LoginAttempt.attempt_time>cutoff,
+                            LoginAttempt.success==False
+                        ))\
+                    .all()
+            for email, source_ip, attempt_time in recent_failures:
+                record_login_failure(email, source_ip, attempt_time.timestamp())
+            login_attempt_log.start(last_id)
+        _login_limiters_loaded.set()
+
 def log_login_attempt(email, success, ip):
-    """Create a database entry when a user attempts to login.
+    """Record a login attempt for rate limiting, and queue it to be stored in the database.
 
     Arguments:
         email (str): The email the login is attempted for.
         success (str): Whether the login was successful or not.
         ip (ipaddress): The ip address that the login attempt occurred from.
     """
-    with access_db() as db_conn:
-        curr_time = datetime.datetime.now()
-        login_attempt = LoginAttempt(email=email, success=success, source_ip=ip, attempt_time=curr_time)
-        db_conn.add(login_attempt)
-        db_conn.commit()
+    load_login_limiters()
+    curr_time = datetime.datetime.now()
+    if not success:
+        record_login_failure(email, ip, curr_time.timestamp())
+    if LOGIN_ATTEMPT_PERSIST:
+        login_attempt_log.add(email, success, ip, curr_time)
+
+def login_attempts_exceeded(email, ip=None):
+    """Check whether too many failed attempts have been made recently, by email or by source IP.
 
-def login_attempts_exceeded(email):
-    """Check whether too many failed attempts have been made in the past hour.
+    This is decided from the in-memory limiters alone. Attempts made to other API processes
+    reach them within LOGIN_ATTEMPT_FLUSH_INTERVAL seconds, see LoginAttemptLog.
 
     Arguments:
         email (str): The email of the account that failed login attempts are being made for.
+        ip (ipaddress): The ip address that the login attempt is coming from.
 
     Returns:
         result (bool): True if too many attempts have been made, False otherwise.
     """
-    curr_time = datetime.datetime.now()
-    hour_ago = curr_time - datetime.timedelta(hours=1)
-    with access_db() as db_conn:
-        recent_attempts = db_conn.query(LoginAttempt)\
-            .filter(\
-                and_(
-                    LoginAttempt.email==email,
-                    LoginAttempt.attempt_time>hour_ago,
-                    LoginAttempt.success==False
-                ))
-        num_attempts = recent_attempts.count()
-        if num_attempts > 5:
-            return True
+    load_login_limiters()
+    if email_login_limiter.exceeded(email):
+        return True
+    if ip is not None and ip_login_limiter.exceeded(str(ip)):
+        return True
     return False
 
 def generate_hmac_digest(msg):
@@ -452,9 +1124,211 @@ def generate_hmac_digest(msg):
     digest = hmac.new(key, msg=msg, digestmod=hashlib.sha512).digest()
     return digest
 
+class JWTKeyring:
+    """In-memory cache of the keys used to sign and verify session tokens.
+
+    The current signing key lives in users/.key, and keys that have been rotated out
+    are kept in users/.retired_keys so that tokens signed with them are still accepted.
+    Every key is identified by a key id, which is stored in the header of each token.
+
+    Keys are read from disk once per process. Afterwards, the key file is only checked
+    for changes once every JWT_KEY_RELOAD_INTERVAL seconds, so that a rotation done by
+    another process is picked up without reading the key on every request. A token signed
+    with a key this process doesn't know yet, e.g. by a process that picked up a rotation
+    first, has the keys checked right away, at most once every miss_check_interval seconds.
+    """
+
+    # Bits to bytes
+    key_size = int(256/8)
+
+    # Minimum number of seconds between checks for changed keys caused by unknown key ids,
+    #  so tokens with made-up key ids can't make every request check the disk.
+    miss_check_interval = 1
+
+    def __init__(self, key_file, retired_key_dir):
+        """Initialization function for the keyring.
+
+        Arguments:
+            key_file (str): Path of the file containing the current signing key.
+            retired_key_dir (str): Path of the directory containing retired signing keys.
+        """
+        self.key_file = key_file
+        self.retired_key_dir = retired_key_dir
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._current_kid = None
+        self._key_file_mtime = None
+        self._retired_key_dir_mtime = None
+        self._next_check = 0
+        self._next_miss_check = 0
+
+    @staticmethod
+    def key_id(key):
+        """Derive a short, stable identifier for a key.
+
+        Arguments:
+            key (bytes): The key to identify.
+
+        Returns:
+            kid (str): Hex string identifying the key.
+        """
+        return hashlib.sha256(key).hexdigest()[:16]
+
+    def current(self):
+        """Fetch the key that new tokens should be signed with.
+
+        Returns:
+            kid (str): Identifier of the current key, or None if no key could be loaded.
+            key (bytes): The current key, or None if no key could be loaded.
+        """
+        self._reload_if_stale()
+        kid = self._current_kid
+        return kid, self._keys.get(kid)
+
+    def get(self, kid):
+        """Fetch an accepted key by its identifier.
+
+        Arguments:
+            kid (str): Identifier of the key, as found in a token header.
+
+        Returns:
+            key (bytes): The matching key if it is still accepted, None otherwise.
+        """
+        self._reload_if_stale()
+        key = self._keys.get(kid)
+        if key is None:
+            # The key may have been rotated in by another process since the last check.
+            now = time.monotonic()
+            if now >= self._next_miss_check:
+                self._next_miss_check = now + self.miss_check_interval
+                self._reload_if_stale(force=True)
+                key = self._keys.get(kid)
+        return key
+
+    def rotate(self):
+        """Replace the current signing key with a freshly generated one.
+
+        The old key is moved into the retired key directory, and only the most recent
+        JWT_RETIRED_KEYS_ACCEPTED retired keys are kept.
+
+        Returns:
+            kid (str): Identifier of the new signing key.
+        """
+        with self._lock:
+            self._load()
+            os.makedirs(self.retired_key_dir, exist_ok=True)
+            old_kid = self._current_kid
+            if old_kid:
+                retired_file = os.path.join(self.retired_key_dir, old_kid)
+                with open(retired_file, 'wb') as f:
+                    f.write(self._keys[old_kid])
+
+            # Write the new key next to the old one, then swap it in atomically.
+            key = secrets.token_bytes(self.key_size)
+            tmp_file = f'{self.key_file}.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(key)
+            os.replace(tmp_file, self.key_file)
+
+            self._prune_retired_keys()
+            self._load()
+            logger.info(f'Rotated session token signing key from {old_kid} to {self._current_kid}.')
+            return self._current_kid
+
+    def _reload_if_stale(self, force=False):
+        """Reload the keys if they have never been loaded, or if the key file or retired keys have changed.
+
+        Arguments:
+            force (bool): Whether to check for changes even if the last check was less than
+                JWT_KEY_RELOAD_INTERVAL seconds ago.
+        """
+        now = time.monotonic()
+        if self._current_kid and now < self._next_check and not force:
+            return
+        with self._lock:
+            if self._current_kid and now < self._next_check and not force:
+                return
+            if not self._current_kid or self._mtimes() != (self._key_file_mtime, self._retired_key_dir_mtime):
+                self._load()
+            self._next_check = now + JWT_KEY_RELOAD_INTERVAL
+
+    def _mtimes(self):
+        """Modification times of the key file and the retired key directory, or None for those that don't exist."""
+        mtimes = []
+        for path in (self.key_file, self.retired_key_dir):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _load(self):
+        """Read the current and retired keys from disk, generating a key if none exists."""
+        key = self._read_or_create_key_file()
+        if not key:
+            return
+
+        keys = {}
+        if os.path.isdir(self.retired_key_dir):
+            for kid in os.listdir(self.retired_key_dir):
+                try:
+                    with open(os.path.join(self.retired_key_dir, kid), 'rb') as f:
+                        keys[kid] = f.read()
+                except OSError:
+                    logger.critical(f'COULD NOT OPEN FILE TO READ: {kid}')
+
+        current_kid = self.key_id(key)
+        keys[current_kid] = key
+        self._keys = keys
+        self._current_kid = current_kid
+        self._key_file_mtime, self._retired_key_dir_mtime = self._mtimes()
+
+    def _read_or_create_key_file(self):
+        """Read the current key file, creating it if it does not exist yet.
+
+        Returns:
+            key (bytes): The current signing key, or None if it could not be read or created.
+        """
+        if not os.path.exists(self.key_file):
+            key = secrets.token_bytes(self.key_size)
+            try:
+                # O_EXCL ensures that only one process generates the initial key.
+                fd = os.open(self.key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                pass
+            except OSError:
+                logger.critical(f'COULD NOT OPEN FILE TO WRITE: {self.key_file}')
+                return None
+            else:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(key)
+                return key
+
+        try:
+            with open(self.key_file, 'rb') as f:
+                return f.read()
+        except OSError:
+            logger.critical(f'COULD NOT OPEN FILE TO READ: {self.key_file}')
+            return None
+
+    def _prune_retired_keys(self):
+        """Delete all but the most recently retired keys."""
+        retired = [os.path.join(self.retired_key_dir, kid) for kid in os.listdir(self.retired_key_dir)]
+        retired.sort(key=os.path.getmtime, reverse=True)
+        for retired_file in retired[JWT_RETIRED_KEYS_ACCEPTED:]:
+            os.remove(retired_file)
+
+
+jwt_keyring = JWTKeyring(os.path.join(BASE_PATH, 'users', '.key'),
+                         os.path.join(BASE_PATH, 'users', '.retired_keys'))
+
 def create_session_token(user):
     """Generates a session token for a given user.
-    
+
+    The token header includes the id of the key used to sign it, so that it can
+    still be verified after the signing key has been rotated. The payload carries
+    enough about the user to authenticate most requests without a database lookup.
+
     Arguments:
         user (User): User for whom a token is being generated.
 
@@ -464,19 +1338,31 @@ def create_session_token(user):
     payload = {
         'iat': int(time.time()),
         'uuid': str(user.guid),
+        'username': user.username,
+        'admin': bool(user.admin),
+        'epoch': invalidation_epoch(user.last_invalidated),
     }
+    kid, key = jwt_keyring.current()
+    if not key:
+        logger.critical('No key available to sign session token.')
+        return None
     try:
-        encoded = jwt.encode(payload, fetch_jwt_key(), algorithm='HS256')
+        encoded = jwt.encode(payload, key, algorithm='HS256', headers={'kid': kid})
     except Exception as e:
         logger.warn('Exception encountered while encoding payload.')
         logger.warn(e)
         return None
     else:
-        return encoded.decode('utf-8')
+        # Older versions of PyJWT return bytes rather than a string.
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode('utf-8')
+        return encoded
 
 def decode_session_token(token):
     """Converts a session token into the original data.
 
+    Tokens issued before key ids were added to the header are checked against the current key.
+
     Arguments:
         token (str): The base64 encoded encryted payload.
 
@@ -484,8 +1370,15 @@ def decode_session_token(token):
         payload (dict): The contents of the payload if decoded successfully and signature matches, None otherwise.
     """
     try:
-        token_bytes = token.encode('utf-8')
-        payload = jwt.decode(token_bytes, fetch_jwt_key(), algorithm='HS256')
+        kid = jwt.get_unverified_header(token).get('kid')
+        if kid:
+            key = jwt_keyring.get(kid)
+        else:
+            _, key = jwt_keyring.current()
+        if not key:
+            logger.info(f'Session token was signed with a key that is no longer accepted: {kid}')
+            return None
+        payload = jwt.decode(token, key, algorithms=['HS256'])
     except Exception as e:
         logger.warn('Exception encountered while decoding token.')
         logger.warn(e)
@@ -493,39 +1386,24 @@ def decode_session_token(token):
         return payload
 
 def fetch_jwt_key():
-    """Fetches a key for use with hmac-sha256.
+    """Fetches the current key for use with hmac-sha256.
 
-    If the users/.key file exists, it reads it from the file.
-    If the file does not exist, it generates one.
+    The key is cached in memory by the keyring, and only read from the users/.key file
+    when it is first needed or has been rotated. If the file does not exist, one is generated.
 
     Returns:
-        key (bytes): Key to be used for hmac-sha512.
+        key (bytes): Key to be used for hmac-sha256.
     """
-    # Bits to bytes
-    key_size = int(256/8)
+    _, key = jwt_keyring.current()
+    return key
 
-    key_file = os.path.join(BASE_PATH, 'users', '.key')
-    key = None
-    if os.path.exists(key_file):
-        try:
-            with open(key_file, 'rb') as f:
-                key = f.read()
-        except:
-            logger.critical(f'COULD NOT OPEN FILE TO READ: {key_file}')
-            return None
-        else:
-            return key
-    else:
-        # Generate a key
-        key = secrets.token_bytes(key_size)
-        try:
-            with open(key_file, 'wb') as f:
-                f.write(key)
-        except:
-            logger.critical(f'COULD NOT OPEN FILE TO WRITE: {key_file}')
-            return None
-        else:
-            return key
+def rotate_jwt_key():
+    """Generate a new session token signing key, retiring the current one.
+
+    Returns:
+        kid (str): Identifier of the new signing key.
+    """
+    return jwt_keyring.rotate()
 
 def get_user_from_request(request):
     """Fetches the user from the database based on the contents of their session cookie.
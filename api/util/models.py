@@ -3,27 +3,30 @@
 # Filename: util/models.py
 """Utility classes for database objects."""
 
-from sqlalchemy.types import TypeDecorator, CHAR, String
+from sqlalchemy import Column, DateTime, select, text
+from sqlalchemy.types import TypeDecorator, BINARY, String
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
-import uuid
+import datetime, uuid
 
-# Taken from: https://docs.sqlalchemy.org/en/13/core/custom_types.html#backend-agnostic-guid-type
+# Adapted from: https://docs.sqlalchemy.org/en/13/core/custom_types.html#backend-agnostic-guid-type
 class GUID(TypeDecorator):
     """Platform-independent GUID type.
 
     Uses PostgreSQL's UUID type, otherwise uses
-    CHAR(32), storing as stringified hex values.
+    BINARY(16), storing the raw bytes of the UUID.
 
+    Databases created before GUIDs were stored as bytes hold them as 32 character
+    hex strings, which migrate_guid_columns converts.
     """
     
-    impl = CHAR
+    impl = BINARY
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
             return dialect.type_descriptor(UUID())
         else:
-            return dialect.type_descriptor(CHAR(32))
+            return dialect.type_descriptor(BINARY(16))
 
     def process_bind_param(self, value, dialect):
         if value is None:
@@ -32,18 +35,17 @@ class GUID(TypeDecorator):
             return str(value)
         else:
             if not isinstance(value, uuid.UUID):
-                return "%.32x" % uuid.UUID(value).int
-            else:
-                # hexstring
-                return "%.32x" % value.int
+                value = uuid.UUID(value)
+            return value.bytes
 
     def process_result_value(self, value, dialect):
-        if value is None:
+        if value is None or isinstance(value, uuid.UUID):
             return value
+        elif isinstance(value, bytes):
+            return uuid.UUID(bytes=value)
         else:
-            if not isinstance(value, uuid.UUID):
-                value = uuid.UUID(value)
-            return value
+            # PostgreSQL, or a hex string that hasn't been migrated yet.
+            return uuid.UUID(value)
 
 class HexByteString(TypeDecorator):
     """Convert Python bytestring to string with hexadecimal degiits and back for storage."""
@@ -58,4 +60,122 @@ class HexByteString(TypeDecorator):
     def process_result_value(self, value, dialect):
         return bytes.fromhex(value) if value else None
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+class UnsupportedMigration(Exception):
+    """Raised when a database needs a migration that can't be run on its dialect."""
+
+    pass
+
+class Migration(Base):
+    """Migration ORM, recording the migrations of existing data that have been completed.
+
+    Attributes:
+        __tablename__ (str): Name of database table
+        name (str): Name of the migration, e.g. BINARY_GUIDS_MIGRATION.
+        completed_at (datetime): When the migration was completed.
+    """
+
+    __tablename__ = 'migration'
+
+    name = Column(String, primary_key=True)
+    completed_at = Column(DateTime)
+
+# Name of the migration converting hex string GUIDs into binary values.
+BINARY_GUIDS_MIGRATION = 'binary_guids'
+
+def migration_completed(conn, name):
+    """Check whether a migration has been recorded as completed.
+
+    Arguments:
+        conn (Connection or Engine): Connection to the database.
+        name (str): Name of the migration.
+
+    Returns:
+        result (bool): True if the migration was completed.
+    """
+    table = Migration.__table__
+    return conn.execute(select([table.c.name]).where(table.c.name==name)).scalar() is not None
+
+def record_migration(conn, name):
+    """Record a migration as completed.
+
+    Arguments:
+        conn (Connection): Connection to the database, in the migration's transaction.
+        name (str): Name of the migration.
+    """
+    conn.execute(Migration.__table__.insert(), name=name, completed_at=datetime.datetime.now())
+
+def guid_columns():
+    """List the GUID columns of every table, as (table, column) pairs."""
+    return [(table, column) for table in Base.metadata.sorted_tables
+            for column in table.columns if isinstance(column.type, GUID)]
+
+def find_hex_guids(conn, table, column):
+    """Fetch the GUIDs of a column that are still stored as 32 character hex strings.
+
+    Arguments:
+        conn (Connection): Connection to the database.
+        table (Table): Table holding the column.
+        column (Column): GUID column to check.
+
+    Returns:
+        result (list): The hex strings.
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    # Selecting through text() skips the GUID type, so the raw stored values come back.
+    rows = conn.execute(text(f'SELECT DISTINCT {quote(column.name)} FROM {quote(table.name)}'))
+    return [row[0] for row in rows if isinstance(row[0], str)]
+
+def migrate_guid_columns(engine):
+    """Convert GUIDs stored as 32 character hex strings into 16 byte binary values.
+
+    This is a no-op on PostgreSQL, which has a native UUID type, and for rows that have
+    already been converted. Only SQLite databases are converted: they were the only ones
+    supported before GUIDs were stored as bytes, and SQLite stores the bytes as they are in the
+    old CHAR(32) columns, so their type doesn't need to change. Other databases would need their
+    columns altered to BINARY(16), and their keys rebuilt, by hand.
+
+    Once no hex strings are left, this is recorded as BINARY_GUIDS_MIGRATION, and later calls
+    return right away instead of scanning the GUID columns again.
+
+    Arguments:
+        engine (Engine): Engine connected to the database to migrate.
+
+    Returns:
+        converted (int): Number of values that were converted.
+
+    Raises:
+        UnsupportedMigration: Raised if a database other than SQLite holds hex string GUIDs.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    converted = 0
+    with engine.begin() as conn:
+        if migration_completed(conn, BINARY_GUIDS_MIGRATION):
+            return 0
+        if engine.dialect.name == 'postgresql':
+            record_migration(conn, BINARY_GUIDS_MIGRATION)
+            return 0
+        if engine.dialect.name != 'sqlite':
+            unmigrated = sum(len(find_hex_guids(conn, table, column)) for table, column in guid_columns())
+            if unmigrated:
+                raise UnsupportedMigration(
+                    f'{unmigrated} GUIDs are stored as hex strings, which can only be converted '
+                    f'automatically on SQLite. Convert the GUID columns to BINARY(16) by hand.'
+                )
+            record_migration(conn, BINARY_GUIDS_MIGRATION)
+            return 0
+
+        for table, column in guid_columns():
+            table_name = quote(table.name)
+            column_name = quote(column.name)
+            hex_values = find_hex_guids(conn, table, column)
+            for hex_value in hex_values:
+                conn.execute(
+                    text(f'UPDATE {table_name} SET {column_name} = :new WHERE {column_name} = :old'),
+                    new=uuid.UUID(hex_value).bytes,
+                    old=hex_value,
+                )
+            converted += len(hex_values)
+        record_migration(conn, BINARY_GUIDS_MIGRATION)
+    return converted
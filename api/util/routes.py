@@ -8,7 +8,7 @@ import threading, logging
 
 # Local file imports
 import local_settings
-from users.util import get_user_from_request, is_logged_in
+from users.util import get_user_from_request, is_logged_in, password_hash_pool
 from util.decorators import requires_params, requires_login, requires_admin
 from util.util import BaseHandler, reboot_machine_with_delay, mount_as_needed, wake_media_server
 
@@ -43,4 +43,17 @@ class Remount(BaseHandler):
         Wakes the media server and mounts as necessary."""
         wake_media_server()
         mount_as_needed()
-        return self.HTTP_200()
\ No newline at end of file
+        return self.HTTP_200()
+
+class Metrics(BaseHandler):
+    """Route handler for fetching internal performance metrics."""
+
+    @requires_admin()
+    def get(self):
+        """GET /metrics.
+
+        Returns statistics about the password hashing pool.
+        """
+        return self.HTTP_200(data={
+            'password_hashing': password_hash_pool.metrics(),
+        })
\ No newline at end of file
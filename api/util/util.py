@@ -4,11 +4,12 @@
 """Utility functions and classes for all modules."""
 
 # Native python imports
-from datetime import datetime, timedelta
+import itertools
+import json
 import os
+import threading
 from pathlib import Path
 import time
-from wsgiref.handlers import format_date_time
 
 # Local file imports
 import local_settings
@@ -17,31 +18,125 @@ from settings import *
 
 # PIP library imports
 from pycnic.core import Handler
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from wakeonlan import send_magic_packet
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def create_db_engine(uri):
+    """Create a database engine, tuned for the database it connects to.
+
+    File-based SQLite databases get a pool of connections that may be shared between
+    threads, and each new connection is configured with SQLITE_PRAGMAS.
+
+    Arguments:
+        uri (str): SQLAlchemy database URI to connect to.
+
+    Returns:
+        engine (Engine): The configured engine.
+    """
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite':
+        # Server-based databases, e.g. PostgreSQL, may drop idle connections, so they are checked before use.
+        return create_engine(uri, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True)
+    if url.database in (None, '', ':memory:'):
+        return create_engine(uri)
+
+    new_engine = create_engine(
+        uri,
+        poolclass=QueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        connect_args={
+            'check_same_thread': False,
+            'timeout': SQLITE_PRAGMAS.get('busy_timeout', 5000) / 1000,
+        },
+    )
+    event.listen(new_engine, 'connect', set_sqlite_pragmas)
+    return new_engine
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Run the configured pragmas on a newly opened SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {pragma}={value}')
+    cursor.close()
+
+
+def database_modified_time():
+    """Fetch the last time the local database file was written to.
+
+    In WAL mode, recent writes live in the -wal file until they are checkpointed
+    into the main database file, so both files are checked.
+
+    Returns:
+        mtime (float): Modification time of the database as a unix timestamp, or None
+            if the database is not a local SQLite file.
+    """
+    if db_uri != f'sqlite:///{local_db_path}':
+        return None
+    mtime = os.path.getmtime(local_db_path)
+    wal_path = f'{local_db_path}-wal'
+    if os.path.exists(wal_path):
+        mtime = max(mtime, os.path.getmtime(wal_path))
+    return mtime
+
 
 # Variables and settings
-engine = create_engine(db_uri)
+engine = create_db_engine(db_uri)
 Session = sessionmaker(bind=engine)
 
+read_engines = [create_db_engine(uri) for uri in DB_READ_REPLICA_URIS]
+ReadSessions = [sessionmaker(bind=read_engine) for read_engine in read_engines]
+_read_session_counter = itertools.count()
+
+# Reason phrases for the status codes that BaseHandler responds with.
+RESPONSE_STATUSES = {
+    200: 'OK',
+    201: 'Created',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    416: 'Requested Range Not Satisfiable',
+    429: 'Too Many Requests',
+    503: 'Service Unavailable',
+}
+
+# Holds the database sessions shared by everything that handles the current request.
+_request_state = threading.local()
+
 
 class RangeFileWrapper:
     """FileWrapper with support for byte ranges.
 
     Borrowed from https://gist.github.com/dcwatson/cb5d8157a8fa5a4a046e"""
 
-    def __init__(self, filelike, blksize=8192, offset=0, length=None):
-        """Initialization function for iterable wrapper."""
+    def __init__(self, filelike, blksize=8192, offset=0, length=None, on_close=None):
+        """Initialization function for iterable wrapper.
+
+        Arguments:
+            on_close (callable): Called once the response has been sent, or abandoned.
+        """
         self.filelike = filelike
         self.filelike.seek(offset, os.SEEK_SET)
         self.remaining = length
         self.blksize = blksize
+        self.on_close = on_close
 
     def close(self):
         """Closes filelike."""
         if hasattr(self.filelike, 'close'):
             self.filelike.close()
+        if self.on_close:
+            on_close, self.on_close = self.on_close, None
+            on_close()
 
     def __iter__(self):
         """Returns self as iterator."""
@@ -65,13 +160,143 @@ class RangeFileWrapper:
             return data
 
 
+class EncodedResponse:
+    """Response body that has already been encoded, which pycnic sends as-is."""
+
+    def __init__(self, body):
+        """Initialization function for the response.
+
+        Arguments:
+            body (bytes): The encoded response body.
+        """
+        self.body = body
+
+    def __iter__(self):
+        """Returns an iterator over the single chunk of the body."""
+        return iter((self.body,))
+
+
+def encode_json(obj):
+    """Encode an object as JSON, using orjson when it is installed and enabled.
+
+    Arguments:
+        obj: The object to encode.
+
+    Returns:
+        result (bytes): The JSON encoded object.
+    """
+    if orjson and FAST_JSON:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+# The fixed part of each response envelope, encoded once per status code.
+_envelope_prefixes = {}
+
+
+def envelope_prefix(status_code):
+    """Fetch the encoded start of the response envelope for a status code.
+
+    Arguments:
+        status_code (int): HTTP status code of the response.
+
+    Returns:
+        prefix (bytes): Encoded envelope, up to and including the key of the data element.
+    """
+    try:
+        return _envelope_prefixes[status_code]
+    except KeyError:
+        prefix = (
+            b'{"status_code":' + encode_json(status_code)
+            + b',"status":' + encode_json(RESPONSE_STATUSES[status_code])
+            + b',"version":' + encode_json(settings.API_VERSION)
+            + b',"data":'
+        )
+        _envelope_prefixes[status_code] = prefix
+        return prefix
+
+
+def envelope_body(status_code, data={}, error=None, encoded_data=None):
+    """Encode a response body in the standard envelope.
+
+    Only the data and error elements are encoded for each response, the rest of the
+    envelope is encoded once per status code.
+
+    Arguments:
+        status_code (int): HTTP status code of the response.
+        data (dict): Data to be returned in the response.
+        error (str): Any error message that wants to be added to the response.
+        encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
+
+    Returns:
+        body (bytes): The encoded response body.
+    """
+    if encoded_data is None:
+        encoded_data = encode_json(data)
+    return b''.join([
+        envelope_prefix(status_code),
+        encoded_data,
+        b',"error":',
+        encode_json(error),
+        b'}',
+    ])
+
+
+class CachePolicy:
+    """Caching policy of a route, sent as the Cache-Control header of its responses.
+
+    Attributes:
+        header (str): Value of the Cache-Control header.
+    """
+
+    def __init__(self, max_age=None, public=False, private=False, immutable=False, no_cache=False, no_store=False):
+        """Initialization function for the policy.
+
+        Arguments:
+            max_age (int): Number of seconds a response may be reused for without revalidating.
+            public (bool): Whether shared caches, e.g. a CDN, may store the response.
+            private (bool): Whether the response may only be stored by the user's own browser.
+            immutable (bool): Whether the response will never change while it is fresh.
+            no_cache (bool): Whether caches must revalidate the response before reusing it.
+            no_store (bool): Whether caches may not store the response at all.
+        """
+        directives = []
+        if no_store:
+            directives.append('no-store')
+        if public:
+            directives.append('public')
+        if private:
+            directives.append('private')
+        if no_cache:
+            directives.append('no-cache')
+        if max_age is not None:
+            directives.append(f'max-age={max_age}')
+        if immutable:
+            directives.append('immutable')
+        self.header = ', '.join(directives)
+
+
+# Responses that should never be stored, e.g. errors, or data specific to a user.
+NO_STORE = CachePolicy(no_store=True)
+# Responses that may only be reused by the user's browser once it has revalidated them.
+PRIVATE_REVALIDATE = CachePolicy(private=True, no_cache=True)
+
+
 class BaseHandler(Handler):
     """Extension of pycnic's Handler class. 
 
     Provides utility functions for inheriting in specific http response handlers.
+
+    Attributes:
+        cache_policy (CachePolicy): Caching policy of the handler's responses. Handlers serving
+            data that can be shared between users should override this.
     """
+
+    cache_policy = NO_STORE
+
     def before(self):
         """Executes on receiving a request before any other execution.
+
         This sets necessary headers.
         """
         origin = self.request.get_header('Origin')
@@ -80,11 +305,38 @@ class BaseHandler(Handler):
             self.response.set_header('Access-Control-Allow-Origin', origin)
             self.response.set_header('Access-Control-Allow-Credentials', "true")
         self.response.set_header('X-Robots-Tag', 'noindex, nofollow, noarchive, notranslate, noimageindex')
+        self.response.set_header('Cache-Control', self.cache_policy.header)
+
+        begin_request_session()
 
-        next_day = datetime.now() + timedelta(days=1)
-        self.response.set_header('Expires', format_date_time(next_day.timestamp()))
+    def after(self):
+        """Executes after the request has been handled.
 
-    def HTTP_200(self, data={}, error=None): # 200 OK -- general success
+        This releases the database sessions used by the request.
+        """
+        end_request_session()
+
+    def envelope(self, status_code, data={}, error=None, encoded_data=None):
+        """Build an encoded response in the standard envelope, and set the response status.
+
+        Arguments:
+            status_code (int): HTTP status code of the response.
+            data (dict): Data to be returned in the response.
+            error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
+
+        Returns:
+            result (EncodedResponse): The encoded response body.
+        """
+        body = envelope_body(status_code, data, error, encoded_data)
+        self.response.status_code = status_code
+        self.response.set_header('Content-Length', str(len(body)))
+        if status_code >= 400:
+            # Errors should be retried, rather than served again from a cache.
+            self.response.set_header('Cache-Control', NO_STORE.header)
+        return EncodedResponse(body)
+
+    def HTTP_200(self, data={}, error=None, encoded_data=None): # 200 OK -- general success
         """200 OK response.
 
         General success
@@ -92,18 +344,11 @@ class BaseHandler(Handler):
         Arguments:
             data (dict): Data to be returned in the response.
             error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
         """
-        result = {
-            'status_code': 200,
-            'status': 'OK',
-            'version': settings.API_VERSION,
-            'data': data,
-            'error': error
-        }
-        self.response.status_code = 200
-        return result
+        return self.envelope(200, data, error, encoded_data)
 
-    def HTTP_201(self, data={}, error=None):
+    def HTTP_201(self, data={}, error=None, encoded_data=None):
         """201 Created response.
 
         Resource has been created.
@@ -111,18 +356,35 @@ class BaseHandler(Handler):
         Arguments:
             data (dict): Data to be returned in the response.
             error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
         """
-        result = {
-            'status_code': 201,
-            'status': 'Created',
-            'version': settings.API_VERSION,
-            'data': data,
-            'error': error
-        }
-        self.response.status_code = 201
-        return result
+        return self.envelope(201, data, error, encoded_data)
+
+    def HTTP_304(self, etag): # 304 Not Modified -- cached copy is still current
+        """304 Not Modified response.
+
+        The copy the client has cached, identified by its ETag, is still current.
+
+        Arguments:
+            etag (str): Identifies the current version of the response.
+        """
+        self.response.status_code = 304
+        self.response.set_header('ETag', f'"{etag}"')
+        return EncodedResponse(b'')
 
-    def HTTP_400(self, data={}, error=None): # 400 Bad Request -- request not understood by server
+    def etag_matches(self, etag):
+        """Check whether the client already has a version of the response, from its If-None-Match header.
+
+        Arguments:
+            etag (str): Identifies the current version of the response.
+        """
+        header = self.request.get_header('If-None-Match')
+        if not header:
+            return False
+        tags = {tag.strip() for tag in header.split(',')}
+        return '*' in tags or f'"{etag}"' in tags or f'W/"{etag}"' in tags
+
+    def HTTP_400(self, data={}, error=None, encoded_data=None): # 400 Bad Request -- request not understood by server
         """400 Bad Request response.
 
         Request not understood by server, general failure.
@@ -130,18 +392,11 @@ class BaseHandler(Handler):
         Arguments:
             data (dict): Data to be returned in the response.
             error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
         """
-        result = {
-            'status_code': 400,
-            'status': 'Bad Request',
-            'version': settings.API_VERSION,
-            'data': data,
-            'error': error
-        }
-        self.response.status_code = 400
-        return result
+        return self.envelope(400, data, error, encoded_data)
 
-    def HTTP_403(self, data={}, error=None): # 403 Forbidden -- no permission
+    def HTTP_403(self, data={}, error=None, encoded_data=None): # 403 Forbidden -- no permission
         """403 Forbidden response.
 
         User does not have permission to access the resource
@@ -149,18 +404,11 @@ class BaseHandler(Handler):
         Arguments:
             data (dict): Data to be returned in the response.
             error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
         """
-        result = {
-            'status_code': 403,
-            'status': 'Forbidden',
-            'version': settings.API_VERSION,
-            'data': data,
-            'error': error
-        }
-        self.response.status_code = 403
-        return result
+        return self.envelope(403, data, error, encoded_data)
 
-    def HTTP_404(self, data={}, error=None): # 404 Not Found -- resource not found
+    def HTTP_404(self, data={}, error=None, encoded_data=None): # 404 Not Found -- resource not found
         """404 Not Found response.
 
         Resource not found
@@ -168,18 +416,11 @@ class BaseHandler(Handler):
         Arguments:
             data (dict): Data to be returned in the response.
             error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
         """
-        result = {
-            'status_code': 404,
-            'status': 'Not Found',
-            'version': settings.API_VERSION,
-            'data': data,
-            'error': error
-        }
-        self.response.status_code = 404
-        return result
+        return self.envelope(404, data, error, encoded_data)
 
-    def HTTP_416(self, data={}, error=None): # 416 Requested Range Not Satisfiable -- out of bounds request
+    def HTTP_416(self, data={}, error=None, encoded_data=None): # 416 Requested Range Not Satisfiable -- out of bounds request
         """416 Requested Range Not Satisfiable response.
 
         Range requested was out of allowed bounds, e.g. "start" was beyond filesize.
@@ -187,18 +428,11 @@ class BaseHandler(Handler):
         Arguments:
             data (dict): Data to be returned in the response.
             error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
         """
-        result = {
-            'status_code': 416,
-            'status': 'Requested Range Not Satisfiable',
-            'version': settings.API_VERSION,
-            'data': data,
-            'error': error
-        }
-        self.response.status_code = 429
-        return result
+        return self.envelope(416, data, error, encoded_data)
 
-    def HTTP_429(self, data={}, error=None): # 429 Too Many Requests -- rate-limiting
+    def HTTP_429(self, data={}, error=None, encoded_data=None): # 429 Too Many Requests -- rate-limiting
         """429 Too Many Requests response.
 
         Rate limiting applied
@@ -206,16 +440,24 @@ class BaseHandler(Handler):
         Arguments:
             data (dict): Data to be returned in the response.
             error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
         """
-        result = {
-            'status_code': 429,
-            'status': 'Too Many Requests',
-            'version': settings.API_VERSION,
-            'data': data,
-            'error': error
-        }
-        self.response.status_code = 429
-        return result
+        return self.envelope(429, data, error, encoded_data)
+
+    def HTTP_503(self, data={}, error=None, encoded_data=None, retry_after=None): # 503 Service Unavailable -- temporarily overloaded
+        """503 Service Unavailable response.
+
+        Server is temporarily unable to handle the request
+
+        Arguments:
+            data (dict): Data to be returned in the response.
+            error (str): Any error message that wants to be added to the response.
+            encoded_data (bytes): Data that has already been encoded as JSON, used instead of data.
+            retry_after (int): Number of seconds the client should wait before trying again.
+        """
+        if retry_after is not None:
+            self.response.set_header('Retry-After', str(retry_after))
+        return self.envelope(503, data, error, encoded_data)
 
 
 class access_db:
@@ -224,19 +466,90 @@ class access_db:
     This automatically closes database connections on completion, 
     and is designed solely for convenience.
 
+    While a request is being handled, every use of access_db in the same thread shares
+    one session (per database), which is only closed once the request is finished.
+    This keeps the number of connections per request down, and means ORM objects
+    returned by helpers can still lazy-load their relationships.
+
+    Queries that only read data, and can tolerate a little replication lag, may pass
+    read_only=True to be spread across the read replicas in DB_READ_REPLICA_URIS.
+    Without any replicas configured, these use the main database. This is meant for the
+    listing endpoints: reads that decide a write, such as permission checks or a scan
+    comparing files with the tracks it knows, must use the main database, as a replica
+    may not have caught up with the last write yet.
+
     Example:
     with access_db() as db_conn:
         do_stuff()
         db_conn.commit()
     """
+    def __init__(self, read_only=False):
+        """Initialization function for the wrapper.
+
+        Arguments:
+            read_only (bool): Whether the connection may be made to a read replica.
+        """
+        self.read_only = read_only and bool(ReadSessions)
+
     def __enter__(self):
         """Connects to the database and return the connection as part of the setup process."""
-        self.db_conn = Session()
+        request_sessions = getattr(_request_state, 'sessions', None)
+        if request_sessions is None:
+            self.db_conn = self._new_session()
+            self.owns_session = True
+            return self.db_conn
+
+        # Reuse the session belonging to the current request.
+        self.owns_session = False
+        self.db_conn = request_sessions.get(self.read_only)
+        if self.db_conn is None:
+            self.db_conn = self._new_session()
+            request_sessions[self.read_only] = self.db_conn
         return self.db_conn
 
     def __exit__(self, type, value, traceback):
         """Closes the database connection as part of the teardown process."""
-        self.db_conn.close()
+        if self.owns_session:
+            self.db_conn.close()
+        elif type is not None:
+            # Leave the request's session usable for anything else that handles the request.
+            self.db_conn.rollback()
+
+    def _new_session(self):
+        """Create a session for either the main database, or one of the read replicas."""
+        if self.read_only:
+            # Rotate through the replicas.
+            return ReadSessions[next(_read_session_counter) % len(ReadSessions)]()
+        return Session()
+
+
+def begin_request_session():
+    """Start sharing database sessions between everything that handles the current request."""
+    end_request_session()
+    _request_state.sessions = {}
+
+
+def end_request_session():
+    """Close the database sessions used by the current request, if any."""
+    request_sessions = getattr(_request_state, 'sessions', None)
+    _request_state.sessions = None
+    if request_sessions:
+        for db_conn in request_sessions.values():
+            db_conn.close()
+
+
+def process_exists(pid):
+    """Check whether a process is still running. Only POSIX systems can check, so elsewhere every process is assumed to be."""
+    if pid == os.getpid() or os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, but owned by someone else.
+        return True
+    return True
 
 
 def reboot_machine_with_delay():
@@ -252,10 +565,15 @@ def reboot_machine():
 
 
 def mount_as_needed():
-    """Wake the media server, then mount if necessary."""
+    """Wake the media server, then mount if necessary.
+
+    Returns:
+        result (bool): Whether the media server is mounted afterwards.
+    """
     wake_media_server()
     try:
-        is_mounted()
+        if is_mounted():
+            return True
     except OSError as e:
         # Sometimes, a mount fails in a weird way. This attempts to fix that.
         if e.strerror == 'Host is down':
@@ -266,11 +584,10 @@ def mount_as_needed():
             logger.critical('Error while checking mount.')
             logger.critical(e)
             raise e
-    else:
-        return
 
     logger.warn('Remounting media server.')
     mount_smb()
+    return is_mounted()
 
 
 def is_mounted() -> bool:
@@ -279,7 +596,6 @@ def is_mounted() -> bool:
     if not settings.NEED_TO_MOUNT:
         return True
 
-    wake_media_server()
     p = Path(MUSIC_FOLDER)
     result = p.is_mount()
     return result
@@ -306,8 +622,6 @@ def mount_smb():
     if not settings.NEED_TO_MOUNT:
         return
 
-    wake_media_server()
-
     os.system(f'sudo {settings.MOUNT_SHARE_SCRIPT}')
 
 
@@ -315,3 +629,149 @@ def wake_media_server():
     """Wake the media server by sending it a magic packet."""
     if settings.NEED_TO_WAKE:
         send_magic_packet(local_settings.MAGIC_PACKET_MAC_ADDRESS)
+
+
+class MediaUnavailable(OSError):
+    """Raised when a file can't be opened because the media server is unavailable."""
+
+    pass
+
+
+class MountSupervisor:
+    """Keeps the media server awake and mounted from a background thread.
+
+    Request threads never wake or mount the media server themselves. They open files
+    directly, and only when that fails do they report it here, and wait for the background
+    thread to repair the mount. Failed repairs are retried with an exponential backoff,
+    while new requests wait for the repair rather than touching the share themselves.
+    """
+
+    def __init__(self):
+        """Initialization function for the supervisor."""
+        self._lock = threading.Lock()
+        self._failed = threading.Event()
+        self._healthy = threading.Event()
+        self._healthy.set()
+        self._thread = None
+        self.last_checked = 0
+
+    @property
+    def enabled(self):
+        """Whether the media server is remote, and may need to be woken or mounted."""
+        return settings.NEED_TO_MOUNT or settings.NEED_TO_WAKE
+
+    @property
+    def healthy(self):
+        """Whether the media server is believed to be available."""
+        return self._healthy.is_set()
+
+    def report_failure(self):
+        """Report that opening a file failed, so the mount is repaired in the background.
+
+        Returns:
+            result (bool): Whether the failure may have been caused by the media server, in which
+                case a repair was requested. If the mount was checked very recently, the file is
+                assumed to be missing instead.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self._healthy.is_set():
+                if time.monotonic() - self.last_checked < MOUNT_CHECK_COOLDOWN:
+                    return False
+                logger.warn('Could not open a file from the media server, repairing the mount.')
+                self._healthy.clear()
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='mount-supervisor', daemon=True)
+                self._thread.start()
+            self._failed.set()
+        return True
+
+    def wait_until_healthy(self, timeout):
+        """Wait for the media server to become available.
+
+        Arguments:
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+            result (bool): Whether the media server is available.
+        """
+        return self._healthy.wait(timeout)
+
+    def repair(self):
+        """Wake and remount the media server.
+
+        Returns:
+            result (bool): Whether the media server is mounted afterwards.
+        """
+        try:
+            result = mount_as_needed()
+        except Exception as e:
+            logger.warn(f'Could not repair the media server mount: {e}')
+            result = False
+        self.last_checked = time.monotonic()
+        return result
+
+    def _run(self):
+        """Repair the mount whenever a failure is reported, backing off while repairs fail."""
+        backoff = MOUNT_RETRY_MIN_BACKOFF
+        while True:
+            self._failed.wait()
+            if self.repair():
+                backoff = MOUNT_RETRY_MIN_BACKOFF
+                with self._lock:
+                    self._failed.clear()
+                    self._healthy.set()
+                logger.info('Media server is available.')
+            else:
+                logger.warn(f'Media server is unavailable, retrying in {backoff} seconds.')
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MOUNT_RETRY_MAX_BACKOFF)
+
+
+media_supervisor = MountSupervisor()
+
+
+def access_media(func, *args):
+    """Run a function that accesses files stored on the media server.
+
+    If the function fails, the mount supervisor is asked to repair the mount, and the function
+    is run again once it has been.
+
+    Arguments:
+        func (callable): Function accessing the media server, e.g. open.
+        args: Arguments to pass to the function.
+
+    Returns:
+        result: The result of the function.
+
+    Raises:
+        MediaUnavailable: If the media server was not available within MOUNT_REPAIR_WAIT seconds.
+        OSError: If the function failed for any other reason.
+    """
+    if media_supervisor.healthy:
+        try:
+            return func(*args)
+        except OSError:
+            if not media_supervisor.report_failure():
+                raise
+    if not media_supervisor.wait_until_healthy(MOUNT_REPAIR_WAIT):
+        raise MediaUnavailable('Media server unavailable.')
+    return func(*args)
+
+
+def open_media_file(path, mode='rb'):
+    """Open a file stored on the media server, repairing the mount if necessary.
+
+    Arguments:
+        path (str): Path of the file to open.
+        mode (str): Mode to open the file in.
+
+    Returns:
+        result (file): The opened file.
+
+    Raises:
+        MediaUnavailable: If the media server was not available within MOUNT_REPAIR_WAIT seconds.
+        OSError: If the file could not be opened for any other reason.
+    """
+    return access_media(open, path, mode)